@@ -0,0 +1,538 @@
+# rs-utils is available under the MIT License. https://github.com/RoundServices/rs-utils/
+# Copyright (c) 2022, Round Services LLC - https://roundservices.biz/
+#
+# Author: Ezequiel O Sandoval - esandoval@roundservices.biz
+#
+
+import aiohttp
+import asyncio
+import json
+import jwt
+import time
+from rs.utils import http, validators
+from rs.utils.basics import Logger
+from rs.utils.clients import GLUU_45_SCOPE, TokenCache, ValidatedTokenCache, check_claims, decode_verified, \
+    default_discovery_cache, default_jwks_cache, default_validated_token_cache, validate_claims
+from urllib.parse import urlsplit
+
+
+class AsyncHttpResponse:
+    """
+    AsyncHttpResponse is a fully read response, with the attributes of requests.Response used by rs clients,
+    so it can be checked with http.validate_response.
+    Attributes:
+        status_code: HTTP status code
+        headers: case insensitive response headers
+        content: body as bytes
+    """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def close(self):
+        pass
+
+
+class AsyncHttpTransport:
+    """
+    AsyncHttpTransport is the asyncio counterpart of http.HttpTransport: calls go through a pooled
+    aiohttp.ClientSession, created on first use in the running event loop, and are recorded in metrics with
+    connect (TCP and TLS, only on new connections), ttfb (server wait, until response headers, excluding connect)
+    and total durations in seconds, labelled by method, host and status.
+    Close it with await close() or use it with async with.
+    """
+
+    def __init__(self, limit=100, limit_per_host=10, timeout=(10, 60), metrics=None):
+        """
+        :param limit: max connections open at once
+        :param limit_per_host: max connections open at once per host
+        :param timeout: default timeout, seconds or a (connect, read) tuple
+        :param metrics: MetricsRegistry to record calls in, default is http.http_metrics
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.metrics = metrics if metrics is not None else http.http_metrics
+        self.session = None
+
+    async def request(self, method, url, data=None, headers=None, verify=True, timeout=None):
+        """
+        :param method: HTTP method
+        :param url: request URL
+        :param data: request body
+        :param headers: dict of request headers
+        :param verify: verify TLS certificates
+        :param timeout: seconds or a (connect, read) tuple, default is the transport timeout
+        :return: AsyncHttpResponse with the body already read
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host),
+                cookie_jar=aiohttp.DummyCookieJar(), trace_configs=[_connect_trace_config()])
+        phases = {}
+        status = "error"
+        content = b""
+        start_time = time.perf_counter()
+        try:
+            async with self.session.request(method, url, data=data, headers=headers, ssl=None if verify else False,
+                                            timeout=self._client_timeout(timeout),
+                                            trace_request_ctx=phases) as response:
+                phases["ttfb"] = max(0.0, time.perf_counter() - start_time - phases.get("connect", 0.0))
+                status = response.status
+                content = await response.read()
+                return AsyncHttpResponse(response.status, response.headers, content)
+        finally:
+            phases["total"] = time.perf_counter() - start_time
+            host = urlsplit(url).netloc.rpartition("@")[2]
+            for phase, duration in phases.items():
+                self.metrics.record("http_request_duration_seconds", duration, method=method, host=host,
+                                    status=status, phase=phase)
+            self.metrics.record("http_response_bytes", len(content), method=method, host=host, status=status)
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _client_timeout(self, timeout):
+        timeout = self.timeout if timeout is None else timeout
+        if isinstance(timeout, tuple):
+            return aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        return aiohttp.ClientTimeout(total=timeout)
+
+
+def _connect_trace_config():
+    """
+    :return: aiohttp.TraceConfig recording the time to open new connections in the phases dict passed as
+    trace_request_ctx
+    """
+
+    async def on_connection_create_start(session, context, params):
+        context.connect_start = time.perf_counter()
+
+    async def on_connection_create_end(session, context, params):
+        context.trace_request_ctx["connect"] = time.perf_counter() - context.connect_start
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    return trace_config
+
+
+class _SingleFlight:
+    """
+    coalesces concurrent coroutines of the same event loop working on the same key into a single task
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+    async def run(self, key, coroutine_function):
+        """
+        :param key: hashable key
+        :param coroutine_function: function with no params returning the coroutine to run
+        :return: result of the single task running for key
+        """
+        loop = asyncio.get_running_loop()
+        task_key = (loop, key)
+        task = self._tasks.get(task_key)
+        if task is None:
+            task = loop.create_task(coroutine_function())
+            self._tasks[task_key] = task
+            task.add_done_callback(lambda done: self._tasks.pop(task_key, None))
+        return await asyncio.shield(task)
+
+
+_single_flight = _SingleFlight()
+_background_tasks = set()
+
+
+class AsyncOIDCClient:
+    """
+    AsyncOIDCClient is the asyncio counterpart of clients.OIDCClient. It shares the discovery cache with
+    OIDCClient, the .well-known document is fetched on first use instead of in the constructor.
+    Close it with await close() or use it with async with, so the transport it created is closed too.
+    """
+
+    def __init__(self, idp_url, logger=Logger("AsyncOIDCClient"), verify=True, transport=None, discovery_cache=None,
+                 jwks_cache=None, validated_token_cache=None):
+        """
+        Params
+        :param idp_url: for instance 'https://myidp.myorg.com'
+        :param logger: RoundServices log. If None, default will be created
+        :param transport: AsyncHttpTransport used for every call. If None, a new one is created and closed by close()
+        :param discovery_cache: clients.DiscoveryCache for the .well-known document. If None, the shared one is used
+        :param jwks_cache: clients.JwksCache for token signing keys. If None, the shared one is used
+        :param validated_token_cache: clients.ValidatedTokenCache for verified tokens. If None, the shared one is used
+        """
+        self.idp_url = idp_url
+        self.logger = logger
+        self.verify = verify
+        self.transport = transport or AsyncHttpTransport()
+        self._owns_transport = transport is None
+        self.discovery_cache = discovery_cache or default_discovery_cache
+        self.jwks_cache = jwks_cache or default_jwks_cache
+        self.validated_token_cache = validated_token_cache or default_validated_token_cache
+        self.well_known = None
+
+    async def close(self):
+        """
+        closes the transport if it was created by this client, a transport passed to the constructor is left open
+        """
+        if self._owns_transport:
+            await self.transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def get_well_known(self, use_cache=True):
+        """
+        Executes a basic request to .well-known endpoint from a standard IDP
+        :param use_cache: if True, the document is served from the discovery cache when possible
+        :return: a dict that represent the information from endpoint. otherwise it will raise an error
+        """
+        cache = self.discovery_cache
+        document, state = cache.lookup(self.idp_url) if use_cache else (None, "missing")
+        if state == "stale" and cache.start_revalidation(self.idp_url):
+            task = asyncio.get_running_loop().create_task(self._revalidate())
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+        elif state == "missing":
+            document = await _single_flight.run((cache, self.idp_url), self._fetch_well_known)
+        self.logger.trace("obtained wellknown info: {}", document)
+        self.well_known = document
+        return document
+
+    async def _fetch_well_known(self):
+        """
+        same as clients.DiscoveryCache.fetch
+        """
+        url = self.idp_url + "/.well-known/openid-configuration"
+        self.logger.trace("GET request to {}", url)
+        response = await self.transport.get(url, verify=self.verify,
+                                            headers=self.discovery_cache.conditional_headers(self.idp_url))
+        if response.status_code == 304:
+            return self.discovery_cache.store(self.idp_url, response.headers, None)
+        http.validate_response(response, self.logger, "Can not reach Wellknown endpoint, with idp_url {} - DNS or host file?", self.idp_url)
+        return self.discovery_cache.store(self.idp_url, response.headers, response.json())
+
+    async def _revalidate(self):
+        try:
+            await self._fetch_well_known()
+        except Exception as err:
+            self.discovery_cache.end_revalidation(self.idp_url)
+            self.logger.warn("Could not revalidate discovery document of {}: {}", self.idp_url, err)
+
+    async def validate_idp(self):
+        """
+        Checks connectivity with the idp well-known endpoint and verifies the issuer.
+        :return: Boolean if there is no connectivity issues. Otherwise raise an error
+        """
+        self.logger.trace("Validating IDP with idp_url {}", self.idp_url)
+        return (await self.get_well_known(use_cache=False))['issuer'] == self.idp_url
+
+    async def request_to_token_endpoint(self, b64_client_credentials, params_in_dict):
+        """
+        same as clients.OIDCClient.request_to_token_endpoint
+        :return: a dict that represents json response from endpoint. otherwise raise an error
+        """
+        well_known = self.well_known or await self.get_well_known()
+        self.logger.trace("Getting AccToken with these values {}", params_in_dict)
+        payload = ""
+        for k, v in params_in_dict.items():
+            payload = "{}={}&{}".format(k, v, payload)
+        self.logger.trace("about to request acc_token with this payload {}", payload)
+        response = await self.transport.request("POST", well_known['token_endpoint'], data=payload, headers=self._get_basic_header(b64_client_credentials), verify=self.verify)
+        http.validate_response(response, self.logger, "Can not get access_token with these values {} - HTTP {}", payload, response.status_code)
+        response_json = response.json()
+        self.logger.debug("JSON Response obj is: {}", response_json)
+        return response_json
+
+    def _get_basic_header(self, credentials):
+        return {
+            'Authorization': "Basic %s" % credentials,
+            'Cache-Control': "no-cache",
+            'Content-Type': "application/x-www-form-urlencoded",
+            'Connection': "keep-alive",
+            'cache-control': "no-cache"
+        }
+
+    async def validate_jwt(self, claims, token, error_claim=None, verify_signature=True, audience=None):
+        """
+        same as clients.OIDCClient.validate_jwt
+        :return: Boolean
+        """
+        self.logger.debug('validate_jwt - token: {} - claims: {} - error_claim: {}', token, claims, error_claim)
+        if not verify_signature:
+            return validate_claims(self.logger, claims, token, error_claim)
+        decoded_token = await self._decode_verified(token, audience)
+        return decoded_token is not None and check_claims(self.logger, decoded_token, claims, error_claim)
+
+    async def validate_jwts(self, tokens, claims, error_claim=None, audience=None):
+        """
+        same as clients.OIDCClient.validate_jwts
+        :return: list of Booleans, one per token
+        """
+        tokens = list(tokens)
+        try:
+            jwks_uri = (await self.get_well_known())['jwks_uri']
+        except Exception as err:
+            self.logger.error("Could not get jwks_uri err msg: {}", err)
+            return [False] * len(tokens)
+        results = []
+        for token in tokens:
+            decoded_token = await self._decode_verified(token, audience, jwks_uri)
+            results.append(decoded_token is not None and check_claims(self.logger, decoded_token, claims, error_claim))
+        return results
+
+    async def _decode_verified(self, token, audience, jwks_uri=None):
+        """
+        :return: dict with the verified claims of token, None if it is not valid
+        """
+        try:
+            jwks_uri = jwks_uri or (await self.get_well_known())['jwks_uri']
+            cache_key = ValidatedTokenCache.key(jwks_uri, token, audience)
+            decoded_token = self.validated_token_cache.get(cache_key)
+            if decoded_token is not None:
+                return decoded_token
+            kid = jwt.get_unverified_header(token).get("kid")
+            key, state = self.jwks_cache.lookup(jwks_uri, kid)
+            if state == "refresh":
+                await _single_flight.run((self.jwks_cache, jwks_uri), lambda: self._fetch_jwks(jwks_uri))
+                key = self.jwks_cache.lookup(jwks_uri, kid)[0]
+            if key is None:
+                self.logger.error("No signing key with kid {} in {}", kid, jwks_uri)
+                return None
+            decoded_token = decode_verified(token, key, audience)
+        except Exception as err:
+            self.logger.error("Could not verify token err msg: {}", err)
+            return None
+        self.validated_token_cache.put(cache_key, decoded_token)
+        return decoded_token
+
+    async def _fetch_jwks(self, jwks_uri):
+        """
+        same as clients.JwksCache.fetch
+        """
+        self.jwks_cache.start_fetch(jwks_uri)
+        self.logger.trace("GET request to {}", jwks_uri)
+        response = await self.transport.get(jwks_uri, verify=self.verify)
+        http.validate_response(response, self.logger, "Can not get JWKS from {} - HTTP {}", jwks_uri, response.status_code)
+        self.jwks_cache.store(jwks_uri, response.json())
+
+
+class AsyncUMAClient:
+    """
+    AsyncUMAClient is the asyncio counterpart of clients.UMAClient, RPTs are cached and refreshed the same way.
+    Close it with await close() or use it with async with, so the transport it created is closed too.
+    """
+
+    def __init__(self, api_base_endpoint, b64_client_credentials, logger=Logger("AsyncUMAClient"), verify=True, is_gluu_45=False, transport=None, token_cache=None):
+        """
+        Constructor
+        :param api_base_endpoint: for instance "https://myidp.org.com/identity/restv1/api/v1
+        :param b64_client_credentials: 'client_id:client_secret' in base64 encoded format
+        :param logger: RoundServices log. If it is None, default will be created.
+        :param transport: AsyncHttpTransport used for every call. If None, a new one is created and closed by close()
+        :param token_cache: clients.TokenCache for RPTs. If None, a new one is created for this client
+        """
+        self.api_base_endpoint = api_base_endpoint
+        self.b64_client_credentials = b64_client_credentials
+        self.logger = logger
+        self.verify = verify
+        self.transport = transport or AsyncHttpTransport()
+        self._owns_transport = transport is None
+        self._oidc_client = None
+        self.token_cache = token_cache or TokenCache()
+        self.is_gluu_45 = is_gluu_45
+        self.logger.debug("is_gluu_45 deployment: {}", is_gluu_45)
+
+    async def close(self):
+        """
+        closes the transport if it was created by this client, a transport passed to the constructor is left open
+        """
+        if self._owns_transport:
+            await self.transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def get_rpt(self, path, operation="GET", use_cache=True):
+        """
+        same as clients.UMAClient.get_rpt
+        :return: an String that represents a valid access_token for that resource. otherwise raise an error.
+        """
+        key = self._token_cache_key(path, operation)
+        if not use_cache:
+            self.token_cache.invalidate(key)
+        token = self.token_cache.get(key)
+        if token is None:
+            token = await _single_flight.run((self.token_cache, key), lambda: self._fetch_rpt(key, path, operation))
+        return token
+
+    def _token_cache_key(self, path, operation):
+        return ('client_credentials',) if self.is_gluu_45 else (path, operation)
+
+    async def _fetch_rpt(self, key, path, operation):
+        token, expires_in = await self._request_rpt(path, operation)
+        self.token_cache.put(key, token, expires_in)
+        return token
+
+    async def _request_rpt(self, path, operation):
+        """
+        requests a new RPT, see clients.UMAClient.get_rpt
+        :return: (access_token, expires_in)
+        """
+        idp_url = "/".join(self.api_base_endpoint.split("/", 3)[:3])
+        self.logger.trace("idp_url is {}", idp_url)
+        if not self.is_gluu_45:
+            url = self.api_base_endpoint + "/" + path
+            self.logger.trace("Starting RPT with url {} with operation: {}", url, operation)
+            response = await self.transport.request(operation, url, data="", headers=self._get_operation_headers(""), verify=self.verify)
+            if response.status_code != 401:
+                validators.raise_and_log(self.logger, IOError, "Can not get ticket to be exchanged for RPT, maybe UMA not enabled? - HTTP {}", response.status_code)
+            ticket = dict(x.split("=") for x in response.headers['WWW-Authenticate'].split(",")).get(' ticket')
+            self.logger.trace("Ticket value is {}", ticket)
+            payload = {
+                'grant_type': 'urn:ietf:params:oauth:grant-type:uma-ticket',
+                'ticket': ticket
+            }
+        else:
+            payload = {
+                'grant_type': 'client_credentials',
+                'scope': GLUU_45_SCOPE
+            }
+        token_response = await self._get_oidc_client(idp_url).request_to_token_endpoint(self.b64_client_credentials, payload)
+        return token_response['access_token'], token_response.get('expires_in')
+
+    def _get_oidc_client(self, idp_url):
+        if self._oidc_client is None or self._oidc_client.idp_url != idp_url:
+            self._oidc_client = AsyncOIDCClient(idp_url, self.logger, self.verify, self.transport)
+        return self._oidc_client
+
+    async def get(self, sub_path):
+        return await self.execute("GET", sub_path)
+
+    async def post(self, sub_path, json_obj):
+        return await self.execute("POST", sub_path, json_obj)
+
+    async def put(self, sub_path, json_obj):
+        return await self.execute("PUT", sub_path, json_obj)
+
+    async def delete(self, sub_path):
+        return await self.execute("DELETE", sub_path)
+
+    async def execute(self, operation, sub_path, json_obj=None, rpt=None):
+        """
+        same as clients.UMAClient.execute
+        :return: returns a dict based on the json returned by API
+        """
+        url = "{}/{}".format(self.api_base_endpoint, sub_path)
+        body = "" if json_obj is None else json.dumps(json_obj)
+        self.logger.debug("""
+        UMA requests with params:
+        operation: {}
+        url: {}
+        json_obj: {}
+        """, operation, url, json.dumps(json_obj))
+        token = await self.get_rpt(sub_path, operation) if rpt is None else rpt
+        response = await self.transport.request(operation, url, data=body, headers=self._get_operation_headers(token), verify=self.verify)
+        if response.status_code == 401 and rpt is None:
+            self.logger.debug("Cached RPT rejected for {} {}, requesting a new one", operation, url)
+            self.token_cache.invalidate(self._token_cache_key(sub_path, operation), token)
+            token = await self.get_rpt(sub_path, operation)
+            response = await self.transport.request(operation, url, data=body, headers=self._get_operation_headers(token), verify=self.verify)
+        http.validate_response(response, self.logger, "Execute Failed - HTTP Code: {}".format(response.status_code))
+        try:
+            return response.json()
+        except:
+            return {}
+
+    async def execute_many(self, entries, max_concurrency=8, rate_limit=None, burst=1):
+        """
+        same as clients.UMAClient.execute_many, running up to max_concurrency requests at once in the event loop
+        :return: async generator of result dicts, in completion order
+        """
+        limiter = _AsyncRateLimiter(rate_limit, burst) if rate_limit else None
+        entries = iter(enumerate(entries))
+        pending = set()
+        try:
+            while True:
+                for index, entry in entries:
+                    pending.add(asyncio.ensure_future(self._execute_entry(index, entry, limiter)))
+                    if len(pending) >= 2 * max_concurrency:
+                        break
+                if not pending:
+                    return
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _execute_entry(self, index, entry, limiter):
+        operation, sub_path = entry[0], entry[1]
+        json_obj = entry[2] if len(entry) > 2 else None
+        if limiter is not None:
+            await limiter.acquire()
+        report = {'index': index, 'operation': operation, 'sub_path': sub_path, 'result': None, 'error': None}
+        start_time = time.monotonic()
+        try:
+            report['result'] = await self.execute(operation, sub_path, json_obj)
+        except Exception as err:
+            self.logger.debug("Request {} {} failed: {}", operation, sub_path, err)
+            report['error'] = err
+        report['elapsed'] = time.monotonic() - start_time
+        return report
+
+    def _get_operation_headers(self, ticket):
+        return {
+            'Authorization': "Bearer %s" % ticket,
+            'Content-Type': "application/json",
+            'Connection': "keep-alive",
+            'cache-control': "no-cache"
+        }
+
+
+class _AsyncRateLimiter(http.RateLimiter):
+    """
+    http.RateLimiter that waits with asyncio.sleep instead of blocking the event loop
+    """
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
@@ -4,13 +4,512 @@
 # Author: Ezequiel O Sandoval - esandoval@roundservices.biz
 #
 
+from collections import ChainMap, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from fnmatch import fnmatch
+import atexit
+import ctypes
+import ctypes.util
+import filecmp
+import gzip
+import hashlib
+import json
+import os
+import queue
 import sys
 import re
+import select
+import shutil
+import struct
+import tempfile
+import threading
+import time
 from os.path import isfile, join, isdir
 from os import listdir
 from rs.utils import validators
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LOG_LEVELS = {
+    "ERROR": 1,
+    "WARN": 2,
+    "INFO": 3,
+    "DEBUG": 4,
+    "TRACE": 5
+}
+
+
+class LogSink(object):
+    """
+    LogSink is the single writer of a log file inside a process, shared by every Logger logging to that path.
+    The file is opened once with O_APPEND and every write is a single os.write of whole lines, so lines from
+    several processes appending to the same file never tear or overwrite each other.
+    Attributes:
+        log_path: absolute path of the log file
+        use_lock: if True, also takes an exclusive flock on the file around each write
+        max_line_bytes: longer lines are truncated so each write stays small enough to be atomic
+        max_bytes: rotate when the file would grow past this size, None disables size rotation
+        rotate_interval: rotate every rotate_interval seconds, None disables time rotation
+        backup_count: number of rotated segments kept
+        compress: gzip rotated segments on a background thread
+    """
+
+    max_write_bytes = 65536
+    stale_check_interval = 1.0
+    default_options = (("use_lock", False), ("max_line_bytes", 8192), ("max_bytes", None), ("rotate_interval", None),
+                       ("backup_count", 7), ("compress", True))
+    _sinks = {}
+    _sinks_lock = threading.Lock()
+
+    def __init__(self, log_path, use_lock=False, max_line_bytes=8192, max_bytes=None, rotate_interval=None,
+                 backup_count=7, compress=True):
+        self.log_path = log_path
+        self.use_lock = use_lock and fcntl is not None
+        self.max_line_bytes = max_line_bytes
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.compress = compress
+        self._fd = None
+        self._lock = threading.Lock()
+        self._writer = None
+        self._next_rollover = None
+        self._next_stale_check = 0
+
+    @classmethod
+    def get(cls, log_path, use_lock=False, max_line_bytes=8192, max_bytes=None, rotate_interval=None,
+            backup_count=7, compress=True):
+        """
+        returns the sink shared by every Logger of this process writing to log_path.
+        Options different from their defaults are also applied to an existing sink, so a Logger asking for rotation
+        gets it even when a Logger with default options, like the library ones logging to rs_logger.log, wrote
+        first. Default options never override the ones of an existing sink, and the last non-default value wins.
+        :param log_path: file to append log
+        :param use_lock: take an exclusive flock around each write
+        :param max_line_bytes: max encoded size of a single line
+        :param max_bytes: size in bytes that triggers a rotation
+        :param rotate_interval: seconds between rotations
+        :param backup_count: number of rotated segments kept
+        :param compress: gzip rotated segments
+        :return: LogSink
+        """
+        key = os.path.abspath(log_path)
+        with cls._sinks_lock:
+            sink = cls._sinks.get(key)
+            if sink is None:
+                sink = cls(key, use_lock, max_line_bytes, max_bytes, rotate_interval, backup_count, compress)
+                cls._sinks[key] = sink
+            else:
+                sink._apply_options(use_lock=use_lock, max_line_bytes=max_line_bytes, max_bytes=max_bytes,
+                                    rotate_interval=rotate_interval, backup_count=backup_count, compress=compress)
+            return sink
+
+    def _apply_options(self, **options):
+        """
+        applies the options that differ from their defaults, see get
+        """
+        with self._lock:
+            for name, default in self.default_options:
+                value = options[name]
+                if name == "use_lock":
+                    value = value and fcntl is not None
+                if value == default or value == getattr(self, name):
+                    continue
+                setattr(self, name, value)
+                if name == "rotate_interval" and self._fd is not None:
+                    self._schedule_rollover()
+
+    def get_async_writer(self, queue_size=10000, batch_size=500, flush_interval=1.0, block_on_full=True):
+        """
+        returns the AsyncLogWriter feeding this sink, creating it on first use
+        """
+        with self._lock:
+            if self._writer is None or self._writer.closed:
+                self._writer = AsyncLogWriter(self, queue_size, batch_size, flush_interval, block_on_full)
+            return self._writer
+
+    def write(self, lines):
+        """
+        appends lines with as few atomic writes as possible
+        :param lines: list of log lines, each one ending with a line break
+        """
+        chunks = []
+        chunk = b""
+        for line in lines:
+            data = line.encode("utf-8")
+            if len(data) > self.max_line_bytes:
+                data = data[:self.max_line_bytes - 4].decode("utf-8", "ignore").encode("utf-8") + b"...\n"
+            if chunk and len(chunk) + len(data) > self.max_write_bytes:
+                chunks.append(chunk)
+                chunk = b""
+            chunk += data
+        if chunk:
+            chunks.append(chunk)
+        with self._lock:
+            if self._fd is None:
+                self._open()
+            if self.use_lock:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                for data in chunks:
+                    if self.max_bytes is not None or self.rotate_interval is not None:
+                        self._rotate_if_needed(len(data))
+                    while data:
+                        data = data[os.write(self._fd, data):]
+            finally:
+                if self.use_lock:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        """
+        stops the async writer, if any, and closes the file
+        """
+        if self._writer is not None:
+            self._writer.close()
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def _open(self):
+        self._fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._schedule_rollover()
+
+    def _schedule_rollover(self):
+        if self.rotate_interval is not None:
+            self._next_rollover = (int(time.time() // self.rotate_interval) + 1) * self.rotate_interval
+
+    def _reopen(self):
+        """
+        reopens log_path keeping the flock, if any, on the new descriptor
+        """
+        old_fd = self._fd
+        self._open()
+        if self.use_lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            fcntl.flock(old_fd, fcntl.LOCK_UN)
+        os.close(old_fd)
+
+    def _rotate_if_needed(self, pending_bytes):
+        """
+        rotates log_path when the next write would exceed max_bytes or the rotate_interval elapsed.
+        Called with the sink lock (and flock, if enabled) held.
+        :param pending_bytes: size of the next write
+        """
+        now = time.time()
+        if self.use_lock or now >= self._next_stale_check:
+            self._next_stale_check = now + self.stale_check_interval
+            if self._is_stale():
+                self._reopen()
+        size = os.fstat(self._fd).st_size
+        if size == 0:
+            return
+        if not ((self.max_bytes is not None and size + pending_bytes > self.max_bytes)
+                or (self._next_rollover is not None and now >= self._next_rollover)):
+            return
+        if self._is_stale():
+            self._reopen()
+            return
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        suffix = max([order[1] + 1 for order, _ in self._segments() if order[0] == timestamp], default=0)
+        rotated_path = "{}.{}".format(self.log_path, timestamp)
+        if suffix > 0:
+            rotated_path = "{}.{}".format(rotated_path, suffix)
+        os.rename(self.log_path, rotated_path)
+        self._reopen()
+        if self.compress:
+            _LogCompressor.submit(rotated_path, self)
+        else:
+            self.apply_retention()
+
+    def _is_stale(self):
+        """
+        :return: True if log_path was rotated or removed by another process since it was opened here
+        """
+        try:
+            path_stat = os.stat(self.log_path)
+        except OSError:
+            return True
+        fd_stat = os.fstat(self._fd)
+        return (path_stat.st_dev, path_stat.st_ino) != (fd_stat.st_dev, fd_stat.st_ino)
+
+    def apply_retention(self):
+        """
+        removes the oldest rotated segments so at most backup_count of them are kept
+        """
+        segments = [path for _, path in sorted(self._segments())]
+        for segment in segments[:max(0, len(segments) - self.backup_count)]:
+            try:
+                os.remove(segment)
+            except OSError:
+                pass
+
+    def _segments(self):
+        """
+        :return: list of ((timestamp, suffix), path) of rotated segments, compressed or not, where ordering by
+        (timestamp, suffix) is rotation order
+        """
+        directory, base_name = os.path.split(self.log_path)
+        pattern = re.compile(re.escape(base_name) + r"\.(\d{8}-\d{6})(?:\.(\d+))?(?:\.gz)?$")
+        segments = []
+        for f in listdir(directory):
+            match = pattern.match(f)
+            if match:
+                segments.append(((match.group(1), int(match.group(2) or 0)), join(directory, f)))
+        return segments
+
+    @classmethod
+    def _reset_after_fork(cls):
+        """
+        runs in a forked child: writer threads do not survive a fork, so their queues are abandoned
+        and children write synchronously through the inherited O_APPEND descriptors
+        """
+        cls._sinks_lock = threading.Lock()
+        for sink in cls._sinks.values():
+            sink._lock = threading.Lock()
+            if sink._writer is not None:
+                sink._writer.closed = True
+            sink._writer = None
+        _LogCompressor.reset()
+
+
+class _LogCompressor(object):
+    """
+    gzips rotated log segments on a single background thread, so logging calls never pay for compression.
+    Segments wait compress_delay seconds first, giving other processes time to notice the rotation and reopen.
+    """
+
+    compress_delay = 2.0
+    _queue = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def submit(cls, rotated_path, sink):
+        with cls._lock:
+            if cls._queue is None:
+                cls._queue = queue.Queue()
+                threading.Thread(target=cls._run, args=(cls._queue,), name="LogCompressor", daemon=True).start()
+            cls._queue.put((time.monotonic() + cls.compress_delay, rotated_path, sink))
+
+    @classmethod
+    def reset(cls):
+        cls._lock = threading.Lock()
+        cls._queue = None
+
+    @classmethod
+    def _run(cls, jobs):
+        while True:
+            not_before, rotated_path, sink = jobs.get()
+            time.sleep(max(0, not_before - time.monotonic()))
+            try:
+                with open(rotated_path, "rb") as f_in, gzip.open(rotated_path + ".gz.tmp", "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+                os.rename(rotated_path + ".gz.tmp", rotated_path + ".gz")
+                os.remove(rotated_path)
+            except Exception:
+                pass
+            sink.apply_retention()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=LogSink._reset_after_fork)
+
+
+class AsyncLogWriter(object):
+    """
+    AsyncLogWriter appends log lines to a LogSink from a single background thread
+    Lines are queued in a bounded in-memory queue and written in batches.
+    Attributes:
+        sink: LogSink lines are written to
+        batch_size: max number of lines written per batch
+        flush_interval: max seconds a queued line waits before being written
+        block_on_full: if True callers wait when queue is full, otherwise the line is dropped
+        dropped: number of lines dropped because queue was full
+    """
+
+    _STOP = object()
+
+    def __init__(self, sink, queue_size=10000, batch_size=500, flush_interval=1.0, block_on_full=True):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_on_full = block_on_full
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self.closed = False
+        self._thread = threading.Thread(target=self._run, name="AsyncLogWriter", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, line):
+        """
+        queues a line to be appended
+        :param line: full log line, including line break
+        """
+        if self.closed:
+            self._append([line])
+            return
+        if self.block_on_full:
+            self._queue.put(line)
+            return
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def flush(self, timeout=None):
+        """
+        blocks until every line queued before this call is written
+        :param timeout: max seconds to wait, None waits forever
+        :return: True if lines were written before timeout
+        """
+        if self.closed:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        """
+        writes pending lines and stops the writer thread, later lines are written synchronously
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    def _run(self):
+        """
+        writer thread loop, writes a batch when it is full or when flush_interval has elapsed
+        """
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        stop = False
+        while not stop:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+            events = []
+            while item is not None:
+                if item is self._STOP:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    events.append(item)
+                else:
+                    batch.append(item)
+                if stop or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = None
+            if batch and (stop or events or len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._append(batch)
+                batch = []
+            if not batch:
+                deadline = time.monotonic() + self.flush_interval
+            for event in events:
+                event.set()
+
+    def _append(self, lines):
+        """
+        writes a batch to the sink
+        :param lines: list of log lines
+        """
+        try:
+            self.sink.write(lines)
+        except Exception:
+            pass
+
+
+class LogSuppressor(object):
+    """
+    LogSuppressor limits identical messages to max_repeats per window seconds.
+    Messages are identified by (level, function, template), tracked keys are evicted in LRU order
+    once max_keys is reached, so memory stays bounded.
+    Attributes:
+        max_repeats: number of identical messages logged per window
+        window: window length in seconds
+        max_keys: max number of tracked keys
+    """
+
+    def __init__(self, max_repeats, window=60.0, max_keys=1024):
+        self.max_repeats = max_repeats
+        self.window = window
+        self.max_keys = max_keys
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, key):
+        """
+        registers a message
+        :param key: (level, function, template) tuple
+        :return: (log, summaries) where log tells if the message must be logged and summaries is a list of
+        (key, suppressed_count) for windows that have just ended with suppressed messages
+        """
+        now = time.monotonic()
+        summaries = []
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None:
+                state = [now, 0, 0]
+                self._keys[key] = state
+                while len(self._keys) > self.max_keys:
+                    evicted_key, evicted_state = self._keys.popitem(last=False)
+                    if evicted_state[2] > 0:
+                        summaries.append((evicted_key, evicted_state[2]))
+            else:
+                self._keys.move_to_end(key)
+                if now - state[0] >= self.window:
+                    if state[2] > 0:
+                        summaries.append((key, state[2]))
+                    state[0], state[1], state[2] = now, 0, 0
+            state[1] += 1
+            if state[1] > self.max_repeats:
+                state[2] += 1
+                return False, summaries
+            return True, summaries
+
+    def expire(self):
+        """
+        ends windows that have elapsed with suppressed messages
+        :return: (summaries, next_expiry) where summaries is a list of (key, suppressed_count) and next_expiry the
+        seconds until the next window with suppressed messages ends, None if there is none
+        """
+        now = time.monotonic()
+        summaries = []
+        next_expiry = None
+        with self._lock:
+            for key, state in self._keys.items():
+                if state[2] == 0:
+                    continue
+                remaining = state[0] + self.window - now
+                if remaining <= 0:
+                    summaries.append((key, state[2]))
+                    state[0], state[1], state[2] = now, 0, 0
+                else:
+                    next_expiry = remaining if next_expiry is None else min(next_expiry, remaining)
+        return summaries, next_expiry
+
+    def drain(self):
+        """
+        ends every tracked window
+        :return: list of (key, suppressed_count) for windows with suppressed messages
+        """
+        with self._lock:
+            summaries = [(key, state[2]) for key, state in self._keys.items() if state[2] > 0]
+            self._keys.clear()
+        return summaries
+
 
 class Logger(object):
     """
@@ -19,190 +518,1206 @@ class Logger(object):
     Attributes:
         _name: name of the Logger instance
         _level: log level mode
+        _level_no: integer value of _level, resolved once in set_level
         log_path: file to append log
+        log_format: "text" for "time || level || name || function || msg" lines, "json" for one JSON object per line
+        _sink: LogSink shared by every Logger of the process writing to log_path, see LogSink for rotation options.
+        Resolved on the first write, so a relative log_path is relative to the working directory at that time
+        _writer: AsyncLogWriter of _sink used when async_mode is enabled, otherwise None
+        _suppressor: LogSuppressor used when suppress_repeats is set, otherwise None. "suppressed" summaries are
+        logged by a timer once their window ends, and at exit
     """
 
-    def __init__(self, name, log_level="DEBUG", log_path="rs_logger.log"):
+    def __init__(self, name, log_level="DEBUG", log_path="rs_logger.log", async_mode=False, queue_size=10000,
+                 batch_size=500, flush_interval=1.0, block_on_full=True, use_lock=False, max_line_bytes=8192,
+                 max_bytes=None, rotate_interval=None, backup_count=7, compress=True, log_format="text",
+                 suppress_repeats=None, suppress_window=60.0, suppress_max_keys=1024):
         self._name = name
-        self._level = log_level
+        self.set_level(log_level)
         self.log_path = log_path
+        self.log_format = log_format
+        self._sink_options = (use_lock, max_line_bytes, max_bytes, rotate_interval, backup_count, compress)
+        self._writer_options = (queue_size, batch_size, flush_interval, block_on_full) if async_mode else None
+        self._sink = None
+        self._writer = None
+        self._sink_lock = threading.Lock()
+        self._suppressor = LogSuppressor(suppress_repeats, suppress_window,
+                                         suppress_max_keys) if suppress_repeats is not None else None
+        self._summary_timer = None
+        self._summary_lock = threading.Lock()
+        if self._suppressor is not None:
+            atexit.register(self._drain_summaries)
+
+    @property
+    def dropped(self):
+        """
+        number of lines dropped by the async writer because its queue was full
+        """
+        return self._writer.dropped if self._writer is not None else 0
+
+    def flush(self, timeout=None):
+        """
+        waits until queued lines are written to log_path. No-op in sync mode
+        :param timeout: max seconds to wait, None waits forever
+        """
+        if self._writer is not None:
+            return self._writer.flush(timeout)
+        return True
+
+    def close(self):
+        """
+        logs pending "suppressed" summaries, writes queued lines and stops the async writer shared by every Logger
+        of log_path
+        """
+        self._drain_summaries()
+        if self._writer is not None:
+            self._writer.close()
+
+    def set_level(self, log_level):
+        """
+        sets log level, resolving it to an integer so disabled calls return before any work
+        :param log_level: one of ERROR, WARN, INFO, DEBUG, TRACE
+        """
+        level_no = self._log_level(log_level)
+        if not isinstance(level_no, int):
+            raise ValueError("Invalid log level: {}".format(log_level))
+        self._level = log_level
+        self._level_no = level_no
+
+    def is_enabled(self, log_level):
+        """
+        :param log_level: one of ERROR, WARN, INFO, DEBUG, TRACE
+        :return: True if a message of that level would be logged
+        """
+        return LOG_LEVELS.get(log_level, 0) <= self._level_no
 
     def trace(self, msg, *args):
         """
         TRACE log
-        :param msg: msg to log
+        :param msg: msg to log, or a callable returning it that is only called if TRACE is enabled
         """
-        self._log("TRACE", msg, *args)
+        if self._level_no >= 5:
+            self._log("TRACE", msg, *args)
 
     def debug(self, msg, *args):
         """
         DEBUG log
-        :param msg: msg to log
+        :param msg: msg to log, or a callable returning it that is only called if DEBUG is enabled
         """
-        self._log("DEBUG", msg, *args)
+        if self._level_no >= 4:
+            self._log("DEBUG", msg, *args)
 
     def info(self, msg, *args):
         """
         INFO log
-        :param msg: msg to log
+        :param msg: msg to log, or a callable returning it that is only called if INFO is enabled
         """
-        self._log("INFO", msg, *args)
+        if self._level_no >= 3:
+            self._log("INFO", msg, *args)
 
     def warn(self, msg, *args):
         """
         WARN log
-        :param msg: msg to log
+        :param msg: msg to log, or a callable returning it that is only called if WARN is enabled
         """
-        self._log("WARN", msg, *args)
+        if self._level_no >= 2:
+            self._log("WARN", msg, *args)
 
     def error(self, msg, *args):
         """
         ERROR log
-        :param msg: msg to log
+        :param msg: msg to log, or a callable returning it
         """
-        self._log("ERROR", msg, *args)
+        if self._level_no >= 1:
+            self._log("ERROR", msg, *args)
 
     def _log(self, function_log_level, msg, *args):
         """
-        logs according level set
+        logs a message already known to be enabled, args are only formatted here
         :param function_log_level: log level
         :param msg: msg to log
         """
         function = sys._getframe(2).f_code.co_name
-        if self._log_level(self._level) >= self._log_level(function_log_level):
-            log_line = "{} || {} || {} || {} || {}".format(datetime.now().isoformat(sep=' ', timespec='milliseconds'),
-                                                           function_log_level, self._name, function,
-                                                           msg.format(*args) if len(args) > 0 else msg)
-            try:
-                print(log_line)
-                f = open(self.log_path, 'a')
-                f.write(log_line + "\n")
-                f.close()
-            except Exception:
-                pass
+        if callable(msg):
+            msg = msg()
+        if self._suppressor is not None:
+            key = (function_log_level, function, msg if isinstance(msg, str) else repr(msg))
+            log, summaries = self._suppressor.check(key)
+            for key, count in summaries:
+                self._write_summary(key, count)
+            if not log:
+                self._schedule_summaries(self._suppressor.window)
+                return
+        self._write(function_log_level, function, msg, args)
+
+    def _schedule_summaries(self, delay):
+        """
+        starts the timer logging "suppressed" summaries, unless it is already running
+        :param delay: seconds until the timer fires
+        """
+        with self._summary_lock:
+            if self._summary_timer is not None:
+                return
+            self._summary_timer = threading.Timer(delay, self._write_expired_summaries)
+            self._summary_timer.daemon = True
+            self._summary_timer.start()
+
+    def _write_expired_summaries(self):
+        """
+        timer callback, logs summaries of ended windows and waits for the next one, if any
+        """
+        with self._summary_lock:
+            self._summary_timer = None
+        summaries, next_expiry = self._suppressor.expire()
+        for key, count in summaries:
+            self._write_summary(key, count)
+        if next_expiry is not None:
+            self._schedule_summaries(next_expiry)
+
+    def _drain_summaries(self):
+        """
+        logs pending "suppressed" summaries, on close and at exit
+        """
+        if self._suppressor is None:
+            return
+        with self._summary_lock:
+            if self._summary_timer is not None:
+                self._summary_timer.cancel()
+                self._summary_timer = None
+        for key, count in self._suppressor.drain():
+            self._write_summary(key, count)
+
+    def _write_summary(self, key, count):
+        """
+        logs how many repeats of a message were suppressed
+        :param key: (level, function, template) of the suppressed message
+        :param count: number of suppressed repeats
+        """
+        function_log_level, function, msg = key
+        self._write(function_log_level, function, "suppressed {} repeats of: {}", (count, msg))
+
+    def _write(self, function_log_level, function, msg, args):
+        """
+        formats a log line and writes it to console and log_path
+        :param function_log_level: log level
+        :param function: name of the function that logs
+        :param msg: msg to log
+        :param args: params from msg
+        """
+        now = datetime.now()
+        formatted_msg = msg.format(*args) if len(args) > 0 else msg
+        log_line = "{} || {} || {} || {} || {}".format(now.isoformat(sep=' ', timespec='milliseconds'),
+                                                       function_log_level, self._name, function, formatted_msg)
+        try:
+            print(log_line)
+            if self._sink is None:
+                self._open_sink()
+            if self.log_format == "json":
+                record = {
+                    "ts": now.astimezone().isoformat(timespec='milliseconds'),
+                    "level": function_log_level,
+                    "logger": self._name,
+                    "function": function,
+                    "msg": formatted_msg
+                }
+                if len(args) > 0:
+                    record["template"] = msg
+                    record["args"] = args
+                log_line = self._json_line(record, self._sink.max_line_bytes)
+            else:
+                log_line += "\n"
+            if self._writer is not None:
+                self._writer.write(log_line)
+            else:
+                self._sink.write([log_line])
+        except Exception:
+            pass
+
+    def _json_line(self, record, max_bytes):
+        """
+        serializes a JSON record, shortening its args and msg when the line would be longer than max_bytes,
+        so the sink never has to cut it into invalid JSON
+        :param record: dict with ts, level, logger, function, msg and optionally template and args
+        :param max_bytes: max encoded size of the line
+        :return: JSON line ending with a line break, records shortened here have "truncated": true
+        """
+        line = json.dumps(record, default=str) + "\n"
+        if len(line) <= max_bytes:
+            return line
+        record["truncated"] = True
+        if "args" in record:
+            record["args"] = [_shorten(str(arg), 256) for arg in record["args"]]
+        line = json.dumps(record, default=str) + "\n"
+        if len(line) > max_bytes:
+            record["msg"] = _shorten(record["msg"], len(record["msg"]) - (len(line) - max_bytes))
+            line = json.dumps(record, default=str) + "\n"
+        if len(line) > max_bytes:
+            record.pop("template", None)
+            record.pop("args", None)
+            line = json.dumps(record, default=str) + "\n"
+        return line
+
+    def _open_sink(self):
+        """
+        resolves log_path against the current working directory and gets its shared LogSink, and AsyncLogWriter
+        in async mode
+        """
+        with self._sink_lock:
+            if self._sink is not None:
+                return
+            sink = LogSink.get(self.log_path, *self._sink_options)
+            if self._writer_options is not None:
+                self._writer = sink.get_async_writer(*self._writer_options)
+            self._sink = sink
 
     def _log_level(self, argument):
         """
         Validates if current level is available to log
         :return: Integer for comparison
         """
-        switcher = {
-            "ERROR": 1,
-            "WARN": 2,
-            "INFO": 3,
-            "DEBUG": 4,
-            "TRACE": 5
+        return LOG_LEVELS.get(argument, "Invalid level")
+
+
+class TemplateReplacer(object):
+    """
+    TemplateReplacer replaces every prefix + key + suffix placeholder of a text in a single regex pass
+    Attributes:
+        pattern: compiled regex matching placeholders, group 1 is the key
+        values: dict of key -> replacement value
+    """
+
+    max_pending_chars = 65536
+    _key_chars = re.compile("[\\w.]*")
+
+    def __init__(self, param_prefix, param_suffix, values):
+        self.param_prefix = param_prefix
+        self.param_suffix = param_suffix
+        self.pattern = self.compile_pattern(param_prefix, param_suffix)
+        self.values = {k: str(v) for k, v in values.items()}
+
+    @staticmethod
+    def compile_pattern(param_prefix, param_suffix):
+        """
+        :return: compiled regex matching prefix + key + suffix placeholders, group 1 is the key
+        """
+        return re.compile(re.escape(param_prefix) + "([\\w.]+)" + re.escape(param_suffix))
+
+    def render(self, data):
+        """
+        replaces every placeholder in data
+        :param data: text with placeholders
+        :return: (rendered text, set of replaced keys). raises KeyError with the set of missing keys, if any
+        """
+        substitute, used_keys, missing_keys = self._substitution()
+        output = self.pattern.sub(substitute, data)
+        if missing_keys:
+            raise KeyError(missing_keys)
+        return output, used_keys
+
+    def render_stream(self, file_in, file_out, chunk_size=1024 * 1024):
+        """
+        replaces every placeholder reading file_in in chunks and writing to file_out, so memory usage is bounded
+        by chunk_size. Placeholders split between two chunks are held back until the next chunk is read.
+        When param_suffix starts with a key char, a placeholder can not be told complete before the whole text is
+        read, so file_in is rendered at once.
+        :param file_in: text file object to read from
+        :param file_out: text file object to write to
+        :param chunk_size: number of chars read at once
+        :return: set of replaced keys. raises KeyError with the set of missing keys, if any
+        """
+        if not self.param_prefix or self._key_chars.match(self.param_suffix).end() > 0:
+            output, used_keys = self.render(file_in.read())
+            file_out.write(output)
+            return used_keys
+        substitute, used_keys, missing_keys = self._substitution()
+        pending = ""
+        while True:
+            chunk = file_in.read(chunk_size)
+            data = pending + chunk
+            if not chunk:
+                file_out.write(self.pattern.sub(substitute, data))
+                break
+            pending = self._render_chunk(data, substitute, file_out)
+        if missing_keys:
+            raise KeyError(missing_keys)
+        return used_keys
+
+    def _substitution(self):
+        """
+        :return: (re.sub callback, set the callback fills with replaced keys, set it fills with missing keys)
+        """
+        used_keys = set()
+        missing_keys = set()
+        values = self.values
+
+        def substitute(match):
+            key = match.group(1)
+            value = values.get(key)
+            if value is None:
+                missing_keys.add(key)
+                return match.group(0)
+            used_keys.add(key)
+            return value
+
+        return substitute, used_keys, missing_keys
+
+    def _render_chunk(self, data, substitute, file_out):
+        """
+        writes data rendered up to the first position where a placeholder may start and be completed by text not
+        read yet, scanning placeholders as a single pass over the whole text would
+        :param data: text read and not rendered yet
+        :return: text held back, to be rendered with the next chunk
+        """
+        last_end = [0]
+
+        def substitute_and_track(match):
+            last_end[0] = match.end()
+            return substitute(match)
+
+        output = self.pattern.sub(substitute_and_track, data)
+        cut = self._incomplete_start(data, last_end[0])
+        file_out.write(output[:len(output) - (len(data) - cut)])
+        return data[cut:]
+
+    def _incomplete_start(self, data, position):
+        """
+        :param data: text read so far
+        :param position: end of the last placeholder found in data
+        :return: first position, at or after position, of a placeholder that text not read yet may complete,
+        len(data) if there is none. Placeholders longer than max_pending_chars are not waited for
+        """
+        prefix = self.param_prefix
+        start = max(position, len(data) - self.max_pending_chars)
+        while True:
+            start = data.find(prefix[0], start)
+            if start == -1:
+                return len(data)
+            rest = data[start:start + len(prefix)]
+            if len(rest) < len(prefix):
+                if prefix.startswith(rest):
+                    return start
+            elif rest == prefix:
+                key_end = self._key_chars.match(data, start + len(prefix)).end()
+                if key_end == len(data) or (key_end > start + len(prefix) and len(data) - key_end < len(self.param_suffix)
+                                            and self.param_suffix.startswith(data[key_end:])):
+                    return start
+            start += 1
+
+
+class RenderManifest(object):
+    """
+    RenderManifest records, for every file rendered by Properties.replace, the hash of the template it was rendered
+    from, the keys it references with the values used, and the size, mtime and hash of the output.
+    Templates are kept in a store folder (manifest_path + ".d") named by hash, so rendered files can be rendered
+    again when a referenced value changes.
+    Attributes:
+        manifest_path: JSON file where entries are saved
+        store_path: folder with the template copies
+        files: dict of absolute file path -> entry
+    """
+
+    version = 1
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.store_path = manifest_path + ".d"
+        self.files = {}
+        self._lock = threading.Lock()
+        try:
+            with open(manifest_path, "rt") as f:
+                manifest = json.load(f)
+            if manifest.get("version") == self.version:
+                self.files = manifest["files"]
+        except (OSError, ValueError):
+            pass
+
+    def get(self, file_path):
+        with self._lock:
+            return self.files.get(os.path.abspath(file_path))
+
+    def update(self, file_path, input_hash, keys):
+        """
+        records a rendered file
+        :param file_path: rendered file
+        :param input_hash: hash of the template it was rendered from
+        :param keys: dict of referenced key -> value used
+        """
+        stat = os.stat(file_path)
+        entry = {
+            "input_hash": input_hash,
+            "output_hash": _file_hash(file_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "keys": keys
         }
-        return switcher.get(argument, "Invalid level")
+        with self._lock:
+            self.files[os.path.abspath(file_path)] = entry
+
+    def is_output(self, file_path, entry):
+        """
+        :return: True if file_path still holds the output recorded in entry
+        """
+        stat = os.stat(file_path)
+        if stat.st_size != entry["size"]:
+            return False
+        return stat.st_mtime_ns == entry["mtime_ns"] or _file_hash(file_path) == entry["output_hash"]
+
+    def template_path(self, input_hash):
+        return join(self.store_path, input_hash)
+
+    def store_template(self, file_path):
+        """
+        copies a template into the store
+        :param file_path: template file
+        :return: (hash of the template, path of its copy)
+        """
+        os.makedirs(self.store_path, exist_ok=True)
+        tmp_fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.store_path)
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as file_in, open(tmp_fd, "wb") as file_out:
+            for chunk in iter(lambda: file_in.read(1024 * 1024), b""):
+                digest.update(chunk)
+                file_out.write(chunk)
+        input_hash = digest.hexdigest()
+        os.replace(tmp_path, self.template_path(input_hash))
+        return input_hash, self.template_path(input_hash)
+
+    def save(self):
+        """
+        writes the manifest and removes templates no longer referenced by any entry
+        """
+        with self._lock:
+            manifest = {"version": self.version, "files": dict(self.files)}
+        tmp_path = "{}.{}.tmp".format(self.manifest_path, os.getpid())
+        with open(tmp_path, "wt") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+        if isdir(self.store_path):
+            referenced = {entry["input_hash"] for entry in manifest["files"].values()}
+            for file_name in listdir(self.store_path):
+                if file_name not in referenced and not file_name.endswith(".tmp"):
+                    os.remove(join(self.store_path, file_name))
+
+
+def _shorten(text, max_chars):
+    """
+    :return: text, cut to max_chars characters ending with '...' if it is longer
+    """
+    if len(text) <= max_chars:
+        return text
+    return text[:max(0, max_chars - 3)] + "..."
+
+
+def _file_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _copy_file_attributes(source_path, tmp_path):
+    """
+    gives tmp_path the owner and group, when permitted, and the mode of source_path, before it replaces source_path
+    """
+    stat = os.stat(source_path)
+    try:
+        os.chown(tmp_path, stat.st_uid, stat.st_gid)
+    except PermissionError:
+        pass
+    shutil.copymode(source_path, tmp_path)
+
+
+def _open_temp_file(path, mode=0o666):
+    """
+    creates a new temp file next to path, with mode masked by the process umask as open does
+    :return: (file descriptor, temp file path)
+    """
+    directory, file_name = os.path.split(path)
+    while True:
+        tmp_path = join(directory, ".{}.{}.tmp".format(file_name, os.urandom(6).hex()))
+        try:
+            return os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode), tmp_path
+        except FileExistsError:
+            continue
+
+
+_PROPERTY_LINE = re.compile(r"([^=:\s]*)[ \t\f]*(?:[=:][ \t\f]*)?(.*)", re.S)
+_PROPERTY_ESCAPES = {"t": "\t", "n": "\n", "r": "\r", "f": "\f"}
+
+
+def parse_properties(lines):
+    """
+    Parses Java .properties content: '=', ':' or whitespace separators, '#' and '!' comments,
+    backslash escapes (including \\uXXXX) and backslash continuation lines.
+    For backwards compatibility, values are also stripped of surrounding whitespace and double quotes, unless
+    they are escaped ('\\ ', '\\t', '\\"').
+    :param lines: iterable of text lines
+    :return: dict of key -> value
+    """
+    props = {}
+    logical_line = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if logical_line is None:
+            line = line.lstrip(" \t\f")
+            if not line or line[0] in "#!":
+                continue
+        else:
+            line = logical_line + line.lstrip(" \t\f")
+            logical_line = None
+        if line.endswith("\\") and (len(line) - len(line.rstrip("\\"))) % 2 == 1:
+            logical_line = line[:-1]
+            continue
+        if "\\" in line:
+            key, value = _parse_escaped_property(line)
+        else:
+            key, value = _PROPERTY_LINE.match(line).groups()
+            value = value.strip().strip('"')
+        props[key] = value
+    if logical_line is not None:
+        key, value = _parse_escaped_property(logical_line)
+        props[key] = value
+    return props
+
+
+def _parse_escaped_property(line):
+    """
+    splits a logical line containing backslash escapes into an unescaped key and value
+    """
+    key = []
+    position = 0
+    length = len(line)
+    while position < length and line[position] not in "=: \t\f":
+        if line[position] == "\\" and position + 1 < length:
+            position = _unescape(line, position, key)
+        else:
+            key.append(line[position])
+            position += 1
+    while position < length and line[position] in " \t\f":
+        position += 1
+    if position < length and line[position] in "=:":
+        position += 1
+        while position < length and line[position] in " \t\f":
+            position += 1
+    position, length = _strip_raw_value(line, position, length)
+    value = []
+    while position < length:
+        if line[position] == "\\" and position + 1 < length:
+            position = _unescape(line, position, value)
+        else:
+            value.append(line[position])
+            position += 1
+    return "".join(key), "".join(value)
+
+
+def _strip_raw_value(line, start, end):
+    """
+    strips surrounding whitespace and double quotes of the escaped value line[start:end], as parse_properties does
+    with values, keeping escaped ones
+    :return: (start, end) of the stripped value
+    """
+    while end > start and line[end - 1] in " \t\f" and not _is_escaped(line, start, end - 1):
+        end -= 1
+    while start < end and line[start] == '"':
+        start += 1
+    while end > start and line[end - 1] == '"' and not _is_escaped(line, start, end - 1):
+        end -= 1
+    return start, end
+
+
+def _is_escaped(line, start, position):
+    """
+    :return: True if line[position] is preceded by an odd number of backslashes, not looking before start
+    """
+    backslashes = 0
+    while position - backslashes - 1 >= start and line[position - backslashes - 1] == "\\":
+        backslashes += 1
+    return backslashes % 2 == 1
+
+
+def _unescape(line, position, output):
+    """
+    appends the char escaped at line[position] (a backslash) to output
+    :return: position after the escape sequence
+    """
+    char = line[position + 1]
+    if char == "u" and position + 6 <= len(line):
+        try:
+            output.append(chr(int(line[position + 2:position + 6], 16)))
+            return position + 6
+        except ValueError:
+            pass
+    output.append(_PROPERTY_ESCAPES.get(char, char))
+    return position + 2
+
+
+_KEY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "\f": "\\f", "=": "\\=",
+                              ":": "\\:", "#": "\\#", "!": "\\!", " ": "\\ "})
+_VALUE_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "\f": "\\f"})
+
+
+def _escape_property(text, is_key):
+    """
+    escapes a key or a value so parse_properties (or Java) reads it back unchanged, including leading and trailing
+    spaces and double quotes of values
+    :param text: key or value
+    :param is_key: keys also escape separators, comment chars and spaces
+    """
+    if is_key:
+        return text.translate(_KEY_ESCAPES)
+    escaped = text.translate(_VALUE_ESCAPES)
+    # parse_properties strips unescaped whitespace and double quotes around values
+    if len(escaped) > 1 and escaped[-1] in ' "':
+        escaped = escaped[:-1] + "\\" + escaped[-1]
+    return "\\" + escaped if escaped.startswith((" ", '"')) else escaped
 
 
 class Properties:
     """ Properties is an auxiliary class to handle Java-properties-like files
+        Sources are layered in a ChainMap, from highest to lowest priority: values set with put(),
+        environment variables starting with env_prefix, extra layers (last one first), props_file_path
+        and default_props_file_path.
+        Values can reference other properties with the placeholder syntax, for instance db.url={{db.host}}:{{db.port}}.
+        get() resolves each key once and memoizes it, put() only invalidates the keys depending on the changed one.
         """
 
+    _parse_cache = {}
+    _parse_cache_lock = threading.Lock()
+
+    stream_threshold = 16 * 1024 * 1024
+    stream_chunk_size = 1024 * 1024
+
     def __init__(self, props_file_path="./local.properties", default_props_file_path="./sample.properties",
-                 param_prefix="{{", param_suffix="}}"):
+                 param_prefix="{{", param_suffix="}}", manifest_path=None, layers=None, env_prefix=None,
+                 parse_cache_dir=None):
+        """
+        :param props_file_path: local properties file
+        :param default_props_file_path: default properties file, overridden by local properties
+        :param param_prefix: placeholder prefix used by replace
+        :param param_suffix: placeholder suffix used by replace
+        :param manifest_path: enables incremental replace, see RenderManifest
+        :param layers: list of extra properties file paths or dicts, each one overriding the previous ones and local properties
+        :param env_prefix: if set, environment variables starting with it override every file. The key is the variable
+        name without the prefix, lowercased, with '__' replaced by '.'. For instance RS_DB__HOST -> db.host
+        :param parse_cache_dir: folder to cache parsed files in, keyed by path, mtime and size
+        """
         self.logger = Logger("Properties")
         self.param_prefix = param_prefix
         self.logger.trace("param prefix: {}", param_prefix)
         self.param_suffix = param_suffix
         self.logger.trace("param suffix: {}", param_suffix)
-        self.logger.trace("Loading default properties...")
-        self.properties = self._load(default_props_file_path).copy()
-        self.logger.trace("Default properties: {}", self.properties)
-        self.logger.trace("Loading local properties...")
-        local_properties = self._load(props_file_path)
-        self.logger.trace("Local properties: {}", self.properties)
-        self.logger.trace("Merging Local properties into Default properties...")
-        self.properties.update(local_properties)
-        self.logger.trace("Properties: {}", self.properties)
+        self.parse_cache_dir = parse_cache_dir
+        self.sources = [default_props_file_path, props_file_path] + list(layers or [])
+        self.env_prefix = env_prefix
+        self.properties = ChainMap({}, *self._load_layers())
+        self.logger.trace(lambda: "Properties: {}".format(dict(self.properties)))
+        self._replacer = None
+        self._reference_pattern = TemplateReplacer.compile_pattern(param_prefix, param_suffix)
+        self._resolved = {}
+        self._dependents = {}
+        self.manifest = RenderManifest(manifest_path) if manifest_path is not None else None
+
+    def _load_layers(self):
+        """
+        :return: list of source dicts, from highest to lowest priority, without put() values
+        """
+        maps = [self._load(source) if isinstance(source, str) else dict(source) for source in self.sources]
+        if self.env_prefix is not None:
+            maps.append({k[len(self.env_prefix):].lower().replace("__", "."): v for k, v in os.environ.items()
+                         if k.startswith(self.env_prefix)})
+        return list(reversed(maps))
+
+    def reload(self):
+        """
+        loads file sources again, keeping values set with put(). New values are resolved before replacing the
+        current ones, so on error (e.g. a circular reference) properties are left unchanged
+        :return: set of keys whose resolved value changed, was added or was removed
+        """
+        old_values = {k: self.get(k) for k in self.properties}
+        properties = ChainMap(self.properties.maps[0], *self._load_layers())
+        resolved = {}
+        dependents = {}
+        new_values = {k: resolved[k] if k in resolved else self._resolve(k, properties, resolved, dependents)
+                      for k in properties}
+        self.properties = properties
+        self._resolved = resolved
+        self._dependents = dependents
+        self._replacer = None
+        changed_keys = {k for k in old_values.keys() | new_values.keys() if old_values.get(k) != new_values.get(k)}
+        self.logger.debug("Properties reloaded, changed keys: {}", changed_keys)
+        return changed_keys
+
+    def replace_changed(self, changed_keys, workers=1):
+        """
+        renders again the files recorded in the manifest that reference any of changed_keys, or a key whose value
+        changed since they were rendered, for instance because it references one of changed_keys
+        :param changed_keys: iterable of property keys
+        :param workers: number of threads replacing files in parallel
+        :return: list of reports, see replace
+        """
+        if self.manifest is None:
+            return []
+        changed_keys = set(changed_keys)
+        values = self._get_replacer().values
+        with self.manifest._lock:
+            files_path = sorted(path for path, entry in self.manifest.files.items()
+                                if (not changed_keys.isdisjoint(entry["keys"])
+                                    or any(values.get(k) != v for k, v in entry["keys"].items())) and isfile(path))
+        reports = []
+        for file_path in files_path:
+            reports.extend(self.replace(file_path, workers=workers))
+        return reports
+
+    def watch(self, callback=None, interval=1.0, debounce=0.5):
+        """
+        starts a PropertiesWatcher that reloads properties when source files change
+        :param callback: optional subscriber, see PropertiesWatcher.subscribe
+        :return: the started PropertiesWatcher
+        """
+        watcher = PropertiesWatcher(self, interval, debounce)
+        if callback is not None:
+            watcher.subscribe(callback)
+        watcher.start()
+        return watcher
 
     def get(self, key):
-        return self.properties.get(key, None)
+        """
+        :param key: property key
+        :return: property value with references to other properties resolved, None if key is not present
+        """
+        if key in self._resolved:
+            return self._resolved[key]
+        if key not in self.properties:
+            return None
+        return self._resolve(key, self.properties, self._resolved, self._dependents)
 
     def put(self, key, value):
         self.properties[key] = value
+        self._replacer = None
+        invalidated = [key]
+        while invalidated:
+            invalid_key = invalidated.pop()
+            self._resolved.pop(invalid_key, None)
+            invalidated.extend(self._dependents.pop(invalid_key, ()))
 
-    def replace(self, path, extension=None):
+    def _resolve(self, key, properties, resolved, dependents):
+        """
+        resolves a key and every property it references, depth first without recursion.
+        Each key is resolved once, so a whole property set resolves in linear time.
+        :param key: property key, present in properties
+        :param properties: raw values
+        :param resolved: dict of resolved values, updated in place
+        :param dependents: dict of key -> keys referencing it, updated in place
+        :return: resolved value. raises ValueError on circular references
+        """
+
+        def resolved_reference(match):
+            # references to missing keys are kept as they are
+            value = resolved.get(match.group(1))
+            return match.group(0) if value is None else str(value)
+
+        stack = [key]
+        on_stack = {key}
+        while stack:
+            current = stack[-1]
+            raw_value = properties[current]
+            references = self._reference_pattern.findall(raw_value) if isinstance(raw_value, str) else []
+            pending = None
+            for reference in references:
+                if reference in resolved or reference not in properties:
+                    continue
+                if reference in on_stack:
+                    cycle = stack[stack.index(reference):] + [reference]
+                    validators.raise_and_log(self.logger, ValueError, "Circular reference between properties: {}",
+                                             " -> ".join(cycle))
+                pending = reference
+                break
+            if pending is not None:
+                stack.append(pending)
+                on_stack.add(pending)
+                continue
+            if references:
+                resolved[current] = self._reference_pattern.sub(resolved_reference, raw_value)
+                for reference in references:
+                    dependents.setdefault(reference, set()).add(current)
+            else:
+                resolved[current] = raw_value
+            on_stack.discard(stack.pop())
+        return resolved[key]
+
+    def _get_replacer(self):
+        """
+        returns the TemplateReplacer for current resolved properties, built once and discarded by put()
+        """
+        replacer = self._replacer
+        if replacer is None:
+            replacer = TemplateReplacer(self.param_prefix, self.param_suffix, {k: self.get(k) for k in self.properties})
+            self._replacer = replacer
+        return replacer
+
+    def replace(self, path, extension=None, recursive=False, include=None, exclude=None, workers=1):
         """
         replace keys inside a file or a folder with files with a related Property value
         :param path: path to file or folder
-        :param extension: file extension
-        :return:
+        :param extension: file extension, None matches every file
+        :param recursive: if True, also replaces files in subfolders
+        :param include: list of glob patterns, matched against paths relative to folder. If set, only matching files are replaced
+        :param exclude: list of glob patterns, matched against paths relative to folder. Matching files are skipped
+        :param workers: number of threads replacing files in parallel
+        :return: list of dicts, one per file, with 'path', 'keys' (replaced keys), 'bytes' (size read),
+        'elapsed' (seconds) and 'skipped' (True if the file was already rendered with current values)
         """
-        files_path = [path] if not isdir(path) else [join(path, f) for f in listdir(path) if
-                                                     isfile(join(path, f)) and f.endswith(extension)]
-        for file_path in files_path:
-            self._replace_file(file_path)
+        files_path = [path] if not isdir(path) else self._list_files(path, extension, recursive, include, exclude)
+        self.logger.debug("Replacing properties in {} files with {} workers", len(files_path), workers)
+        replacer = self._get_replacer()
+        try:
+            if workers > 1 and len(files_path) > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    return list(executor.map(lambda file_path: self._replace_file(file_path, replacer), files_path))
+            return [self._replace_file(file_path, replacer) for file_path in files_path]
+        finally:
+            if self.manifest is not None:
+                self.manifest.save()
+
+    def _list_files(self, path, extension=None, recursive=False, include=None, exclude=None):
+        """
+        lists files inside a folder using os.scandir
+        :param path: folder path
+        :return: list of file paths, sorted
+        """
+        files_path = []
+        pending_dirs = [path]
+        while pending_dirs:
+            with os.scandir(pending_dirs.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if recursive:
+                            pending_dirs.append(entry.path)
+                        continue
+                    if not entry.is_file() or (extension is not None and not entry.name.endswith(extension)):
+                        continue
+                    relative_path = os.path.relpath(entry.path, path).replace(os.sep, "/")
+                    if include and not any(fnmatch(relative_path, pattern) for pattern in include):
+                        continue
+                    if exclude and any(fnmatch(relative_path, pattern) for pattern in exclude):
+                        continue
+                    files_path.append(entry.path)
+        return sorted(files_path)
 
     def _load(self, file_path):
         """
-        Read a property file passed as parameter
-        """
-        separator = "="
-        comment_char = "#"
-        props = {}
-        self.logger.trace("Opening file from {}", file_path)
-        with open(file_path, "rt") as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith(comment_char):
-                    key_value = line.split(separator)
-                    key = key_value[0].strip()
-                    value = separator.join(key_value[1:]).strip().strip('"')
-                    props[key] = value
-                    self.logger.trace("Key: {} - Value: {} loaded", key, value)
+        Read a property file passed as parameter. Parsed files are cached in memory and, if parse_cache_dir is set,
+        on disk, keyed by path, mtime and size.
+        :return: dict of key -> value, shared with the cache so it must not be modified
+        """
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        cache_key = [stat.st_mtime_ns, stat.st_size]
+        with self._parse_cache_lock:
+            cached = self._parse_cache.get(file_path)
+        if cached is not None and cached[0] == cache_key:
+            self.logger.trace("{} loaded from memory cache", file_path)
+            return cached[1]
+        cache_file = None
+        props = None
+        if self.parse_cache_dir is not None:
+            cache_file = join(self.parse_cache_dir, hashlib.sha1(file_path.encode("utf-8")).hexdigest() + ".json")
+            try:
+                with open(cache_file, "rt") as f:
+                    cached = json.load(f)
+                if cached["key"] == cache_key:
+                    props = cached["props"]
+                    self.logger.trace("{} loaded from parse cache {}", file_path, cache_file)
+            except (OSError, ValueError, KeyError):
+                pass
+        if props is None:
+            self.logger.trace("Opening file from {}", file_path)
+            with open(file_path, "rt") as f:
+                props = parse_properties(f)
+            if cache_file is not None:
+                try:
+                    os.makedirs(self.parse_cache_dir, exist_ok=True)
+                    tmp_path = "{}.{}.tmp".format(cache_file, os.getpid())
+                    with open(tmp_path, "wt") as f:
+                        json.dump({"key": cache_key, "props": props}, f)
+                    os.replace(tmp_path, cache_file)
+                except OSError:
+                    pass
+        with self._parse_cache_lock:
+            self._parse_cache[file_path] = (cache_key, props)
+        self.logger.trace("{} keys loaded from {}", len(props), file_path)
         return props
 
-    def _replace_file(self, file_path):
+    def _replace_file(self, file_path, replacer=None):
         """
-        Replace key values from Properties with its related value on a single file
+        Replace key values from Properties with its related value on a single file.
+        Output goes to a temp file that is renamed over file_path, so file_path is never left half written.
+        A symlinked file_path keeps its link, its target is rendered, with the owner and mode it had.
+        Files bigger than stream_threshold bytes are processed in chunks, keeping memory usage constant.
+        With a manifest, files still holding their last output are skipped if no referenced value changed,
+        or rendered again from their stored template otherwise.
         :param file_path: path to a single file
-        :return:
+        :param replacer: TemplateReplacer to use, default is the one of current properties
+        :return: dict with 'path', 'keys', 'bytes', 'elapsed' and 'skipped'
         """
         self.logger.trace("Property replacement for {}", file_path)
-        props_key_separator = dict()
-        for k, v in self.properties.items():
-            new_key = self.param_prefix + k + self.param_suffix
-            props_key_separator[new_key] = v
-        file_in = open(file_path, "rt")
-        data = file_in.read()
-        self.logger.trace("{} successfully read", file_path)
-        regex_to_use = re.escape(self.param_prefix) + "[\\w.]+" + re.escape(self.param_suffix)
-        self.logger.trace(regex_to_use)
-        keys_to_replace_repeated = re.findall(re.compile(regex_to_use), data)
-        self.logger.trace(keys_to_replace_repeated)
-        keys_to_replace = set(keys_to_replace_repeated)
-        self.logger.trace(keys_to_replace)
-        pending_keys = keys_to_replace.difference(set(props_key_separator.keys()))
-        if len(pending_keys) > 0:
+        start_time = time.monotonic()
+        replacer = replacer or self._get_replacer()
+        source_path = file_path
+        input_hash = None
+        if self.manifest is not None:
+            entry = self.manifest.get(file_path)
+            if entry is not None and self.manifest.is_output(file_path, entry):
+                if all(replacer.values.get(k) == v for k, v in entry["keys"].items()):
+                    self.logger.trace("{} already rendered with current values, skipping", file_path)
+                    return {
+                        'path': file_path,
+                        'keys': sorted(entry["keys"]),
+                        'bytes': 0,
+                        'elapsed': time.monotonic() - start_time,
+                        'skipped': True
+                    }
+                if isfile(self.manifest.template_path(entry["input_hash"])):
+                    input_hash = entry["input_hash"]
+                    source_path = self.manifest.template_path(input_hash)
+                    self.logger.trace("{} referenced values changed, rendering again from {}", file_path, source_path)
+            if input_hash is None:
+                input_hash, source_path = self.manifest.store_template(file_path)
+        target_path = os.path.realpath(file_path)
+        directory, file_name = os.path.split(target_path)
+        tmp_fd, tmp_path = tempfile.mkstemp(prefix="." + file_name + ".", suffix=".tmp", dir=directory)
+        try:
+            with open(source_path, "rt") as file_in, open(tmp_fd, "wt") as file_out:
+                size = os.fstat(file_in.fileno()).st_size
+                if size > self.stream_threshold:
+                    self.logger.trace("{} has {} bytes, streaming replacement", file_path, size)
+                    used_keys = replacer.render_stream(file_in, file_out, self.stream_chunk_size)
+                else:
+                    data, used_keys = replacer.render(file_in.read())
+                    self.logger.trace("File read and replaced in memory, proceeding to dump in file")
+                    file_out.write(data)
+            _copy_file_attributes(target_path, tmp_path)
+            os.replace(tmp_path, target_path)
+        except KeyError as err:
+            os.remove(tmp_path)
+            pending_keys = {self.param_prefix + k + self.param_suffix for k in err.args[0]}
             validators.raise_and_log(self.logger, ValueError, """
             The following values are not present in local.properties nor sample.properties, but are required by running app:
 
             {}
             """.format(pending_keys))
-        for key in keys_to_replace:
-            data = data.replace(key, props_key_separator.get(key))
-        file_in.close()
-        self.logger.trace("File read and replaced in memory, proceeding to dump in file")
-        file_out = open(file_path, "wt")
-        file_out.write(data)
-        file_out.close()
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        if self.manifest is not None:
+            self.manifest.update(file_path, input_hash, {k: replacer.values[k] for k in used_keys})
+        self.logger.trace("Keys replaced: {}", used_keys)
         self.logger.trace("{} successfully replaced with Property values", file_path)
+        return {
+            'path': file_path,
+            'keys': sorted(used_keys),
+            'bytes': size,
+            'elapsed': time.monotonic() - start_time,
+            'skipped': False
+        }
 
-    def write(self, file_path):
+    def write(self, file_path, sort_keys=False, skip_unchanged=False):
         """
-        writes the properties obj on a file as regular properties file
+        writes the properties obj on a file as regular properties file, escaping keys and values as Java does.
+        Lines are streamed to a temp file that is renamed over file_path, so readers never see a partial file.
+        A symlinked file_path keeps its link and its target keeps its owner and mode, new files follow the umask.
         Args:
             file_path: path to file to be created with properties
+            sort_keys: if True, keys are written in sorted order
+            skip_unchanged: if True and file_path already has the same content, it is not rewritten, keeping its mtime
+        Returns:
+            False if the write was skipped because content was unchanged, otherwise True
         """
         self.logger.debug("writing properties on {}", file_path)
-        properties = ""
+        keys = sorted(self.properties) if sort_keys else list(self.properties)
+        target_path = os.path.realpath(file_path)
+        exists = isfile(target_path)
+        tmp_fd, tmp_path = _open_temp_file(target_path, 0o600 if exists else 0o666)
+        try:
+            with open(tmp_fd, "wt", buffering=1024 * 1024) as file_out:
+                for k in keys:
+                    file_out.write("{}={}\n".format(_escape_property(k, True),
+                                                    _escape_property(str(self.properties[k]), False)))
+            if skip_unchanged and exists and filecmp.cmp(tmp_path, target_path, shallow=False):
+                os.remove(tmp_path)
+                self.logger.debug("properties in {} are unchanged, write skipped", file_path)
+                return False
+            if exists:
+                _copy_file_attributes(target_path, tmp_path)
+            os.replace(tmp_path, target_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.logger.debug("properties successfully wrote in {}", file_path)
+        return True
 
-        for k, v in self.properties.items():
-            properties = "{}\n{}={}".format(properties, k, v)
 
-        file_out = open(file_path, "wt")
-        file_out.write(properties)
-        file_out.close()
-        self.logger.debug("properties successfully wrote in {}", file_path)
+class PropertiesWatcher(object):
+    """
+    PropertiesWatcher reloads a Properties instance when its source files change, and renders again only the
+    manifest files referencing changed keys. Sources are checked by mtime and size every interval seconds;
+    on Linux, inotify wakes the watcher as soon as a source file changes, ignoring other files of its folder.
+    A change triggers a reload once sources have been quiet for debounce seconds, so a burst of edits causes
+    a single reload. A failed reload is retried every interval until it succeeds or sources change again.
+    Attributes:
+        properties: Properties instance to reload
+        interval: seconds between checks
+        debounce: seconds sources must stay unchanged before reloading
+    """
+
+    _IN_EVENTS = 0x00000002 | 0x00000008 | 0x00000080 | 0x00000100 | 0x00000200
+    _IN_Q_OVERFLOW = 0x00004000
+    _EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, properties, interval=1.0, debounce=0.5):
+        self.properties = properties
+        self.interval = interval
+        self.debounce = debounce
+        self.logger = properties.logger
+        self._subscribers = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._inotify_fd = None
+        self._watches = {}
+        self._pending_keys = set()
+
+    def subscribe(self, callback):
+        """
+        registers a callback called after each reload with (changed_keys, reports), where reports are the
+        replace reports of the files rendered again
+        """
+        self._subscribers.append(callback)
+
+    def start(self):
+        self._open_inotify()
+        self._thread = threading.Thread(target=self._run, name="PropertiesWatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+    def check(self):
+        """
+        reloads properties, renders affected files and notifies subscribers. Keys changed by a reload whose
+        rendering failed are rendered again by the next check
+        :return: set of changed keys
+        """
+        self._pending_keys |= self.properties.reload()
+        changed_keys = self._pending_keys
+        reports = self.properties.replace_changed(changed_keys) if changed_keys else []
+        self._pending_keys = set()
+        for callback in self._subscribers:
+            try:
+                callback(changed_keys, reports)
+            except Exception as err:
+                self.logger.error("Properties watcher subscriber failed: {}", err)
+        return changed_keys
+
+    def _paths(self):
+        return [os.path.abspath(source) for source in self.properties.sources if isinstance(source, str)]
+
+    def _signature(self):
+        signature = []
+        for path in self._paths():
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append(None)
+        return signature
+
+    def _run(self):
+        signature = self._signature()
+        while not self._stop.is_set():
+            self._wait(self.interval, wake_on_event=True)
+            current = self._signature()
+            if current == signature:
+                continue
+            while not self._stop.is_set():
+                self._wait(self.debounce)
+                latest = self._signature()
+                if latest == current:
+                    break
+                current = latest
+            try:
+                self.check()
+            except Exception as err:
+                self.logger.error("Could not reload properties: {}", err)
+                continue
+            signature = current
+
+    def _wait(self, timeout, wake_on_event=False):
+        """
+        waits timeout seconds, or less if wake_on_event and inotify reports a change of a source file,
+        draining inotify events
+        """
+        if self._inotify_fd is None or not wake_on_event:
+            self._stop.wait(timeout)
+            self._read_events()
+            return
+        deadline = time.monotonic() + timeout
+        while not self._stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            select.select([self._inotify_fd], [], [], remaining)
+            if self._read_events():
+                return
+
+    def _read_events(self):
+        """
+        drains pending inotify events
+        :return: True if any of them is about a source file
+        """
+        if self._inotify_fd is None:
+            return False
+        relevant = False
+        while True:
+            try:
+                data = os.read(self._inotify_fd, 65536)
+            except OSError:
+                return relevant
+            if not data:
+                return relevant
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self._EVENT_HEADER.unpack_from(data, offset)
+                offset += self._EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+                offset += length
+                if mask & self._IN_Q_OVERFLOW or name in self._watches.get(wd, ()):
+                    relevant = True
+
+    def _open_inotify(self):
+        """
+        watches source folders with inotify through libc, when available. Otherwise polling is used
+        """
+        if not sys.platform.startswith("linux"):
+            return
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return
+            names = {}
+            for path in self._paths():
+                names.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+            for directory, directory_names in names.items():
+                wd = libc.inotify_add_watch(fd, directory.encode(), self._IN_EVENTS)
+                if wd >= 0:
+                    self._watches.setdefault(wd, set()).update(directory_names)
+            self._inotify_fd = fd
+        except (OSError, AttributeError):
+            self._inotify_fd = None
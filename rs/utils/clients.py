@@ -4,38 +4,535 @@
 # Author: Ezequiel O Sandoval - esandoval@roundservices.biz
 #
 
-import requests
+import hashlib
 import json
 import jwt
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from rs.utils import http, validators
 from rs.utils.basics import Logger
 
 
+class DiscoveryCache:
+    """
+    DiscoveryCache keeps OIDC discovery documents per issuer URL, shared by every OIDCClient of the process.
+    Documents are fresh for the Cache-Control max-age of the response, or ttl seconds without it, but never less
+    than min_ttl seconds. Once expired, a document is still served for up to stale_ttl seconds while a background
+    thread revalidates it with If-None-Match / If-Modified-Since. Older entries are fetched again synchronously.
+    """
+
+    def __init__(self, ttl=300, min_ttl=60, stale_ttl=3600):
+        """
+        :param ttl: seconds a document is fresh when the response has no max-age
+        :param min_ttl: min seconds a document is fresh, even with no-cache or a lower max-age
+        :param stale_ttl: seconds an expired document can be served while revalidating
+        """
+        self.ttl = ttl
+        self.min_ttl = min_ttl
+        self.stale_ttl = stale_ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+
+    def get(self, idp_url, transport, verify=True, logger=None):
+        """
+        :param idp_url: issuer URL, for instance 'https://myidp.myorg.com'
+        :param transport: http.HttpTransport used to fetch the document
+        :param verify: verify TLS certificates
+        :param logger: RoundServices log
+        :return: dict with the discovery document. Raises IOError if it can not be fetched
+        """
+        document, state = self.lookup(idp_url)
+        if state == "fresh":
+            return document
+        if state == "stale":
+            if self.start_revalidation(idp_url):
+                threading.Thread(target=self._revalidate, args=(idp_url, transport, verify, logger),
+                                 name="DiscoveryCache", daemon=True).start()
+            return document
+        with self._fetch_lock(idp_url):
+            document, state = self.lookup(idp_url)
+            if state == "fresh":
+                return document
+            return self.fetch(idp_url, transport, verify, logger)
+
+    def fetch(self, idp_url, transport, verify=True, logger=None):
+        """
+        fetches the document, conditionally if a previous copy is cached, and stores it
+        :return: dict with the discovery document. Raises IOError if it can not be fetched
+        """
+        url = idp_url + "/.well-known/openid-configuration"
+        if logger is not None:
+            logger.trace("GET request to {}", url)
+        response = transport.get(url, verify=verify, headers=self.conditional_headers(idp_url))
+        if response.status_code == 304:
+            return self.store(idp_url, response.headers, None)
+        http.validate_response(response, logger, "Can not reach Wellknown endpoint, with idp_url {} - DNS or host file?", idp_url)
+        return self.store(idp_url, response.headers, response.json())
+
+    def lookup(self, idp_url):
+        """
+        :return: (document, state) where state is 'fresh', 'stale' (servable while revalidating) or 'missing'
+        """
+        with self._lock:
+            entry = self._entries.get(idp_url)
+        if entry is None:
+            return None, "missing"
+        now = time.monotonic()
+        if now < entry["expires"]:
+            return entry["document"], "fresh"
+        if now < entry["expires"] + self.stale_ttl:
+            return entry["document"], "stale"
+        return None, "missing"
+
+    def conditional_headers(self, idp_url):
+        """
+        :return: If-None-Match / If-Modified-Since headers for the cached copy, if any
+        """
+        with self._lock:
+            entry = self._entries.get(idp_url)
+        headers = {}
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store(self, idp_url, headers, document):
+        """
+        stores a fetched document
+        :param headers: response headers
+        :param document: dict with the document, None on a 304 response to keep the cached one
+        :return: the stored document
+        """
+        with self._lock:
+            previous = self._entries.get(idp_url)
+            etag = headers.get("ETag")
+            last_modified = headers.get("Last-Modified")
+            if document is None:
+                if previous is None:
+                    raise IOError("Got 304 for {} without a cached discovery document".format(idp_url))
+                document = previous["document"]
+                etag = etag or previous["etag"]
+                last_modified = last_modified or previous["last_modified"]
+            self._entries[idp_url] = {
+                "document": document,
+                "etag": etag,
+                "last_modified": last_modified,
+                "expires": time.monotonic() + max(self.min_ttl, self._max_age(headers)),
+                "revalidating": False
+            }
+        return document
+
+    def invalidate(self, idp_url=None):
+        """
+        removes a cached document, or every one if idp_url is None
+        """
+        with self._lock:
+            if idp_url is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(idp_url, None)
+
+    def _max_age(self, headers):
+        cache_control = headers.get("Cache-Control", "").lower()
+        if "no-store" in cache_control or "no-cache" in cache_control:
+            return 0
+        match = re.search(r"max-age\s*=\s*(\d+)", cache_control)
+        return int(match.group(1)) if match else self.ttl
+
+    def start_revalidation(self, idp_url):
+        """
+        :return: True if the caller must revalidate idp_url, False if it is already being revalidated
+        """
+        with self._lock:
+            entry = self._entries.get(idp_url)
+            if entry is None or entry["revalidating"]:
+                return False
+            entry["revalidating"] = True
+            return True
+
+    def _revalidate(self, idp_url, transport, verify, logger):
+        try:
+            self.fetch(idp_url, transport, verify, logger)
+        except Exception as err:
+            self.end_revalidation(idp_url)
+            if logger is not None:
+                logger.warn("Could not revalidate discovery document of {}: {}", idp_url, err)
+
+    def end_revalidation(self, idp_url):
+        """
+        lets the next stale lookup of idp_url revalidate it again, after a failed revalidation
+        """
+        with self._lock:
+            entry = self._entries.get(idp_url)
+            if entry is not None:
+                entry["revalidating"] = False
+
+    def _fetch_lock(self, idp_url):
+        with self._lock:
+            return self._fetch_locks.setdefault(idp_url, threading.Lock())
+
+
+default_discovery_cache = DiscoveryCache()
+
+GLUU_45_SCOPE = '\
+                https://gluu.org/auth/oxtrust.attribute.read \
+                https://gluu.org/auth/oxtrust.attribute.write \
+                https://gluu.org/auth/oxtrust.authenticationmethod.read \
+                https://gluu.org/auth/oxtrust.authenticationmethod.write \
+                https://gluu.org/auth/oxtrust.client.read \
+                https://gluu.org/auth/oxtrust.client.write \
+                https://gluu.org/auth/oxtrust.customscript.read \
+                https://gluu.org/auth/oxtrust.customscript.write \
+                https://gluu.org/auth/oxtrust.ldapauthentication.read \
+                https://gluu.org/auth/oxtrust.ldapauthentication.write \
+                https://gluu.org/auth/oxtrust.OxauthjsonSetting.read \
+                https://gluu.org/auth/oxtrust.oxauthjsonSetting.write \
+                https://gluu.org/auth/oxtrust.oxtrustjsonSetting.write \
+                https://gluu.org/auth/oxtrust.oxtrustjsonSetting.read \
+                https://gluu.org/auth/oxtrust.oxtrustsetting.read \
+                https://gluu.org/auth/oxtrust.oxtrustsetting.write \
+                https://gluu.org/auth/oxtrust.saml.read \
+                https://gluu.org/auth/oxtrust.saml.write \
+                https://gluu.org/auth/oxtrust.scope.read \
+                https://gluu.org/auth/oxtrust.scope.write \
+                https://gluu.org/auth/oxtrust.smtpconfiguration.read \
+                https://gluu.org/auth/oxtrust.smtpconfiguration.write'
+
+
+class TokenCache:
+    """
+    TokenCache keeps access tokens until expires_in minus safety_margin seconds.
+    Concurrent callers asking for the same missing key are coalesced, only one of them fetches the token.
+    Expired tokens are dropped when read or when a token is added, and tokens are evicted in LRU order once
+    max_size is reached.
+    """
+
+    def __init__(self, safety_margin=30, default_ttl=60, max_size=1024):
+        """
+        :param safety_margin: seconds before expiration a token stops being served
+        :param default_ttl: seconds a token is kept when the token response has no expires_in
+        :param max_size: max number of tokens kept
+        """
+        self.safety_margin = safety_margin
+        self.default_ttl = default_ttl
+        self.max_size = max_size
+        self._tokens = OrderedDict()
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+
+    def get(self, key):
+        """
+        :return: cached token for key, None if missing or about to expire
+        """
+        with self._lock:
+            cached = self._tokens.get(key)
+            if cached is None:
+                return None
+            if time.monotonic() >= cached[1]:
+                del self._tokens[key]
+                return None
+            self._tokens.move_to_end(key)
+        return cached[0]
+
+    def put(self, key, token, expires_in=None):
+        """
+        :param key: hashable cache key
+        :param token: token to cache
+        :param expires_in: token lifetime in seconds, as returned by the token endpoint
+        """
+        ttl = self.default_ttl if expires_in is None else int(expires_in) - self.safety_margin
+        if ttl <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._tokens[key] = (token, now + ttl)
+            self._tokens.move_to_end(key)
+            if len(self._tokens) > self.max_size:
+                for expired_key in [k for k, cached in self._tokens.items() if now >= cached[1]]:
+                    del self._tokens[expired_key]
+            while len(self._tokens) > self.max_size:
+                self._tokens.popitem(last=False)
+
+    def invalidate(self, key, token=None):
+        """
+        :param key: cache key
+        :param token: if given, key is only removed while it still holds this token, so concurrent callers
+        rejecting the same token trigger a single refresh
+        """
+        with self._lock:
+            cached = self._tokens.get(key)
+            if cached is not None and (token is None or cached[0] == token):
+                del self._tokens[key]
+
+    def get_or_fetch(self, key, fetch):
+        """
+        returns the cached token for key, or calls fetch once for every concurrent caller.
+        The lock coalescing the callers is dropped once the fetch finishes
+        :param fetch: function with no params returning (token, expires_in)
+        :return: token
+        """
+        token = self.get(key)
+        if token is not None:
+            return token
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(key, threading.Lock())
+        try:
+            with fetch_lock:
+                token = self.get(key)
+                if token is not None:
+                    return token
+                token, expires_in = fetch()
+                self.put(key, token, expires_in)
+                return token
+        finally:
+            with self._lock:
+                if self._fetch_locks.get(key) is fetch_lock:
+                    del self._fetch_locks[key]
+
+
+class JwksCache:
+    """
+    JwksCache keeps the parsed public keys of JWKS documents by jwks_uri and kid, shared by every OIDCClient of the
+    process. Keys are kept for ttl seconds. A kid that is not cached triggers a refetch, but a jwks_uri is never
+    fetched more than once every min_refresh_interval seconds, so tokens with unknown kids can not flood the IDP.
+    """
+
+    def __init__(self, ttl=3600, min_refresh_interval=60):
+        """
+        :param ttl: seconds the keys of a JWKS document are used before fetching it again
+        :param min_refresh_interval: min seconds between two fetches of the same jwks_uri
+        """
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self._entries = {}
+        self._attempts = {}
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+
+    def get_key(self, jwks_uri, kid, transport, verify=True, logger=None):
+        """
+        :param jwks_uri: jwks_uri of the discovery document
+        :param kid: kid of the token header, None if it has none
+        :param transport: http.HttpTransport used to fetch the document
+        :return: jwt.PyJWK, None if there is no key for kid. Raises IOError if the document can not be fetched
+        """
+        key, state = self.lookup(jwks_uri, kid)
+        if state != "refresh":
+            return key
+        with self._fetch_lock(jwks_uri):
+            key, state = self.lookup(jwks_uri, kid)
+            if state != "refresh":
+                return key
+            self.fetch(jwks_uri, transport, verify, logger)
+        return self.lookup(jwks_uri, kid)[0]
+
+    def fetch(self, jwks_uri, transport, verify=True, logger=None):
+        """
+        fetches the JWKS document and stores its keys
+        """
+        self.start_fetch(jwks_uri)
+        if logger is not None:
+            logger.trace("GET request to {}", jwks_uri)
+        response = transport.get(jwks_uri, verify=verify)
+        http.validate_response(response, logger, "Can not get JWKS from {} - HTTP {}", jwks_uri, response.status_code)
+        self.store(jwks_uri, response.json())
+
+    def lookup(self, jwks_uri, kid):
+        """
+        :return: (key, state) where state is 'found', 'refresh' (the caller must fetch the document) or 'missing'
+        (unknown kid, but the document was fetched less than min_refresh_interval seconds ago)
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(jwks_uri)
+            last_attempt = self._attempts.get(jwks_uri)
+        key = None
+        if entry is not None:
+            keys = entry["keys"]
+            key = keys.get(kid) if kid is not None or len(keys) != 1 else next(iter(keys.values()))
+            if key is not None and now < entry["expires"]:
+                return key, "found"
+        if last_attempt is None or now - last_attempt >= self.min_refresh_interval:
+            return None, "refresh"
+        return key, "found" if key is not None else "missing"
+
+    def store(self, jwks_uri, jwks):
+        """
+        parses and stores the signing keys of a JWKS document, keys that can not be parsed are skipped
+        :param jwks: dict with the JWKS document
+        """
+        keys = {}
+        for jwk in jwks.get("keys", []):
+            if jwk.get("use", "sig") != "sig":
+                continue
+            try:
+                keys[jwk.get("kid")] = jwt.PyJWK(jwk)
+            except (jwt.PyJWTError, ValueError, TypeError):
+                continue
+        with self._lock:
+            self._entries[jwks_uri] = {"keys": keys, "expires": time.monotonic() + self.ttl}
+
+    def invalidate(self, jwks_uri=None):
+        """
+        removes the cached keys of jwks_uri, or every one if jwks_uri is None
+        """
+        with self._lock:
+            if jwks_uri is None:
+                self._entries.clear()
+                self._attempts.clear()
+            else:
+                self._entries.pop(jwks_uri, None)
+                self._attempts.pop(jwks_uri, None)
+
+    def start_fetch(self, jwks_uri):
+        """
+        records a fetch attempt of jwks_uri, successful or not, for min_refresh_interval
+        """
+        with self._lock:
+            self._attempts[jwks_uri] = time.monotonic()
+
+    def _fetch_lock(self, jwks_uri):
+        with self._lock:
+            return self._fetch_locks.setdefault(jwks_uri, threading.Lock())
+
+
+class ValidatedTokenCache:
+    """
+    ValidatedTokenCache remembers the claims of tokens whose signature was already verified, until their exp.
+    Tokens are identified by their sha256 hash, and evicted in LRU order once max_size is reached.
+    """
+
+    def __init__(self, max_size=4096):
+        """
+        :param max_size: max number of tokens remembered
+        """
+        self.max_size = max_size
+        self._tokens = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(jwks_uri, token, audience=None):
+        """
+        :return: cache key of a token verified with the keys of jwks_uri for audience
+        """
+        return jwks_uri, audience, hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, key):
+        """
+        :return: dict with the claims of the token, None if not cached or expired
+        """
+        with self._lock:
+            decoded_token = self._tokens.get(key)
+            if decoded_token is None:
+                return None
+            if time.time() >= decoded_token["exp"]:
+                del self._tokens[key]
+                return None
+            self._tokens.move_to_end(key)
+            return decoded_token
+
+    def put(self, key, decoded_token):
+        """
+        :param decoded_token: dict with the verified claims. Not cached if it has no exp claim
+        """
+        if not isinstance(decoded_token.get("exp"), (int, float)):
+            return
+        with self._lock:
+            self._tokens[key] = decoded_token
+            self._tokens.move_to_end(key)
+            while len(self._tokens) > self.max_size:
+                self._tokens.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+
+default_jwks_cache = JwksCache()
+default_validated_token_cache = ValidatedTokenCache()
+
+
+def validate_claims(logger, claims, token, error_claim=None):
+    """
+    Validates a jwt based on the presence of claims' list and the ausence of an error_claim inside the token,
+    without verifying its signature
+    :param logger: RoundServices log
+    :param claims: list of strings that represent claims inside the token
+    :param token: jwt to be decoded and validated
+    :param error_claim: default None, is an string that represents a claim that warns about an error inside the token
+    :return: Boolean
+    """
+    try:
+        decoded_token = jwt.decode(token, options={"verify_signature": False})
+    except Exception as err:
+        logger.error("Could not decode token err msg: {}", err)
+        return False
+    return check_claims(logger, decoded_token, claims, error_claim)
+
+
+def check_claims(logger, decoded_token, claims, error_claim=None):
+    """
+    :param decoded_token: dict with the claims of the token
+    :return: Boolean, True if every claim in claims and no error_claim are in decoded_token
+    """
+    logger.debug('Decoded token: {}', decoded_token)
+    for key in claims:
+        if key not in decoded_token:
+            logger.error("{} key is not included in json", key)
+            return False
+    return False if error_claim is not None and error_claim in decoded_token else True
+
+
+def decode_verified(token, key, audience=None):
+    """
+    decodes a token verifying its signature with key, its exp / nbf / iat claims and, if given, its audience
+    :param key: jwt.PyJWK
+    :return: dict with the claims of the token. Raises jwt.PyJWTError if it is not valid
+    """
+    return jwt.decode(token, key.key, algorithms=[key.algorithm_name], audience=audience,
+                      options={"verify_aud": audience is not None})
+
+
 class OIDCClient:
     """
     OIDCClient has multiple basic functionality that can be useful for OpenID python interactions
     """
-    def __init__(self, idp_url, logger=Logger("OIDCClient"), verify=True):
+    def __init__(self, idp_url, logger=Logger("OIDCClient"), verify=True, transport=None, discovery_cache=None,
+                 jwks_cache=None, validated_token_cache=None):
         """
         Params
         :param idp_url: for instance 'https://myidp.myorg.com'
         :param logger: RoundServices log. If None, default will be created
+        :param transport: http.HttpTransport used for every call. If None, the shared one is used
+        :param discovery_cache: DiscoveryCache for the .well-known document. If None, the shared one is used
+        :param jwks_cache: JwksCache for token signing keys. If None, the shared one is used
+        :param validated_token_cache: ValidatedTokenCache for verified tokens. If None, the shared one is used
         """
         self.idp_url = idp_url
         self.logger = logger
         self.verify = verify
+        self.transport = transport or http.get_default_transport()
+        self.discovery_cache = discovery_cache or default_discovery_cache
+        self.jwks_cache = jwks_cache or default_jwks_cache
+        self.validated_token_cache = validated_token_cache or default_validated_token_cache
         self.well_known = self.get_well_known()
 
-    def get_well_known(self):
+    def get_well_known(self, use_cache=True):
         """
         Executes a basic request to .well-known endpoint from a standard IDP
+        :param use_cache: if True, the document is served from the discovery cache when possible
         :return: a dict that represent the information from endpoint. otherwise it will raise an error
         """
-        url = self.idp_url + "/.well-known/openid-configuration"
-        self.logger.trace("GET request to {}", url)
-        response = requests.get(url, verify=self.verify)
-        http.validate_response(response, self.logger, "Can not reach Wellknown endpoint, with idp_url {} - DNS or host file?", self.idp_url)
-        well_known_json = response.json()
+        if use_cache:
+            well_known_json = self.discovery_cache.get(self.idp_url, self.transport, self.verify, self.logger)
+        else:
+            well_known_json = self.discovery_cache.fetch(self.idp_url, self.transport, self.verify, self.logger)
         self.logger.trace("obtained wellknown info: {}", well_known_json)
         return well_known_json
 
@@ -45,7 +542,7 @@ class OIDCClient:
         :return: Boolean if there is no connectivity issues. Otherwise raise an error
         """
         self.logger.trace("Validating IDP with idp_url {}", self.idp_url)
-        return self.get_well_known()['issuer'] == self.idp_url
+        return self.get_well_known(use_cache=False)['issuer'] == self.idp_url
 
     def request_to_token_endpoint(self, b64_client_credentials, params_in_dict):
         """
@@ -60,7 +557,7 @@ class OIDCClient:
         for k, v in params_in_dict.items():
             payload = "{}={}&{}".format(k, v, payload)
         self.logger.trace("about to request acc_token with this payload {}", payload)
-        response = requests.request("POST", self.well_known['token_endpoint'], data=payload, headers=self._get_basic_header(b64_client_credentials), verify=self.verify)
+        response = self.transport.request("POST", self.well_known['token_endpoint'], data=payload, headers=self._get_basic_header(b64_client_credentials), verify=self.verify)
         http.validate_response(response, self.logger, "Can not get access_token with these values {} - HTTP {}", payload, response.status_code)
         response_json = response.json()
         self.logger.debug("JSON Response obj is: {}", response_json)
@@ -80,26 +577,65 @@ class OIDCClient:
             'cache-control': "no-cache"
         }
 
-    def validate_jwt(self, claims, token, error_claim=None):
+    def validate_jwt(self, claims, token, error_claim=None, verify_signature=True, audience=None):
         """
-        Validates a jwt based on the presence of claims' list and the ausence of an error_claim inside the token
+        Validates a jwt based on the presence of claims' list and the ausence of an error_claim inside the token.
+        The signature is verified with the IDP keys from the jwks_uri of the discovery document, as well as exp,
+        nbf and iat claims. Verified tokens are remembered until they expire.
         :param claims: list of strings that represent claims inside the token
         :param token: jwt to be decoded and validated
         :param error_claim: default None, is an string that represents a claim that warns about an error inside the token
+        :param verify_signature: default True, if False the token is only decoded
+        :param audience: if given, the aud claim of the token must match it
         :return: Boolean
         """
         self.logger.debug('validate_jwt - token: {} - claims: {} - error_claim: {}', token, claims, error_claim)
+        if not verify_signature:
+            return validate_claims(self.logger, claims, token, error_claim)
+        decoded_token = self._decode_verified(token, audience)
+        return decoded_token is not None and check_claims(self.logger, decoded_token, claims, error_claim)
+
+    def validate_jwts(self, tokens, claims, error_claim=None, audience=None):
+        """
+        Validates several jwts as validate_jwt, verifying their signatures. The JWKS document is fetched at most once
+        for the whole batch.
+        :param tokens: iterable of jwts
+        :return: list of Booleans, one per token
+        """
+        tokens = list(tokens)
         try:
-            decoded_token = jwt.decode(token, options={"verify_signature": False})
+            jwks_uri = self.get_well_known()['jwks_uri']
         except Exception as err:
-            self.logger.error("Could not decode token err msg: {}", err)
-            return False
-        self.logger.debug('Decoded token: {}', decoded_token)
-        for key in claims:
-            if key not in decoded_token:
-                self.logger.error("{} key is not included in json", key)
-                return False
-        return False if error_claim is not None and error_claim in decoded_token else True
+            self.logger.error("Could not get jwks_uri err msg: {}", err)
+            return [False] * len(tokens)
+        results = []
+        for token in tokens:
+            decoded_token = self._decode_verified(token, audience, jwks_uri)
+            results.append(decoded_token is not None and check_claims(self.logger, decoded_token, claims, error_claim))
+        return results
+
+    def _decode_verified(self, token, audience, jwks_uri=None):
+        """
+        :param jwks_uri: default is the one of the discovery document
+        :return: dict with the verified claims of token, None if it is not valid
+        """
+        try:
+            jwks_uri = jwks_uri or self.get_well_known()['jwks_uri']
+            cache_key = self.validated_token_cache.key(jwks_uri, token, audience)
+            decoded_token = self.validated_token_cache.get(cache_key)
+            if decoded_token is not None:
+                return decoded_token
+            kid = jwt.get_unverified_header(token).get("kid")
+            key = self.jwks_cache.get_key(jwks_uri, kid, self.transport, self.verify, self.logger)
+            if key is None:
+                self.logger.error("No signing key with kid {} in {}", kid, jwks_uri)
+                return None
+            decoded_token = decode_verified(token, key, audience)
+        except Exception as err:
+            self.logger.error("Could not verify token err msg: {}", err)
+            return None
+        self.validated_token_cache.put(cache_key, decoded_token)
+        return decoded_token
 
 
 class UMAClient:
@@ -107,34 +643,56 @@ class UMAClient:
     Provides basic UMA interaction on a protected UMA API - clients authenticate with basic_credentials
     """
 
-    def __init__(self, api_base_endpoint, b64_client_credentials, logger=Logger("UMAClient"), verify=True, is_gluu_45=False):
+    def __init__(self, api_base_endpoint, b64_client_credentials, logger=Logger("UMAClient"), verify=True, is_gluu_45=False, transport=None, token_cache=None):
         """
         Constructor
         :param api_base_endpoint: for instance "https://myidp.org.com/identity/restv1/api/v1
         :param b64_client_credentials: 'client_id:client_secret' in base64 encoded format
         :param logger: RoundServices log. If it is None, default will be created.
+        :param transport: http.HttpTransport used for every call. If None, the shared one is used
+        :param token_cache: TokenCache for RPTs. If None, a new one is created for this client
         """
         self.api_base_endpoint = api_base_endpoint
         self.b64_client_credentials = b64_client_credentials
         self.logger = logger
         self.verify = verify
+        self.transport = transport or http.get_default_transport()
+        self._oidc_client = None
+        self.token_cache = token_cache or TokenCache()
         self.is_gluu_45 = is_gluu_45
         self.logger.debug("is_gluu_45 deployment: {}", is_gluu_45)
 
-    def get_rpt(self, path, operation="GET"):
+    def get_rpt(self, path, operation="GET", use_cache=True):
         """
         Gets an RPT from API endpoint.
         First gets a ticket (401 HTTP error with a header called ticket in response), then
-        uses that ticket to obtain RPT from IDP token endpoint
+        uses that ticket to obtain RPT from IDP token endpoint.
+        RPTs are cached per (path, operation), or once for every path on Gluu 4.5, until they expire.
         :param path: to the requested endpoint (it will be concatenated to api_base_endpoint)
         :param operation: Default GET, can be one of HTTP Methods
+        :param use_cache: if False, a new RPT is requested and cached
         :return: an String that represents a valid access_token for that resource. otherwise raise an error.
         """
+        key = self._token_cache_key(path, operation)
+        if not use_cache:
+            self.token_cache.invalidate(key)
+        return self.token_cache.get_or_fetch(key, lambda: self._request_rpt(path, operation))
+
+    def _token_cache_key(self, path, operation):
+        """
+        :return: TokenCache key of the RPT for path and operation
+        """
+        return ('client_credentials',) if self.is_gluu_45 else (path, operation)
 
+    def _request_rpt(self, path, operation):
+        """
+        requests a new RPT, see get_rpt
+        :return: (access_token, expires_in)
+        """
         if not self.is_gluu_45:
             url = self.api_base_endpoint + "/" + path
             self.logger.trace("Starting RPT with url {} with operation: {}", url, operation)
-            response = requests.request(operation, url, data="", headers=self._get_operation_headers(""), verify=self.verify)
+            response = self.transport.request(operation, url, data="", headers=self._get_operation_headers(""), verify=self.verify)
             if response.status_code != 401:
                 response.close()
                 validators.raise_and_log(self.logger, IOError, "Can not get ticket to be exchanged for RPT, maybe UMA not enabled? - HTTP {}", response.status_code)
@@ -152,31 +710,20 @@ class UMAClient:
             self.logger.trace("idp_url is {}", idp_url)
             payload = {
                 'grant_type': 'client_credentials',
-                'scope': '\
-                https://gluu.org/auth/oxtrust.attribute.read \
-                https://gluu.org/auth/oxtrust.attribute.write \
-                https://gluu.org/auth/oxtrust.authenticationmethod.read \
-                https://gluu.org/auth/oxtrust.authenticationmethod.write \
-                https://gluu.org/auth/oxtrust.client.read \
-                https://gluu.org/auth/oxtrust.client.write \
-                https://gluu.org/auth/oxtrust.customscript.read \
-                https://gluu.org/auth/oxtrust.customscript.write \
-                https://gluu.org/auth/oxtrust.ldapauthentication.read \
-                https://gluu.org/auth/oxtrust.ldapauthentication.write \
-                https://gluu.org/auth/oxtrust.OxauthjsonSetting.read \
-                https://gluu.org/auth/oxtrust.oxauthjsonSetting.write \
-                https://gluu.org/auth/oxtrust.oxtrustjsonSetting.write \
-                https://gluu.org/auth/oxtrust.oxtrustjsonSetting.read \
-                https://gluu.org/auth/oxtrust.oxtrustsetting.read \
-                https://gluu.org/auth/oxtrust.oxtrustsetting.write \
-                https://gluu.org/auth/oxtrust.saml.read \
-                https://gluu.org/auth/oxtrust.saml.write \
-                https://gluu.org/auth/oxtrust.scope.read \
-                https://gluu.org/auth/oxtrust.scope.write \
-                https://gluu.org/auth/oxtrust.smtpconfiguration.read \
-                https://gluu.org/auth/oxtrust.smtpconfiguration.write'
+                'scope': GLUU_45_SCOPE
             }
-        return OIDCClient(idp_url, self.logger, self.verify).request_to_token_endpoint(self.b64_client_credentials, payload)['access_token']
+        token_response = self._get_oidc_client(idp_url).request_to_token_endpoint(self.b64_client_credentials, payload)
+        return token_response['access_token'], token_response.get('expires_in')
+
+    def _get_oidc_client(self, idp_url):
+        """
+        returns the OIDCClient of the IDP protecting the API, created on first use
+        :param idp_url: IDP base url
+        :return: OIDCClient
+        """
+        if self._oidc_client is None or self._oidc_client.idp_url != idp_url:
+            self._oidc_client = OIDCClient(idp_url, self.logger, self.verify, self.transport)
+        return self._oidc_client
 
     def get(self, sub_path):
         """
@@ -218,7 +765,7 @@ class UMAClient:
         :param operation: GET/POST/PUT/DELETE string
         :param sub_path: string that will be concatenated with api_base_endpoint
         :param json_obj: Parameters on body message, used for POST/PUT operations, default None
-        :param rpt: Optional
+        :param rpt: Optional. If None, a cached RPT is used, requesting a new one and retrying once on HTTP 401
         :return: returns a dict based on the json returned by API
         """
         url = "{}/{}".format(self.api_base_endpoint, sub_path)
@@ -229,19 +776,83 @@ class UMAClient:
         url: {}
         json_obj: {}
         """, operation, url, json.dumps(json_obj))
-        response = requests.request(
+        token = self.get_rpt(sub_path, operation) if rpt is None else rpt
+        response = self.transport.request(
             operation,
             url,
             data=body,
-            headers=self._get_operation_headers(self.get_rpt(sub_path, operation) if rpt is None else rpt),
+            headers=self._get_operation_headers(token),
             verify=self.verify
         )
+        if response.status_code == 401 and rpt is None:
+            self.logger.debug("Cached RPT rejected for {} {}, requesting a new one", operation, url)
+            response.close()
+            self.token_cache.invalidate(self._token_cache_key(sub_path, operation), token)
+            response = self.transport.request(
+                operation,
+                url,
+                data=body,
+                headers=self._get_operation_headers(self.get_rpt(sub_path, operation)),
+                verify=self.verify
+            )
         http.validate_response(response, self.logger, "Execute Failed - HTTP Code: {}".format(response.status_code))
         try:
             return response.json()
         except:
             return {}
 
+    def execute_many(self, entries, max_workers=8, rate_limit=None, burst=1):
+        """
+        Executes several UMA requests concurrently, through the pooled transport and the cached RPTs.
+        Results are yielded as soon as each request completes, so they may come out of order. A failed request
+        does not stop the others, its exception is returned in 'error'.
+        Only up to 2 * max_workers entries are read ahead, so entries can be a generator of any size.
+        :param entries: iterable of (operation, sub_path) or (operation, sub_path, json_obj) tuples
+        :param max_workers: max requests in flight. Keep it below the transport pool_maxsize to reuse connections
+        :param rate_limit: max requests started per second, default is no limit
+        :param burst: max requests started at once when rate_limit is set
+        :return: generator of dicts with index (position in entries), operation, sub_path, result (dict returned by
+        execute, None on error), error (exception, None on success) and elapsed seconds
+        """
+        limiter = http.RateLimiter(rate_limit, burst) if rate_limit else None
+        entries = iter(enumerate(entries))
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        pending = set()
+        try:
+            while True:
+                for index, entry in entries:
+                    pending.add(executor.submit(self._execute_entry, index, entry, limiter))
+                    if len(pending) >= 2 * max_workers:
+                        break
+                if not pending:
+                    return
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _execute_entry(self, index, entry, limiter):
+        """
+        executes a single execute_many entry
+        :return: execute_many result dict
+        """
+        operation, sub_path = entry[0], entry[1]
+        json_obj = entry[2] if len(entry) > 2 else None
+        if limiter is not None:
+            limiter.acquire()
+        report = {'index': index, 'operation': operation, 'sub_path': sub_path, 'result': None, 'error': None}
+        start_time = time.monotonic()
+        try:
+            report['result'] = self.execute(operation, sub_path, json_obj)
+        except Exception as err:
+            self.logger.debug("Request {} {} failed: {}", operation, sub_path, err)
+            report['error'] = err
+        report['elapsed'] = time.monotonic() - start_time
+        return report
+
     def _get_operation_headers(self, ticket):
         """
         Generates a dict that represents a HTTP headed for a requests call with an RPT for UMA requests.
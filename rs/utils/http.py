@@ -5,8 +5,252 @@
 #
 
 import base64
+import random
 import requests
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from rs.utils.metrics import MetricsRegistry
+from urllib.parse import urlsplit
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+
+http_metrics = MetricsRegistry()
+_timing = threading.local()
+
+
+class _TimedHTTPConnection(HTTPConnection):
+	"""
+	records TCP connect time (including DNS resolution) of new connections in the current request phases
+	"""
+
+	def _new_conn(self):
+		start_time = time.perf_counter()
+		conn = super()._new_conn()
+		_current_phases()["connect"] = time.perf_counter() - start_time
+		return conn
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+	"""
+	records TCP connect and TLS handshake times of new connections in the current request phases
+	"""
+
+	def _new_conn(self):
+		start_time = time.perf_counter()
+		conn = super()._new_conn()
+		_current_phases()["connect"] = time.perf_counter() - start_time
+		return conn
+
+	def connect(self):
+		start_time = time.perf_counter()
+		super().connect()
+		phases = _current_phases()
+		phases["tls"] = max(0.0, time.perf_counter() - start_time - phases.get("connect", 0.0))
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+	ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+	ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(HTTPAdapter):
+	"""
+	HTTPAdapter whose pools create connections that record connect and TLS times
+	"""
+
+	def init_poolmanager(self, *args, **kwargs):
+		super().init_poolmanager(*args, **kwargs)
+		self.poolmanager.pool_classes_by_scheme = {
+			"http": _TimedHTTPConnectionPool,
+			"https": _TimedHTTPSConnectionPool
+		}
+
+
+def _current_phases():
+	phases = getattr(_timing, "phases", None)
+	if phases is None:
+		phases = {}
+		_timing.phases = phases
+	return phases
+
+
+def last_request_timing():
+	"""
+	returns the timing of the last request sent by an HttpTransport from the current thread
+	:return: dict with method, host, status, bytes, reused (True if a pooled connection was used) and
+	connect, tls, ttfb and total seconds (connect and tls are None on reused connections). ttfb is the server wait,
+	from the request sent on an open connection until response headers. None if no request was sent
+	"""
+	return getattr(_timing, "last", None)
+
+
+class HttpTransport:
+	"""
+	HttpTransport sends requests through a pooled requests.Session, so connections (and their TLS handshakes)
+	are reused across calls. Cookies are never stored, so calls stay independent as with module-level requests.
+	Every call is timed and recorded in metrics: connect, tls (only on new connections), ttfb (server wait, until
+	response headers, excluding connect and tls) and total durations in seconds, labelled by method, host and status.
+	Attributes:
+		session: requests.Session with pooled adapters mounted for http and https
+		timeout: default timeout, seconds or a (connect, read) tuple, applied when a call does not pass one
+		metrics: MetricsRegistry calls are recorded in
+	"""
+
+	def __init__(self, pool_connections=10, pool_maxsize=10, timeout=(10, 60), retries=0, backoff_factor=0.5,
+				 status_forcelist=(502, 503, 504), metrics=None):
+		"""
+		:param pool_connections: number of hosts with pooled connections
+		:param pool_maxsize: max connections kept per host
+		:param timeout: default timeout, seconds or a (connect, read) tuple
+		:param retries: retries for connection errors and status_forcelist responses, only on idempotent methods
+		:param backoff_factor: retries wait backoff_factor * 2 ^ (retry - 1) seconds
+		:param status_forcelist: HTTP status codes that are retried
+		:param metrics: MetricsRegistry to record calls in, default is http_metrics
+		"""
+		self.timeout = timeout
+		self.metrics = metrics if metrics is not None else http_metrics
+		self.session = requests.Session()
+		self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+		try:
+			retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist,
+						  raise_on_status=False)
+		except TypeError:
+			retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist)
+		adapter = _TimedHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+							  max_retries=retry if retries > 0 else 0)
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+
+	def request(self, method, url, **kwargs):
+		"""
+		same as requests.request, through the pooled session
+		:return: requests.Response
+		"""
+		kwargs.setdefault("timeout", self.timeout)
+		phases = {}
+		_timing.phases = phases
+		status = "error"
+		size = 0
+		start_time = time.perf_counter()
+		try:
+			response = self.session.request(method, url, **kwargs)
+			status = response.status_code
+			size = int(response.headers.get("Content-Length") or 0) if kwargs.get("stream") else len(response.content)
+			# response.elapsed also counts opening the connection
+			phases["ttfb"] = max(0.0, response.elapsed.total_seconds() - phases.get("connect", 0.0) -
+								 phases.get("tls", 0.0))
+			return response
+		finally:
+			phases["total"] = time.perf_counter() - start_time
+			_timing.phases = None
+			self._record(method, url, status, size, phases)
+
+	def _record(self, method, url, status, size, phases):
+		"""
+		records a call in metrics and as the last request timing of the current thread
+		"""
+		host = urlsplit(url).netloc.rpartition("@")[2]
+		for phase, duration in phases.items():
+			self.metrics.record("http_request_duration_seconds", duration, method=method, host=host, status=status,
+								phase=phase)
+		self.metrics.record("http_response_bytes", size, method=method, host=host, status=status)
+		_timing.last = {
+			'method': method,
+			'host': host,
+			'status': status,
+			'bytes': size,
+			'reused': "connect" not in phases,
+			'connect': phases.get("connect"),
+			'tls': phases.get("tls"),
+			'ttfb': phases.get("ttfb"),
+			'total': phases.get("total")
+		}
+
+	def get(self, url, **kwargs):
+		return self.request("GET", url, **kwargs)
+
+	def post(self, url, **kwargs):
+		return self.request("POST", url, **kwargs)
+
+	def close(self):
+		self.session.close()
+
+
+class RateLimiter:
+	"""
+	RateLimiter is a token bucket shared between threads: acquire() blocks until a call is allowed, so calls never
+	exceed rate per second on average, with bursts of up to burst calls.
+	"""
+
+	def __init__(self, rate, burst=1):
+		"""
+		:param rate: calls allowed per second
+		:param burst: max calls allowed at once after an idle period
+		"""
+		if rate <= 0:
+			raise ValueError("rate must be greater than 0, got {}".format(rate))
+		self.rate = float(rate)
+		self.burst = max(1, burst)
+		self._tokens = float(self.burst)
+		self._updated = time.monotonic()
+		self._lock = threading.Lock()
+
+	def acquire(self):
+		"""
+		waits until a call is allowed
+		:return: seconds waited
+		"""
+		wait = self.reserve()
+		if wait > 0:
+			time.sleep(wait)
+		return wait
+
+	def reserve(self):
+		"""
+		takes a token from the bucket, going negative if it is empty. Used by acquire, and by callers that wait
+		without blocking the thread, like async clients
+		:return: seconds the caller must wait before its call
+		"""
+		with self._lock:
+			now = time.monotonic()
+			self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+			self._updated = now
+			self._tokens -= 1
+			return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+
+def get_default_transport():
+	"""
+	returns the HttpTransport shared by every client that is not given one, created on first use
+	:return: HttpTransport
+	"""
+	global _default_transport
+	with _default_transport_lock:
+		if _default_transport is None:
+			_default_transport = HttpTransport()
+		return _default_transport
+
+
+def set_default_transport(transport):
+	"""
+	replaces the shared HttpTransport, for instance with one with bigger pools or retries
+	:param transport: HttpTransport
+	"""
+	global _default_transport
+	with _default_transport_lock:
+		_default_transport = transport
 
 
 def validate_response(response, logger, msg, *args):
@@ -38,7 +282,7 @@ def to_base64_creds(user, password):
 	return base64_bytes.decode('ascii')
 
 
-def wait_for_endpoint(url, iterations, interval, logger, headers={}, verify=True):
+def wait_for_endpoint(url, iterations, interval, logger, headers={}, verify=True, transport=None):
 	"""
 	Wait for a http endpoint until is up and running
 	:param headers: http headers
@@ -46,14 +290,16 @@ def wait_for_endpoint(url, iterations, interval, logger, headers={}, verify=True
 	:param iterations: number of retries
 	:param interval: waiting interval between retries
 	:param logger: rs log obj
+	:param transport: HttpTransport, default is the shared one
 	:return: None
 	"""
+	transport = transport or get_default_transport()
 	endpoint_ready = False
 	for iteration in range(iterations):
 		logger.debug("Iteration #: {}", iteration)
 		try:
 			logger.trace("Calling URL: {} with method: GET", url)
-			http_response = requests.request("GET", url, verify=verify, headers=headers)
+			http_response = transport.request("GET", url, verify=verify, headers=headers)
 			logger.trace("http_response: {}, type: {}", http_response, type(http_response))
 			response_code = http_response.status_code
 			logger.trace("response_code: {}, type: {}", response_code, type(response_code))
@@ -66,3 +312,71 @@ def wait_for_endpoint(url, iterations, interval, logger, headers={}, verify=True
 		time.sleep(interval)
 	if not endpoint_ready:
 		raise Exception("Gave up trying to connect to endpoint: {}", url)
+
+
+def wait_for_endpoints(urls, logger, deadline=300, request_timeout=5, initial_interval=0.5, max_interval=10,
+					   headers={}, verify=True, transport=None, max_workers=None):
+	"""
+	Wait for several http endpoints concurrently until all of them are up and running.
+	Each endpoint is polled on its own thread with exponential backoff and jitter, so the total wait is the one of
+	the slowest endpoint.
+	:param urls: list of http endpoints
+	:param logger: rs log obj
+	:param deadline: max seconds to wait for all endpoints
+	:param request_timeout: max seconds for each request
+	:param initial_interval: waiting interval after the first failed request, doubled after each failure
+	:param max_interval: max waiting interval between requests
+	:param headers: http headers
+	:param transport: HttpTransport, default is the shared one
+	:param max_workers: max endpoints polled at once, default is one thread per endpoint
+	:return: dict of url -> seconds until it was ready. Raises IOError listing endpoints not ready before deadline
+	"""
+	transport = transport or get_default_transport()
+	urls = list(urls)
+	if not urls:
+		return {}
+	deadline_time = time.monotonic() + deadline
+	with ThreadPoolExecutor(max_workers=max_workers or len(urls)) as executor:
+		futures = {url: executor.submit(_wait_until_ready, url, deadline_time, request_timeout, initial_interval,
+										max_interval, logger, headers, verify, transport) for url in urls}
+		times_to_ready = {url: future.result() for url, future in futures.items()}
+	not_ready = [url for url, time_to_ready in times_to_ready.items() if time_to_ready is None]
+	if not_ready:
+		error_msg = "Gave up trying to connect to endpoints after {} seconds: {}".format(deadline, not_ready)
+		logger.error(error_msg)
+		raise IOError(error_msg)
+	logger.debug("Endpoints ready: {}", times_to_ready)
+	return times_to_ready
+
+
+def _wait_until_ready(url, deadline_time, request_timeout, initial_interval, max_interval, logger, headers, verify,
+					  transport):
+	"""
+	polls a single endpoint until it returns 2xx or deadline_time is reached
+	:return: seconds until the endpoint was ready, None if deadline_time was reached first
+	"""
+	start_time = time.monotonic()
+	attempt = 0
+	while True:
+		remaining = deadline_time - time.monotonic()
+		if remaining <= 0:
+			return None
+		try:
+			logger.trace("Calling URL: {} with method: GET", url)
+			http_response = transport.request("GET", url, verify=verify, headers=headers,
+											  timeout=min(request_timeout, remaining))
+			response_code = http_response.status_code
+			http_response.close()
+			logger.trace("URL: {} response_code: {}", url, response_code)
+			if 200 <= response_code < 300:
+				return time.monotonic() - start_time
+		except Exception as err:
+			logger.debug("Exception while trying to get endpoint: {}: {}", url, err)
+		interval = min(max_interval, initial_interval * 2 ** attempt)
+		interval = interval / 2 + random.uniform(0, interval / 2)
+		attempt += 1
+		remaining = deadline_time - time.monotonic()
+		if remaining <= 0:
+			return None
+		logger.info("Waiting {:.2f} seconds for endpoint: {}.", interval, url)
+		time.sleep(min(interval, remaining))
@@ -0,0 +1,185 @@
+# rs-utils is available under the MIT License. https://github.com/RoundServices/rs-utils/
+# Copyright (c) 2022, Round Services LLC - https://roundservices.biz/
+#
+# Author: Ezequiel O Sandoval - esandoval@roundservices.biz
+#
+
+from datetime import datetime
+import argparse
+import json
+import os
+import sys
+import time
+
+
+class JsonLogReader(object):
+    """
+    JsonLogReader queries logs written by Logger with log_format="json".
+    It keeps a sidecar index (log_path + ".idx") splitting the file in blocks of block_lines lines, with the
+    offset, time range, levels and loggers of each block. Queries only read the blocks that can match.
+    The index is updated incrementally on each query, only lines appended since the last update are read.
+    Attributes:
+        log_path: JSON-lines log file
+        index_path: sidecar index file
+        block_lines: number of lines per index block
+    """
+
+    index_version = 1
+
+    def __init__(self, log_path, index_path=None, block_lines=1000):
+        self.log_path = log_path
+        self.index_path = index_path if index_path is not None else log_path + ".idx"
+        self.block_lines = block_lines
+
+    def update_index(self):
+        """
+        indexes lines appended since the last update. The index is rebuilt if the log was rotated or truncated
+        :return: dict that represents the index
+        """
+        stat = os.stat(self.log_path)
+        index = self._load_index()
+        if index is None or index["inode"] != [stat.st_dev, stat.st_ino] or index["indexed_bytes"] > stat.st_size \
+                or index["block_lines"] != self.block_lines:
+            index = {
+                "version": self.index_version,
+                "inode": [stat.st_dev, stat.st_ino],
+                "block_lines": self.block_lines,
+                "indexed_bytes": 0,
+                "blocks": []
+            }
+        blocks = index["blocks"]
+        if blocks and blocks[-1]["lines"] < self.block_lines:
+            offset = blocks.pop()["offset"]
+        else:
+            offset = blocks[-1]["end"] if blocks else 0
+        if offset == stat.st_size:
+            return index
+        block = None
+        with open(self.log_path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                if block is None:
+                    block = {"offset": offset, "end": offset, "lines": 0, "min_ts": None, "max_ts": None,
+                             "levels": [], "loggers": []}
+                offset += len(line)
+                block["end"] = offset
+                block["lines"] += 1
+                record = _parse(line)
+                if record is not None:
+                    ts = record["_epoch"]
+                    block["min_ts"] = ts if block["min_ts"] is None else min(block["min_ts"], ts)
+                    block["max_ts"] = ts if block["max_ts"] is None else max(block["max_ts"], ts)
+                    if record.get("level") not in block["levels"]:
+                        block["levels"].append(record.get("level"))
+                    if record.get("logger") not in block["loggers"]:
+                        block["loggers"].append(record.get("logger"))
+                if block["lines"] >= self.block_lines:
+                    blocks.append(block)
+                    block = None
+        if block is not None:
+            blocks.append(block)
+        index["indexed_bytes"] = offset
+        self._save_index(index)
+        return index
+
+    def query(self, levels=None, loggers=None, functions=None, since=None, until=None):
+        """
+        yields records matching every given filter, in file order
+        :param levels: level or list of levels, for instance "ERROR"
+        :param loggers: logger name or list of logger names, for instance "OIDCMonitor"
+        :param functions: function name or list of function names
+        :param since: epoch seconds or datetime, records older than this are skipped
+        :param until: epoch seconds or datetime, records newer than this are skipped
+        :return: generator of dicts, one per matching log line
+        """
+        levels = _as_set(levels)
+        loggers = _as_set(loggers)
+        functions = _as_set(functions)
+        since = since.timestamp() if isinstance(since, datetime) else since
+        until = until.timestamp() if isinstance(until, datetime) else until
+        index = self.update_index()
+        with open(self.log_path, "rb") as f:
+            for block in index["blocks"]:
+                if block["min_ts"] is None:
+                    continue
+                if since is not None and block["max_ts"] < since:
+                    continue
+                if until is not None and block["min_ts"] > until:
+                    continue
+                if levels is not None and levels.isdisjoint(block["levels"]):
+                    continue
+                if loggers is not None and loggers.isdisjoint(block["loggers"]):
+                    continue
+                f.seek(block["offset"])
+                for line in f.read(block["end"] - block["offset"]).splitlines():
+                    record = _parse(line)
+                    if record is None:
+                        continue
+                    if since is not None and record["_epoch"] < since:
+                        continue
+                    if until is not None and record["_epoch"] > until:
+                        continue
+                    if levels is not None and record.get("level") not in levels:
+                        continue
+                    if loggers is not None and record.get("logger") not in loggers:
+                        continue
+                    if functions is not None and record.get("function") not in functions:
+                        continue
+                    del record["_epoch"]
+                    yield record
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "rt") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return index if index.get("version") == self.index_version else None
+
+    def _save_index(self, index):
+        tmp_path = "{}.{}.tmp".format(self.index_path, os.getpid())
+        try:
+            with open(tmp_path, "wt") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            pass
+
+
+def _parse(line):
+    """
+    :param line: bytes of a single log line
+    :return: dict of the JSON record with its epoch in "_epoch", None if line is not a JSON record
+    """
+    try:
+        record = json.loads(line)
+        record["_epoch"] = datetime.fromisoformat(record["ts"]).timestamp()
+    except (ValueError, KeyError, TypeError):
+        return None
+    return record
+
+
+def _as_set(value):
+    if value is None:
+        return None
+    return {value} if isinstance(value, str) else set(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query a JSON-lines log written by rs.utils.basics.Logger")
+    parser.add_argument("log_path")
+    parser.add_argument("--level", action="append", help="level to include, can be repeated")
+    parser.add_argument("--logger", action="append", help="logger name to include, can be repeated")
+    parser.add_argument("--function", action="append", help="function name to include, can be repeated")
+    parser.add_argument("--last", type=float, help="only records from the last LAST seconds")
+    args = parser.parse_args(argv)
+    since = time.time() - args.last if args.last is not None else None
+    reader = JsonLogReader(args.log_path)
+    for record in reader.query(args.level, args.logger, args.function, since):
+        sys.stdout.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
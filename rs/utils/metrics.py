@@ -0,0 +1,371 @@
+# rs-utils is available under the MIT License. https://github.com/RoundServices/rs-utils/
+# Copyright (c) 2022, Round Services LLC - https://roundservices.biz/
+#
+# Author: Ezequiel O Sandoval - esandoval@roundservices.biz
+#
+
+from datetime import datetime, timezone
+import atexit
+import json
+import math
+import threading
+import time
+
+
+class Histogram(object):
+    """
+    Histogram keeps values in logarithmic buckets, so memory is bounded and percentiles have a bounded relative
+    error (growth - 1, about 4.4% by default) whatever the range of recorded values.
+    Attributes:
+        growth: ratio between the bounds of consecutive buckets
+        count: number of recorded values
+        sum: sum of recorded values
+        min: smallest recorded value
+        max: biggest recorded value
+    """
+
+    def __init__(self, growth=2 ** (1.0 / 16)):
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self._buckets = {}
+        self._zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        """
+        :param value: non negative number
+        """
+        if value <= 0:
+            self._zeros += 1
+        else:
+            index = int(math.floor(math.log(value) / self._log_growth))
+            self._buckets[index] = self._buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        """
+        adds the values of another Histogram with the same growth
+        """
+        for index, bucket_count in other._buckets.items():
+            self._buckets[index] = self._buckets.get(index, 0) + bucket_count
+        self._zeros += other._zeros
+        self.count += other.count
+        self.sum += other.sum
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, percentile):
+        """
+        :param percentile: number between 0 and 100
+        :return: approximate value below which percentile % of recorded values are, None if empty
+        """
+        if self.count == 0:
+            return None
+        rank = max(1, int(math.ceil(self.count * percentile / 100.0)))
+        seen = self._zeros
+        if seen >= rank:
+            return 0.0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                value = self.growth ** (index + 0.5)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        """
+        :return: dict with count, sum, min, max, mean, p50, p95 and p99
+        """
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99)
+        }
+
+
+class MetricsRegistry(object):
+    """
+    MetricsRegistry holds a Histogram per metric name and label set, and exports them as a dict or as
+    Prometheus text. It can be shared between threads.
+    """
+
+    quantiles = (0.5, 0.95, 0.99)
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, value, **labels):
+        """
+        records a value
+        :param name: metric name, for instance 'http_request_duration_seconds'
+        :param value: value to record
+        :param labels: labels identifying the series, for instance host='myidp.myorg.com', values are kept as str
+        """
+        key = (name, _label_items(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = Histogram()
+                self._histograms[key] = histogram
+            histogram.record(value)
+
+    def histogram(self, name, **labels):
+        """
+        :return: a copy of the Histogram of the series, merging every series of name matching the given labels
+        """
+        merged = Histogram()
+        with self._lock:
+            for (series_name, series_labels), histogram in self._histograms.items():
+                if series_name == name and set(_label_items(labels)).issubset(series_labels):
+                    merged.merge(histogram)
+        return merged
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    def to_dict(self):
+        """
+        :return: dict of metric name -> list of dicts with 'labels' and the Histogram.to_dict values
+        """
+        metrics = {}
+        with self._lock:
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                series = histogram.to_dict()
+                series['labels'] = dict(labels)
+                metrics.setdefault(name, []).append(series)
+        return metrics
+
+    def to_prometheus(self, prefix="rs_"):
+        """
+        :param prefix: prepended to every metric name
+        :return: str in Prometheus text exposition format, each metric exported as a summary
+        """
+        lines = []
+        with self._lock:
+            series = sorted(self._histograms.items())
+            last_name = None
+            for (name, labels), histogram in series:
+                metric_name = prefix + name
+                if name != last_name:
+                    lines.append("# TYPE {} summary".format(metric_name))
+                    last_name = name
+                for quantile in self.quantiles:
+                    value = histogram.percentile(quantile * 100)
+                    lines.append("{}{} {}".format(metric_name, _prometheus_labels(labels + (("quantile", quantile),)),
+                                                  "NaN" if value is None else repr(float(value))))
+                lines.append("{}_sum{} {}".format(metric_name, _prometheus_labels(labels), repr(float(histogram.sum))))
+                lines.append("{}_count{} {}".format(metric_name, _prometheus_labels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+class CloudWatchPublisher(object):
+    """
+    CloudWatchPublisher buffers metric datapoints and publishes them with put_metric_data from a background thread.
+    Datapoints are aggregated per metric, unit and dimensions, either as Values / Counts (aggregation='values',
+    up to max_values distinct values per datum) or as a StatisticSet (aggregation='statistics').
+    The buffer is flushed every flush_interval seconds, or as soon as max_datums datums are pending, in calls of
+    up to max_datums datums and about max_payload_bytes. Throttled calls are retried with exponential backoff.
+    Pending datapoints are flushed on close, also called at exit.
+    Attributes:
+        cloudwatch: any object with a boto3 compatible put_metric_data(Namespace=..., MetricData=[...])
+        namespace: CloudWatch namespace
+        dropped: number of datums dropped after failed calls
+    """
+
+    throttling_codes = ("Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequestsException")
+
+    def __init__(self, cloudwatch, namespace="Applications", aggregation="values", flush_interval=60.0,
+                 max_datums=1000, max_values=150, max_payload_bytes=1000000, max_retries=5, backoff_factor=0.5,
+                 logger=None):
+        """
+        :param cloudwatch: client with put_metric_data, for instance boto3.client('cloudwatch')
+        :param namespace: CloudWatch namespace
+        :param aggregation: 'values' or 'statistics'
+        :param flush_interval: max seconds a datapoint waits before being published
+        :param max_datums: max datums per put_metric_data call
+        :param max_values: max distinct values per datum, when aggregation is 'values'
+        :param max_payload_bytes: approximate max size of a put_metric_data call
+        :param max_retries: retries of a throttled call
+        :param backoff_factor: retries wait backoff_factor * 2 ^ (retry - 1) seconds
+        :param logger: RoundServices log, optional
+        """
+        if aggregation not in ("values", "statistics"):
+            raise ValueError("Invalid aggregation: {}".format(aggregation))
+        self.cloudwatch = cloudwatch
+        self.namespace = namespace
+        self.aggregation = aggregation
+        self.flush_interval = flush_interval
+        self.max_datums = max_datums
+        self.max_values = max_values
+        self.max_payload_bytes = max_payload_bytes
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.logger = logger
+        self.dropped = 0
+        self.closed = False
+        self._buffer = {}
+        self._pending_datums = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="CloudWatchPublisher", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, metric, value, unit="None", **dimensions):
+        """
+        buffers a datapoint
+        :param metric: metric name, for instance 'idp-ropc-response'
+        :param value: numeric value
+        :param unit: CloudWatch unit, for instance 'Milliseconds'
+        :param dimensions: CloudWatch dimensions, for instance Idp='myidp.myorg.com'
+        """
+        key = (metric, unit, tuple(sorted(dimensions.items())))
+        with self._lock:
+            bucket = self._buffer.get(key)
+            if bucket is None:
+                bucket = {'timestamp': datetime.now(timezone.utc), 'values': {}, 'count': 0, 'sum': 0.0,
+                          'min': value, 'max': value}
+                self._buffer[key] = bucket
+                self._pending_datums += 1
+            if self.aggregation == "values":
+                if value not in bucket['values'] and len(bucket['values']) % self.max_values == 0 \
+                        and bucket['values']:
+                    self._pending_datums += 1
+                bucket['values'][value] = bucket['values'].get(value, 0) + 1
+            bucket['count'] += 1
+            bucket['sum'] += value
+            bucket['min'] = min(bucket['min'], value)
+            bucket['max'] = max(bucket['max'], value)
+            full = self._pending_datums >= self.max_datums
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """
+        publishes every buffered datapoint now
+        """
+        with self._lock:
+            buffer = self._buffer
+            self._buffer = {}
+            self._pending_datums = 0
+        datums = []
+        for key, bucket in buffer.items():
+            datums.extend(self._datums(key, bucket))
+        with self._flush_lock:
+            for batch in self._batches(datums):
+                self._publish(batch)
+
+    def close(self):
+        """
+        stops the background thread and publishes pending datapoints, later datapoints are published on flush
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        """
+        publisher thread loop, flushes every flush_interval seconds or when the buffer is full
+        """
+        while not self.closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self.closed:
+                break
+            try:
+                self.flush()
+            except Exception as err:
+                if self.logger is not None:
+                    self.logger.error("Could not publish metrics: {}", err)
+
+    def _datums(self, key, bucket):
+        """
+        :return: list of MetricData datums of a buffered metric
+        """
+        metric, unit, dimensions = key
+        datum = {
+            'MetricName': metric,
+            'Timestamp': bucket['timestamp'],
+            'Unit': unit
+        }
+        if dimensions:
+            datum['Dimensions'] = [{'Name': name, 'Value': str(value)} for name, value in dimensions]
+        if self.aggregation == "statistics":
+            datum['StatisticValues'] = {
+                'SampleCount': bucket['count'],
+                'Sum': bucket['sum'],
+                'Minimum': bucket['min'],
+                'Maximum': bucket['max']
+            }
+            return [datum]
+        items = list(bucket['values'].items())
+        datums = []
+        for i in range(0, len(items), self.max_values):
+            chunk = items[i:i + self.max_values]
+            datums.append(dict(datum, Values=[value for value, _ in chunk], Counts=[count for _, count in chunk]))
+        return datums
+
+    def _batches(self, datums):
+        """
+        splits datums in put_metric_data calls of up to max_datums datums and about max_payload_bytes
+        """
+        batch = []
+        size = 0
+        for datum in datums:
+            datum_size = len(json.dumps(datum, default=str))
+            if batch and (len(batch) >= self.max_datums or size + datum_size > self.max_payload_bytes):
+                yield batch
+                batch = []
+                size = 0
+            batch.append(datum)
+            size += datum_size
+        if batch:
+            yield batch
+
+    def _publish(self, batch):
+        """
+        calls put_metric_data, retrying throttled calls
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.cloudwatch.put_metric_data(Namespace=self.namespace, MetricData=batch)
+                return
+            except Exception as err:
+                code = (getattr(err, "response", None) or {}).get("Error", {}).get("Code")
+                if code in self.throttling_codes and attempt < self.max_retries:
+                    time.sleep(self.backoff_factor * 2 ** attempt)
+                    continue
+                self.dropped += len(batch)
+                if self.logger is not None:
+                    self.logger.error("Could not publish {} metric datums: {}", len(batch), err)
+                return
+
+
+def _label_items(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                          for k, v in labels) + "}"
@@ -3,55 +3,129 @@
 #
 # Author: Ezequiel O Sandoval - esandoval@roundservices.biz
 #
+from concurrent.futures import ThreadPoolExecutor
+from rs.utils import http
 from rs.utils.clients import OIDCClient
+from rs.utils.http import RateLimiter
+from rs.utils.metrics import Histogram, MetricsRegistry
 
+import heapq
+import itertools
+import threading
 import time
 
 
 class OIDCMonitor:
     """
-    OIDCMonitor provides functions for idp lambda monitoring
+    OIDCMonitor provides functions for idp lambda monitoring.
+    Token probes publish their response time in milliseconds, and the phases of the token endpoint call as
+    <metric>.connect, .tls (only on new connections), .ttfb (server wait, from the request sent until response headers,
+    excluding connect and tls) and .total.
+    Probes called with cold=True open a new connection instead of reusing a pooled one, and publish as
+    <metric>-cold, so network setup and IDP processing times can be told apart.
     """
 
-    def __init__(self, logger, cloudwatch, idp_base_url, b64_client_credentials, verify=False):
+    timing_phases = ('connect', 'tls', 'ttfb', 'total')
+
+    def __init__(self, logger, cloudwatch, idp_base_url, b64_client_credentials, verify=False, transport=None,
+                 publisher=None):
         """
         Params
         :param logger =  RoundServices log.
-        :param cloudwatch = AWS object to put metrics
+        :param cloudwatch = AWS object to put metrics. If None, metrics are not published, for instance on load tests
         :param idp_base_url = for idp instance 'https://myidp.myorg.com'
         :param b64_client_credentials = 'user:pwd' in b64 format from client account
+        :param transport = http.HttpTransport used by probes. If None, the shared one is used
+        :param publisher = metrics.CloudWatchPublisher buffering metrics instead of publishing them inline with probes.
+        If None, each metric is published with its own put_metric_data call
         """
         self.logger = logger
         self.cloudwatch = cloudwatch
-        self.oidc_client = OIDCClient(idp_base_url, logger, verify)
+        self.publisher = publisher
+        self.oidc_client = OIDCClient(idp_base_url, logger, verify, transport)
         self.b64_client_credentials = b64_client_credentials
 
-    def _cw_put_metric_data(self, metric, value):
+    def flush_metrics(self):
+        """
+        publishes metrics buffered by publisher, for instance before a lambda invocation ends
+        """
+        if self.publisher is not None:
+            self.publisher.flush()
+
+    def _cw_put_metrics(self, metrics):
+        """
+        publishes several metrics, in a single put_metric_data call when there is no publisher
+        :param metrics: dict of metric name -> value
+        """
+        if self.publisher is not None:
+            for metric, value in metrics.items():
+                self.publisher.put(metric, value)
+            return
+        if self.cloudwatch is None:
+            return
         self.cloudwatch.put_metric_data(
-            MetricData=[{'MetricName': metric, 'Unit': 'None', 'Value': value}],
+            MetricData=[{'MetricName': metric, 'Unit': 'None', 'Value': value} for metric, value in metrics.items()],
             Namespace='Applications'
         )
 
-    def default_ropc(self, username, password):
+    def _request_token(self, payload, cold=False):
+        """
+        requests a token, through a new connection if cold
+        :return: (token endpoint response, response time in milliseconds, http.last_request_timing of the call)
+        """
+        oidc_client = self.oidc_client
+        if cold:
+            transport = http.HttpTransport(pool_connections=1, pool_maxsize=1)
+            oidc_client = OIDCClient(self.oidc_client.idp_url, self.logger, self.oidc_client.verify, transport)
+        try:
+            start_time = time.monotonic()
+            output = oidc_client.request_to_token_endpoint(self.b64_client_credentials, payload)
+            response_time = (time.monotonic() - start_time) * 1000
+            return output, response_time, http.last_request_timing()
+        finally:
+            if cold:
+                transport.close()
+
+    def _put_probe_metrics(self, metric, response_time, timing, cold=False):
+        """
+        publishes the response time of a probe and the phases of its token endpoint call, in milliseconds
+        """
+        metric = metric + "-cold" if cold else metric
+        metrics = {metric: response_time}
+        for phase in self.timing_phases:
+            if timing is not None and timing.get(phase) is not None:
+                metrics["{}.{}".format(metric, phase)] = timing[phase] * 1000
+        self._cw_put_metrics(metrics)
+
+    def _timing_ms(self, timing):
+        """
+        :return: dict of phase -> milliseconds of a http.last_request_timing, with 'reused'
+        """
+        if timing is None:
+            return None
+        phases = {phase: None if timing.get(phase) is None else timing[phase] * 1000 for phase in self.timing_phases}
+        phases['reused'] = timing.get('reused')
+        return phases
+
+    def default_ropc(self, username, password, cold=False):
         ropc_payload = {
             'grant_type': 'password',
             'username': username,
             'password': password,
             'scope': 'openid'
         }
-        return self.ropc(ropc_payload)
+        return self.ropc(ropc_payload, cold)
 
-    def ropc(self, ropc_payload):
+    def ropc(self, ropc_payload, cold=False):
         try:
             self.logger.info('Starting ROPC test.')
-            start_time = time.monotonic()
-            output = self.oidc_client.request_to_token_endpoint(self.b64_client_credentials, ropc_payload)
-            response_time = (time.monotonic() - start_time) * 1000
+            output, response_time, timing = self._request_token(ropc_payload, cold)
             self.logger.info('ROPC test OK - response time: {} - result: {}', str(response_time), output)
-            self._cw_put_metric_data('idp-ropc-response', response_time)
+            self._put_probe_metrics('idp-ropc-response', response_time, timing, cold)
             return {
                 'status': 'OK',
-                'response_time': response_time
+                'response_time': response_time,
+                'timing': self._timing_ms(timing)
             }
         except Exception as err:
             self.logger.error("An error has ocurred: {}", err)
@@ -59,17 +133,16 @@ class OIDCMonitor:
                 'status': 'ERROR'
             }
 
-    def clientcred(self):
+    def clientcred(self, cold=False):
         try:
             self.logger.info('Starting client_credentials test.')
-            start_time = time.monotonic()
-            output = self.oidc_client.request_to_token_endpoint(self.b64_client_credentials, {'grant_type': 'client_credentials'})
-            response_time = (time.monotonic() - start_time) * 1000
+            output, response_time, timing = self._request_token({'grant_type': 'client_credentials'}, cold)
             self.logger.info('client_cred test OK - response time: {} - result: {}', str(response_time), output)
-            self._cw_put_metric_data('idp-client-credentials-response', response_time)
+            self._put_probe_metrics('idp-client-credentials-response', response_time, timing, cold)
             return {
                 'status': 'OK',
-                'response_time': response_time
+                'response_time': response_time,
+                'timing': self._timing_ms(timing)
             }
         except Exception as err:
             self.logger.error("An error has ocurred: {}", err)
@@ -77,7 +150,7 @@ class OIDCMonitor:
                 'status': 'ERROR'
             }
 
-    def claims_validation(self, scopes, username, password, claims, error_claim=None, jwt_name='id_token'):
+    def claims_validation(self, scopes, username, password, claims, error_claim=None, jwt_name='id_token', cold=False):
         try:
             self.logger.info('Starting test_claims claims test.')
             ropc_payload = {
@@ -86,17 +159,17 @@ class OIDCMonitor:
                 'password': password,
                 'scope': " ".join(scopes)
             }
-            start_time = time.monotonic()
-            id_token = self.oidc_client.request_to_token_endpoint(self.b64_client_credentials, ropc_payload)[jwt_name]
-            response_time = (time.monotonic() - start_time) * 1000
+            output, response_time, timing = self._request_token(ropc_payload, cold)
+            id_token = output[jwt_name]
             self.logger.info("id_token value before validation is {}", id_token)
             output = self.oidc_client.validate_jwt(claims, id_token, error_claim)
             self.logger.info('jwt validation result {}', output)
             if output:
-                self._cw_put_metric_data('idp-scopes-response', response_time)
+                self._put_probe_metrics('idp-scopes-response', response_time, timing, cold)
                 return {
                     'status': 'OK',
-                    'response_time': response_time
+                    'response_time': response_time,
+                    'timing': self._timing_ms(timing)
                 }
             else:
                 self.logger.error("Invalid JWT")
@@ -108,3 +181,202 @@ class OIDCMonitor:
             return {
                 'status': 'ERROR'
             }
+
+
+class ProbeScheduler:
+    """
+    ProbeScheduler runs probes, such as OIDCMonitor.ropc or OIDCMonitor.clientcred of one or more monitors,
+    periodically and concurrently. A probe is never run again while its previous run is still in flight.
+    Every run is recorded in metrics as probe_response_time_ms, labelled by probe and status.
+    run_load drives the same probes as a load test.
+    Attributes:
+        interval: default seconds between runs of a probe
+        metrics: MetricsRegistry runs are recorded in
+        last_results: dict of probe name -> result of its last run
+    """
+
+    def __init__(self, logger, interval=60, max_workers=8, metrics=None):
+        """
+        :param logger: RoundServices log
+        :param interval: default seconds between runs of a probe
+        :param max_workers: max probes running at once
+        :param metrics: MetricsRegistry, a new one if None
+        """
+        self.logger = logger
+        self.interval = interval
+        self.max_workers = max_workers
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.last_results = {}
+        self._probes = {}
+        self._running = set()
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+
+    def add(self, name, probe, *args, **kwargs):
+        """
+        registers a probe, for instance add("myidp.ropc", monitor.default_ropc, "user", "pwd", interval=30)
+        :param name: unique probe name
+        :param probe: function returning a dict with 'status' ('OK' or 'ERROR'), called with args and kwargs
+        :param interval: keyword only, seconds between runs of this probe, default is the scheduler interval
+        """
+        interval = kwargs.pop("interval", None) or self.interval
+        self._probes[name] = {
+            'function': lambda: probe(*args, **kwargs),
+            'interval': interval
+        }
+
+    def subscribe(self, callback):
+        """
+        registers a callback called after each scheduled run with (name, result)
+        """
+        self._subscribers.append(callback)
+
+    def run_once(self, names=None):
+        """
+        runs probes once, concurrently
+        :param names: probe names, default is every probe
+        :return: dict of probe name -> result
+        """
+        names = list(self._probes) if names is None else names
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {name: executor.submit(self._run, name) for name in names}
+            return {name: future.result() for name, future in futures.items()}
+
+    def start(self):
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._thread = threading.Thread(target=self._schedule, name="ProbeScheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def run_load(self, virtual_users, rate=None, duration=60, names=None):
+        """
+        runs probes as a load test: virtual_users threads call the probes in turn until duration is over.
+        Build the probes from monitors with cloudwatch=None to avoid publishing a metric per call.
+        :param virtual_users: number of concurrent callers
+        :param rate: target calls per second for all probes, default is as fast as virtual_users allow
+        :param duration: seconds the test lasts
+        :param names: probe names, default is every probe
+        :return: dict of probe name, and 'total' for all of them, -> dict with requests, errors, error_rate,
+        throughput (calls per second) and latency (metrics.Histogram.to_dict of milliseconds)
+        """
+        names = list(self._probes) if names is None else names
+        limiter = RateLimiter(rate) if rate else None
+        histograms = {name: {'OK': Histogram(), 'ERROR': Histogram()} for name in names}
+        counter = itertools.count()
+        deadline = time.monotonic() + duration
+        self.logger.info("Starting load test of {} with {} virtual users, rate {} for {} seconds",
+                         names, virtual_users, rate, duration)
+
+        def virtual_user():
+            local = {name: {'OK': Histogram(), 'ERROR': Histogram()} for name in names}
+            while True:
+                if limiter is not None:
+                    limiter.acquire()
+                if time.monotonic() >= deadline:
+                    break
+                name = names[next(counter) % len(names)]
+                start_time = time.monotonic()
+                status = self._call(name)['status']
+                local[name]['OK' if status == 'OK' else 'ERROR'].record((time.monotonic() - start_time) * 1000)
+            with self._lock:
+                for name, by_status in local.items():
+                    for status, histogram in by_status.items():
+                        histograms[name][status].merge(histogram)
+
+        start_time = time.monotonic()
+        users = [threading.Thread(target=virtual_user, name="ProbeLoad-{}".format(i), daemon=True)
+                 for i in range(virtual_users)]
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        elapsed = time.monotonic() - start_time
+        reports = {}
+        total = {'OK': Histogram(), 'ERROR': Histogram()}
+        for name in names:
+            reports[name] = self._load_report(histograms[name], elapsed)
+            total['OK'].merge(histograms[name]['OK'])
+            total['ERROR'].merge(histograms[name]['ERROR'])
+        reports['total'] = self._load_report(total, elapsed)
+        self.logger.info("Load test finished: {}", reports['total'])
+        return reports
+
+    def _load_report(self, by_status, elapsed):
+        latency = Histogram()
+        latency.merge(by_status['OK'])
+        latency.merge(by_status['ERROR'])
+        return {
+            'requests': latency.count,
+            'errors': by_status['ERROR'].count,
+            'error_rate': by_status['ERROR'].count / latency.count if latency.count else 0.0,
+            'throughput': latency.count / elapsed if elapsed > 0 else 0.0,
+            'latency': latency.to_dict()
+        }
+
+    def _schedule(self):
+        """
+        scheduler thread: submits each probe when it is due, every interval seconds, skipping missed runs
+        """
+        now = time.monotonic()
+        queue = [(now, name) for name in self._probes]
+        heapq.heapify(queue)
+        while queue and not self._stop.is_set():
+            due, name = queue[0]
+            if self._stop.wait(max(0.0, due - time.monotonic())):
+                break
+            heapq.heappop(queue)
+            with self._lock:
+                busy = name in self._running
+                if not busy:
+                    self._running.add(name)
+            if busy:
+                self.logger.warn("Probe {} is still running, skipping this run", name)
+            else:
+                self._executor.submit(self._run_scheduled, name)
+            interval = self._probes[name]['interval']
+            heapq.heappush(queue, (max(due + interval, time.monotonic()), name))
+
+    def _run_scheduled(self, name):
+        try:
+            result = self._run(name)
+        finally:
+            with self._lock:
+                self._running.discard(name)
+        for callback in self._subscribers:
+            try:
+                callback(name, result)
+            except Exception as err:
+                self.logger.error("Probe scheduler subscriber failed: {}", err)
+
+    def _run(self, name):
+        """
+        runs a probe and records it
+        :return: probe result
+        """
+        start_time = time.monotonic()
+        result = self._call(name)
+        self.metrics.record("probe_response_time_ms", (time.monotonic() - start_time) * 1000, probe=name,
+                            status=result.get('status'))
+        self.last_results[name] = result
+        return result
+
+    def _call(self, name):
+        try:
+            return self._probes[name]['function']()
+        except Exception as err:
+            self.logger.error("Probe {} failed: {}", name, err)
+            return {
+                'status': 'ERROR'
+            }
@@ -14,7 +14,8 @@ setup(
     author='Round Services LLC',
     author_email='esandoval@roundservices.biz',
     license='MIT License',
-    install_requires=['requests', 'psutil', 'PyJWT'],
+    install_requires=['requests', 'psutil', 'PyJWT[crypto]'],
+    extras_require={'async': ['aiohttp']},
     packages=['rs', 'rs.utils'],
     zip_safe=False,
     python_requires='>=2.7'
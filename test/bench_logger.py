@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmark of Logger calls: disabled levels must cost about as much as an empty method call.
+# Usage: python bench_logger.py [iterations]
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rs.utils.basics import Logger
+
+
+class _Baseline(object):
+
+	def debug(self, msg, *args):
+		pass
+
+
+def main(iterations=1000000):
+	directory = tempfile.mkdtemp()
+	try:
+		logger = Logger("bench", "INFO", os.path.join(directory, "bench.log"))
+		payload = {"token": "x" * 200, "claims": list(range(20))}
+		cases = [
+			("empty method call", _Baseline().debug, lambda debug: debug("value: {}", payload)),
+			("disabled debug, args", logger.debug, lambda debug: debug("value: {}", payload)),
+			("disabled debug, lambda", logger.debug, lambda debug: debug(lambda: "value: {}".format(payload))),
+			("disabled debug, eager format", logger.debug, lambda debug: debug("value: {}".format(payload)))
+		]
+		for name, function, call in cases:
+			seconds = min(timeit.repeat(lambda: call(function), number=iterations, repeat=3))
+			print("{:<30} {:8.1f} ns/call".format(name, seconds / iterations * 1e9))
+		stdout = sys.stdout
+		sys.stdout = open(os.devnull, "w")
+		try:
+			enabled_iterations = max(1, iterations // 100)
+			seconds = min(timeit.repeat(lambda: logger.info("value: {}", payload), number=enabled_iterations, repeat=3))
+		finally:
+			sys.stdout.close()
+			sys.stdout = stdout
+		print("{:<30} {:8.1f} ns/call".format("enabled info, args", seconds / enabled_iterations * 1e9))
+	finally:
+		shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+#
+# Local stand-ins for an OIDC/UMA identity provider and CloudWatch, used by the client, monitor, metrics and async tests.
+#
+
+import atexit
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+
+from rs.utils.basics import Logger
+
+_LOG_DIRECTORY = tempfile.mkdtemp(prefix="rs-tests-")
+atexit.register(shutil.rmtree, _LOG_DIRECTORY, True)
+
+
+def stub_logger(name, log_level="ERROR"):
+	"""
+	:return: Logger writing to a temp folder removed at exit, instead of rs_logger.log in the working directory
+	"""
+	return Logger(name, log_level, os.path.join(_LOG_DIRECTORY, "test.log"))
+
+
+class StubIdp:
+	"""
+	serves on 127.0.0.1, in a daemon thread:
+		GET /.well-known/openid-configuration, with ETag and Cache-Control max-age, answering 304 to If-None-Match
+		GET /jwks, with the public key of kid 'k1'
+		POST /token, issuing a new access token each time
+		any method on /api/..., answering 401 with a UMA ticket unless the bearer token was issued by /token
+	Attributes:
+		url: base URL, also the issuer
+		stats: Counter of requests by endpoint: discovery, jwks, token, ticket, api
+		delay: seconds /api requests wait before answering
+		connections: set of client (host, port) addresses, one per connection used
+	"""
+
+	def __init__(self, max_age=60, expires_in=300):
+		self.max_age = max_age
+		self.expires_in = expires_in
+		self.delay = 0
+		self.stats = Counter()
+		self.connections = set()
+		self.tokens = set()
+		self.lock = threading.Lock()
+		self.key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+		self._counter = itertools.count(1)
+		self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+		self.server.daemon_threads = True
+		self.server.idp = self
+		self.url = "http://{}:{}".format(*self.server.server_address)
+		self._thread = None
+
+	def start(self):
+		self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *exc_info):
+		self.stop()
+
+	def discovery(self):
+		return {"issuer": self.url, "token_endpoint": self.url + "/token", "jwks_uri": self.url + "/jwks"}
+
+	def jwks(self):
+		key = json.loads(RSAAlgorithm.to_jwk(self.key.public_key()))
+		key.update(kid="k1", use="sig", alg="RS256")
+		return {"keys": [key]}
+
+	def sign(self, **claims):
+		"""
+		:return: RS256 token signed with kid 'k1', issued by this IdP and valid for 5 minutes unless claims say otherwise
+		"""
+		now = int(time.time())
+		payload = {"iss": self.url, "sub": "user", "iat": now, "exp": now + 300}
+		payload.update(claims)
+		return jwt.encode(payload, self.key, "RS256", headers={"kid": "k1"})
+
+	def issue_token(self):
+		with self.lock:
+			self.stats["token"] += 1
+			token = "token{}".format(next(self._counter))
+			self.tokens.add(token)
+		return token
+
+
+class StubCloudWatch:
+	"""
+	records put_metric_data calls instead of publishing them, raising a Throttling error for the first throttled calls
+	"""
+
+	def __init__(self, throttled=0):
+		self.calls = []
+		self.throttled = throttled
+
+	def put_metric_data(self, **kwargs):
+		if self.throttled:
+			self.throttled -= 1
+			error = IOError("Rate exceeded")
+			error.response = {"Error": {"Code": "Throttling"}}
+			raise error
+		self.calls.append(kwargs)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, *args):
+		pass
+
+	def send_json(self, code, body, headers=None):
+		data = b"" if body is None else json.dumps(body).encode("utf-8")
+		self.send_response(code)
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def read_body(self):
+		return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+	def handle_any(self):
+		idp = self.server.idp
+		idp.connections.add(self.client_address)
+		body = self.read_body()
+		if self.path == "/.well-known/openid-configuration":
+			idp.stats["discovery"] += 1
+			headers = {"ETag": '"v1"', "Cache-Control": "max-age={}".format(idp.max_age)}
+			if self.headers.get("If-None-Match") == '"v1"':
+				return self.send_json(304, None, headers)
+			return self.send_json(200, idp.discovery(), headers)
+		if self.path == "/jwks":
+			idp.stats["jwks"] += 1
+			return self.send_json(200, idp.jwks())
+		if self.path == "/token" and self.command == "POST":
+			return self.send_json(200, {"access_token": idp.issue_token(), "expires_in": idp.expires_in})
+		authorization = self.headers.get("Authorization", "")
+		token = authorization.split(" ", 1)[1] if " " in authorization else ""
+		with idp.lock:
+			if token not in idp.tokens:
+				idp.stats["ticket"] += 1
+				return self.send_json(401, {}, {"WWW-Authenticate": 'UMA realm="api", as_uri="{}", ticket=t1'.format(idp.url)})
+			idp.stats["api"] += 1
+		if idp.delay:
+			time.sleep(idp.delay)
+		self.send_json(200, {"path": self.path, "method": self.command, "body": body.decode("utf-8")})
+
+	do_GET = handle_any
+	do_POST = handle_any
+	do_PUT = handle_any
+	do_PATCH = handle_any
+	do_DELETE = handle_any
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rs.utils.async_clients import AsyncHttpTransport, AsyncOIDCClient, AsyncUMAClient
+from rs.utils.clients import DiscoveryCache, JwksCache, ValidatedTokenCache
+from stub_idp import StubIdp, stub_logger
+
+
+class AsyncClientsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.idp = StubIdp().start()
+		self.logger = stub_logger(self.id())
+
+	def tearDown(self):
+		self.idp.stop()
+
+	def oidc_client(self, **kwargs):
+		kwargs.setdefault("discovery_cache", DiscoveryCache())
+		kwargs.setdefault("jwks_cache", JwksCache())
+		kwargs.setdefault("validated_token_cache", ValidatedTokenCache())
+		return AsyncOIDCClient(self.idp.url, self.logger, **kwargs)
+
+	def test_close_only_closes_own_transport(self):
+		async def run():
+			async with self.oidc_client() as client:
+				self.assertTrue(await client.validate_idp())
+				transport = client.transport
+				self.assertIsNotNone(transport.session)
+			self.assertIsNone(transport.session)
+			async with AsyncHttpTransport() as shared:
+				async with AsyncUMAClient(self.idp.url + "/api", "Y2xpZW50OnNlY3JldA==", self.logger, transport=shared) as client:
+					await client.get("users")
+				self.assertIsNotNone(shared.session)
+				self.assertFalse(shared.session.closed)
+
+		asyncio.run(run())
+
+	def test_discovery_is_fetched_once_and_revalidated_when_stale(self):
+		async def run():
+			cache = DiscoveryCache(ttl=0, min_ttl=0)
+			self.idp.max_age = 0
+			async with self.oidc_client(discovery_cache=cache) as client:
+				documents = await asyncio.gather(*[client.get_well_known() for _ in range(20)])
+				self.assertEqual([self.idp.discovery()] * 20, documents)
+				self.assertEqual(1, self.idp.stats["discovery"])
+				self.assertEqual(self.idp.discovery(), await client.get_well_known())
+				for _ in range(100):
+					if self.idp.stats["discovery"] == 2 and cache.lookup(self.idp.url)[1] == "stale":
+						break
+					await asyncio.sleep(0.01)
+				self.assertEqual(2, self.idp.stats["discovery"])
+
+		asyncio.run(run())
+
+	def test_validate_jwt_fetches_jwks_once(self):
+		async def run():
+			async with self.oidc_client() as client:
+				tokens = [self.idp.sign(scope="read"), self.idp.sign()]
+				results = await asyncio.gather(*[client.validate_jwt(["scope"], token) for token in tokens * 5])
+				self.assertEqual([True, False] * 5, results)
+				self.assertEqual([True, False], await client.validate_jwts(tokens, ["scope"]))
+				self.assertFalse(await client.validate_jwt(["sub"], tokens[0], error_claim="scope"))
+				self.assertFalse(await client.validate_jwt([], tokens[1][:-4] + "AAAA"))
+				self.assertEqual(1, self.idp.stats["jwks"])
+
+		asyncio.run(run())
+
+	def test_uma_rpt_is_requested_once_and_refreshed_once_when_rejected(self):
+		async def run():
+			async with AsyncUMAClient(self.idp.url + "/api", "Y2xpZW50OnNlY3JldA==", self.logger) as client:
+				results = await asyncio.gather(*[client.get("users") for _ in range(20)])
+				self.assertEqual([{"path": "/api/users", "method": "GET", "body": ""}] * 20, results)
+				self.assertEqual((1, 1), (self.idp.stats["ticket"], self.idp.stats["token"]))
+				self.idp.tokens.clear()
+				await asyncio.gather(*[client.get("users") for _ in range(20)])
+				self.assertEqual(2, self.idp.stats["token"])
+
+		asyncio.run(run())
+
+	def test_execute_many_reports_every_entry(self):
+		async def run():
+			async with AsyncUMAClient(self.idp.url + "/api", "Y2xpZW50OnNlY3JldA==", self.logger, is_gluu_45=True) as client:
+				entries = [("PUT", "items/{}".format(i), {"i": i}) for i in range(30)] + [("OPTIONS", "items")]
+				reports = [report async for report in client.execute_many(entries, max_concurrency=4, rate_limit=1000)]
+				self.assertEqual(list(range(31)), sorted(report["index"] for report in reports))
+				by_index = {report["index"]: report for report in reports}
+				self.assertEqual([None] * 30, [by_index[i]["error"] for i in range(30)])
+				self.assertIsInstance(by_index[30]["error"], IOError)
+				self.assertEqual('{"i": 3}', by_index[3]["result"]["body"])
+				self.assertEqual(1, self.idp.stats["token"])
+
+		asyncio.run(run())
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rs.utils import http
+from rs.utils.clients import DiscoveryCache, JwksCache, OIDCClient, TokenCache, UMAClient, ValidatedTokenCache
+from rs.utils.metrics import MetricsRegistry
+from stub_idp import StubIdp, stub_logger
+
+CREDENTIALS = "Y2xpZW50OnNlY3JldA=="
+
+
+class StubIdpTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.idp = StubIdp().start()
+		self.transport = http.HttpTransport(metrics=MetricsRegistry())
+		self.logger = stub_logger(self.id())
+
+	def tearDown(self):
+		self.transport.close()
+		self.idp.stop()
+
+	def oidc_client(self, **kwargs):
+		kwargs.setdefault("discovery_cache", DiscoveryCache())
+		kwargs.setdefault("jwks_cache", JwksCache())
+		kwargs.setdefault("validated_token_cache", ValidatedTokenCache())
+		return OIDCClient(self.idp.url, self.logger, transport=self.transport, **kwargs)
+
+
+class DiscoveryCacheTest(StubIdpTestCase):
+
+	def test_fresh_document_is_shared(self):
+		cache = DiscoveryCache()
+		clients = [self.oidc_client(discovery_cache=cache) for _ in range(5)]
+		self.assertEqual([self.idp.discovery()] * 5, [client.well_known for client in clients])
+		self.assertEqual(1, self.idp.stats["discovery"])
+		self.assertTrue(clients[0].validate_idp())
+		self.assertEqual(2, self.idp.stats["discovery"])
+
+	def test_stale_document_is_served_while_revalidating(self):
+		cache = DiscoveryCache(ttl=0, min_ttl=0)
+		self.idp.max_age = 0
+		client = self.oidc_client(discovery_cache=cache)
+		self.assertEqual(self.idp.discovery(), client.get_well_known())
+		for _ in range(100):
+			if self.idp.stats["discovery"] == 2 and not cache._entries[self.idp.url]["revalidating"]:
+				break
+			time.sleep(0.01)
+		self.assertEqual(2, self.idp.stats["discovery"])
+		self.assertEqual(self.idp.discovery(), cache.lookup(self.idp.url)[0])
+
+	def test_min_ttl_applies_to_no_cache_responses(self):
+		cache = DiscoveryCache(min_ttl=60)
+		self.idp.max_age = 0
+		self.oidc_client(discovery_cache=cache)
+		self.assertEqual("fresh", cache.lookup(self.idp.url)[1])
+
+
+class UMAClientTest(StubIdpTestCase):
+
+	def uma_client(self, **kwargs):
+		return UMAClient(self.idp.url + "/api", CREDENTIALS, self.logger, transport=self.transport, **kwargs)
+
+	def test_rpt_is_fetched_once_per_resource(self):
+		client = self.uma_client()
+		with ThreadPoolExecutor(max_workers=8) as executor:
+			results = list(executor.map(lambda _: client.get("users"), range(20)))
+		self.assertEqual([{"path": "/api/users", "method": "GET", "body": ""}] * 20, results)
+		self.assertEqual((1, 1), (self.idp.stats["ticket"], self.idp.stats["token"]))
+		client.post("users", {"name": "x"})
+		self.assertEqual(2, self.idp.stats["token"])
+
+	def test_rejected_rpt_is_refreshed_once(self):
+		client = self.uma_client()
+		client.get("users")
+		self.idp.tokens.clear()
+		with ThreadPoolExecutor(max_workers=8) as executor:
+			list(executor.map(lambda _: client.get("users"), range(20)))
+		self.assertEqual(2, self.idp.stats["token"])
+
+	def test_gluu_45_uses_one_client_credentials_token(self):
+		client = self.uma_client(is_gluu_45=True)
+		client.get("users")
+		client.delete("users/1")
+		self.assertEqual((0, 1), (self.idp.stats["ticket"], self.idp.stats["token"]))
+
+
+class UMAClientExecuteManyTest(StubIdpTestCase):
+
+	def test_results_cover_every_entry(self):
+		client = UMAClient(self.idp.url + "/api", CREDENTIALS, self.logger, transport=self.transport)
+		entries = [("PUT", "items/{}".format(i), {"i": i}) for i in range(40)] + [("OPTIONS", "items")]
+		reports = list(client.execute_many(entries, max_workers=4))
+		by_index = {report["index"]: report for report in reports}
+		self.assertEqual(41, len(reports))
+		self.assertEqual(set(range(41)), set(by_index))
+		self.assertEqual([None] * 40, [by_index[i]["error"] for i in range(40)])
+		self.assertEqual('{"i": 7}', by_index[7]["result"]["body"])
+		self.assertIsInstance(by_index[40]["error"], IOError)
+		self.assertLessEqual(len(self.idp.connections), 6)
+
+	def test_entries_are_read_lazily_and_rate_limited(self):
+		client = UMAClient(self.idp.url + "/api", CREDENTIALS, self.logger, transport=self.transport)
+		read = []
+
+		def entries():
+			for i in range(1000):
+				read.append(i)
+				yield "GET", "items"
+
+		start_time = time.monotonic()
+		results = client.execute_many(entries(), max_workers=2, rate_limit=20, burst=1)
+		for _ in range(5):
+			next(results)
+		results.close()
+		self.assertGreaterEqual(time.monotonic() - start_time, 0.15)
+		self.assertLess(len(read), 20)
+
+
+class OIDCClientJwtTest(StubIdpTestCase):
+
+	def test_signatures_are_verified_with_cached_keys(self):
+		client = self.oidc_client()
+		token = self.idp.sign(scope="read")
+		self.assertTrue(client.validate_jwt(["scope"], token))
+		self.assertFalse(client.validate_jwt(["scope"], self.idp.sign()))
+		self.assertFalse(client.validate_jwt(["sub"], token, error_claim="scope"))
+		self.assertFalse(client.validate_jwt(["sub"], self.idp.sign(exp=int(time.time()) - 10)))
+		self.assertFalse(client.validate_jwt(["sub"], token, audience="api"))
+		self.assertTrue(client.validate_jwt(["sub"], self.idp.sign(aud="api"), audience="api"))
+		self.assertEqual([True, False], client.validate_jwts([token, token[:-4] + "AAAA"], ["scope"]))
+		self.assertTrue(client.validate_jwt(["scope"], token[:-4] + "AAAA", verify_signature=False))
+		self.assertEqual(1, self.idp.stats["jwks"])
+
+	def test_unknown_kids_refetch_at_most_once_per_interval(self):
+		client = self.oidc_client(jwks_cache=JwksCache(min_refresh_interval=60))
+		other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+		self.assertTrue(client.validate_jwt(["sub"], self.idp.sign()))
+		for kid in ("k2", "k3", "k4"):
+			token = jwt.encode({"sub": "user", "exp": int(time.time()) + 60}, other_key, "RS256", headers={"kid": kid})
+			self.assertFalse(client.validate_jwt(["sub"], token))
+		self.assertEqual(1, self.idp.stats["jwks"])
+		client.jwks_cache.invalidate()
+		self.assertFalse(client.validate_jwt(["sub"], token))
+		self.assertEqual(2, self.idp.stats["jwks"])
+
+
+class TokenCacheTest(unittest.TestCase):
+
+	def test_expired_tokens_are_dropped(self):
+		cache = TokenCache(safety_margin=0, default_ttl=60)
+		cache.put("a", "token-a", expires_in=0.05)
+		cache.put("b", "token-b")
+		time.sleep(0.1)
+		self.assertIsNone(cache.get("a"))
+		self.assertEqual(["b"], list(cache._tokens))
+
+	def test_size_is_bounded_in_lru_order(self):
+		cache = TokenCache(max_size=3)
+		for key in "abc":
+			cache.put(key, "token-" + key)
+		self.assertEqual("token-a", cache.get("a"))
+		cache.put("d", "token-d")
+		self.assertEqual(["c", "a", "d"], list(cache._tokens))
+		self.assertIsNone(cache.get("b"))
+
+	def test_put_purges_expired_tokens_before_evicting(self):
+		cache = TokenCache(safety_margin=0, max_size=2)
+		cache.put("live", "token-live")
+		cache.put("expired", "token-expired", expires_in=0.05)
+		time.sleep(0.1)
+		cache.put("new", "token-new")
+		self.assertEqual(["live", "new"], list(cache._tokens))
+
+	def test_get_or_fetch_coalesces_callers_and_drops_its_lock(self):
+		cache = TokenCache()
+		fetches = []
+
+		def fetch():
+			fetches.append(1)
+			time.sleep(0.1)
+			return "token", 300
+
+		results = []
+		threads = [threading.Thread(target=lambda: results.append(cache.get_or_fetch("k", fetch))) for _ in range(8)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(1, len(fetches))
+		self.assertEqual(["token"] * 8, results)
+		self.assertEqual({}, cache._fetch_locks)
+
+	def test_failed_fetch_drops_its_lock(self):
+		cache = TokenCache()
+
+		def fetch():
+			raise IOError("down")
+
+		with self.assertRaises(IOError):
+			cache.get_or_fetch("k", fetch)
+		self.assertEqual({}, cache._fetch_locks)
+		self.assertEqual("token", cache.get_or_fetch("k", lambda: ("token", 300)))
+
+
+if __name__ == "__main__":
+	unittest.main()
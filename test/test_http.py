@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rs.utils import http
+from rs.utils.async_clients import AsyncHttpTransport
+from rs.utils.metrics import MetricsRegistry
+from rs.utils.monitors import OIDCMonitor
+from stub_idp import StubCloudWatch, StubIdp, stub_logger
+
+
+class HttpTransportTest(unittest.TestCase):
+
+	def setUp(self):
+		self.idp = StubIdp().start()
+
+	def tearDown(self):
+		self.idp.stop()
+
+	def test_connections_are_reused(self):
+		transport = http.HttpTransport(metrics=MetricsRegistry())
+		try:
+			for _ in range(10):
+				self.assertEqual(200, transport.get(self.idp.url + "/.well-known/openid-configuration").status_code)
+		finally:
+			transport.close()
+		self.assertEqual(1, len(self.idp.connections))
+
+	def test_default_transport_is_shared(self):
+		transport = http.get_default_transport()
+		self.assertIs(transport, http.get_default_transport())
+		replacement = http.HttpTransport()
+		http.set_default_transport(replacement)
+		try:
+			self.assertIs(replacement, http.get_default_transport())
+		finally:
+			http.set_default_transport(transport)
+			replacement.close()
+
+
+class WaitForEndpointsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.logger = stub_logger("test_http")
+
+	def test_waits_for_every_endpoint_concurrently(self):
+		with StubIdp() as ready:
+			late = StubIdp()
+			timer = threading.Timer(1.0, late.start)
+			timer.start()
+			try:
+				start_time = time.monotonic()
+				times = http.wait_for_endpoints([ready.url + "/jwks", late.url + "/jwks"], self.logger, deadline=10,
+												request_timeout=0.3, initial_interval=0.1, max_interval=0.2)
+				elapsed = time.monotonic() - start_time
+			finally:
+				timer.join()
+				late.stop()
+		self.assertLess(times[ready.url + "/jwks"], 0.5)
+		self.assertGreaterEqual(times[late.url + "/jwks"], 1.0)
+		self.assertLess(elapsed, 3)
+
+	def test_deadline_lists_endpoints_not_ready(self):
+		with socket.socket() as sock:
+			sock.bind(("127.0.0.1", 0))
+			url = "http://127.0.0.1:{}/".format(sock.getsockname()[1])
+			start_time = time.monotonic()
+			with self.assertRaises(IOError) as context:
+				http.wait_for_endpoints([url], self.logger, deadline=0.5, initial_interval=0.1)
+		self.assertIn(url, str(context.exception))
+		self.assertLess(time.monotonic() - start_time, 2)
+
+
+class HttpTransportTimingTest(unittest.TestCase):
+
+	def setUp(self):
+		self.idp = StubIdp().start()
+		self.idp.delay = 0.2
+		self.headers = {"Authorization": "Bearer " + self.idp.issue_token()}
+
+	def tearDown(self):
+		self.idp.stop()
+
+	def test_ttfb_excludes_connection_setup(self):
+		metrics = MetricsRegistry()
+		transport = http.HttpTransport(metrics=metrics)
+		try:
+			response = transport.get(self.idp.url + "/api/slow", headers=self.headers)
+			cold = http.last_request_timing()
+			transport.get(self.idp.url + "/api/slow", headers=self.headers)
+			warm = http.last_request_timing()
+		finally:
+			transport.close()
+		self.assertEqual(200, cold["status"])
+		self.assertFalse(cold["reused"])
+		self.assertTrue(warm["reused"])
+		self.assertIsNone(warm["connect"])
+		self.assertIsNone(cold["tls"])
+		self.assertAlmostEqual(response.elapsed.total_seconds(), cold["connect"] + cold["ttfb"], places=3)
+		self.assertGreaterEqual(cold["ttfb"], 0.2)
+		self.assertLessEqual(cold["connect"] + cold["ttfb"], cold["total"])
+		self.assertEqual(1, metrics.histogram("http_request_duration_seconds", phase="connect").count)
+		self.assertEqual(2, metrics.histogram("http_request_duration_seconds", phase="ttfb", status=200).count)
+
+	def test_async_ttfb_excludes_connection_setup(self):
+		metrics = MetricsRegistry()
+
+		async def run():
+			async with AsyncHttpTransport(metrics=metrics) as transport:
+				for _ in range(2):
+					response = await transport.get(self.idp.url + "/api/slow", headers=self.headers)
+					self.assertEqual(200, response.status_code)
+
+		asyncio.run(run())
+		connect = metrics.histogram("http_request_duration_seconds", phase="connect")
+		ttfb = metrics.histogram("http_request_duration_seconds", phase="ttfb")
+		total = metrics.histogram("http_request_duration_seconds", phase="total")
+		self.assertEqual((1, 2, 2), (connect.count, ttfb.count, total.count))
+		self.assertGreaterEqual(ttfb.min, 0.2)
+		self.assertLessEqual(ttfb.max, total.max)
+
+	def test_cold_probe_publishes_phases(self):
+		cloudwatch = StubCloudWatch()
+		monitor = OIDCMonitor(stub_logger("test_http"), cloudwatch, self.idp.url, "Y2xpZW50OnNlY3JldA==")
+		result = monitor.clientcred(cold=True)
+		self.assertEqual("OK", result["status"])
+		self.assertFalse(result["timing"]["reused"])
+		self.assertIsNone(result["timing"]["tls"])
+		published = {datum["MetricName"]: datum["Value"] for datum in cloudwatch.calls[-1]["MetricData"]}
+		metric = "idp-client-credentials-response-cold"
+		self.assertEqual({metric, metric + ".connect", metric + ".ttfb", metric + ".total"}, set(published))
+		self.assertLessEqual(published[metric + ".connect"] + published[metric + ".ttfb"], published[metric + ".total"])
+
+
+class RateLimiterTest(unittest.TestCase):
+
+	def test_reserve_spreads_calls_after_burst(self):
+		limiter = http.RateLimiter(rate=10, burst=2)
+		waits = [limiter.reserve() for _ in range(4)]
+		self.assertEqual([0.0, 0.0], waits[:2])
+		self.assertAlmostEqual(0.1, waits[2], delta=0.01)
+		self.assertAlmostEqual(0.2, waits[3], delta=0.01)
+
+	def test_rate_must_be_positive(self):
+		with self.assertRaises(ValueError):
+			http.RateLimiter(0)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+import gzip
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rs.utils.basics import AsyncLogWriter, LogSink, Logger, _LogCompressor
+
+
+class _Unformattable(object):
+
+	def __format__(self, format_spec):
+		raise AssertionError("disabled calls must not format their args")
+
+
+class LoggerLevelTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.log_path = os.path.join(self.directory, "app.log")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_disabled_levels_do_no_work(self):
+		logger = Logger("test", "WARN", self.log_path)
+		calls = []
+		logger.info(lambda: calls.append("info"))
+		logger.debug("value: {}", _Unformattable())
+		logger.trace(lambda: calls.append("trace"))
+		self.assertEqual([], calls)
+		self.assertFalse(os.path.exists(self.log_path))
+		logger.warn(lambda: "built {}".format(len(calls)))
+		with open(self.log_path) as f:
+			self.assertTrue(f.read().endswith(" || WARN || test || test_disabled_levels_do_no_work || built 0\n"))
+
+	def test_set_level(self):
+		logger = Logger("test", "ERROR", self.log_path)
+		self.assertFalse(logger.is_enabled("INFO"))
+		logger.set_level("TRACE")
+		self.assertTrue(logger.is_enabled("TRACE"))
+		with self.assertRaises(ValueError):
+			logger.set_level("CRITICAL")
+
+
+class AsyncLogWriterTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.log_path = os.path.join(self.directory, "app.log")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def read_lines(self):
+		with open(self.log_path) as f:
+			return f.read().splitlines()
+
+	def test_flush_writes_queued_lines_in_order(self):
+		logger = Logger("test", "INFO", self.log_path, async_mode=True, batch_size=7, flush_interval=60)
+		for i in range(100):
+			logger.info("line {}", i)
+		self.assertTrue(logger.flush(5))
+		lines = self.read_lines()
+		self.assertEqual(["line {}".format(i) for i in range(100)], [line.split(" || ")[-1] for line in lines])
+		logger.close()
+		logger.info("after close")
+		self.assertEqual(101, len(self.read_lines()))
+
+	def test_lines_are_written_after_flush_interval(self):
+		writer = AsyncLogWriter(LogSink(self.log_path), flush_interval=0.1)
+		try:
+			writer.write("queued\n")
+			time.sleep(0.5)
+			self.assertEqual(["queued"], self.read_lines())
+		finally:
+			writer.close()
+
+	def test_full_queue_drops_lines_without_blocking(self):
+		sink = LogSink(self.log_path)
+		writer = AsyncLogWriter(sink, queue_size=10, batch_size=5, flush_interval=0.01, block_on_full=False)
+		try:
+			with sink._lock:
+				start_time = time.monotonic()
+				for i in range(100):
+					writer.write("line {}\n".format(i))
+				self.assertLess(time.monotonic() - start_time, 1)
+			self.assertTrue(writer.flush(5))
+			self.assertGreater(writer.dropped, 0)
+			self.assertEqual(100, len(self.read_lines()) + writer.dropped)
+		finally:
+			writer.close()
+
+
+class LogSinkSharingTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.log_path = os.path.join(self.directory, "app.log")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_loggers_of_a_path_share_one_sink(self):
+		first = Logger("first", "INFO", self.log_path)
+		second = Logger("second", "INFO", os.path.relpath(self.log_path))
+		first.info("one")
+		second.info("two")
+		self.assertIs(first._sink, second._sink)
+		self.assertIs(LogSink.get(self.log_path), first._sink)
+
+	def test_later_loggers_apply_non_default_options(self):
+		library = Logger("OIDCClient", "INFO", self.log_path)
+		library.info("first")
+		app = Logger("app", "INFO", self.log_path, max_bytes=2000, compress=False, backup_count=2)
+		for i in range(100):
+			app.info("line {} {}", i, "x" * 50)
+		Logger("Properties", "INFO", self.log_path).info("last")
+		self.assertEqual((2000, False, 2), (app._sink.max_bytes, app._sink.compress, app._sink.backup_count))
+		self.assertLessEqual(os.path.getsize(self.log_path), 2000)
+		self.assertEqual(3, len(os.listdir(self.directory)))
+
+	def test_processes_append_whole_lines(self):
+		code = "import sys; sys.path.insert(0, {!r}); from rs.utils.basics import Logger; " \
+			   "logger = Logger(sys.argv[1], 'INFO', {!r})\n" \
+			   "for i in range(300): logger.info('{{}} {{}}', i, sys.argv[1] * 2000)".format(
+				   os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."), self.log_path)
+		processes = [subprocess.Popen([sys.executable, "-c", code, name], stdout=subprocess.DEVNULL) for name in "abcd"]
+		for process in processes:
+			self.assertEqual(0, process.wait())
+		with open(self.log_path) as f:
+			lines = f.read().splitlines()
+		self.assertEqual(1200, len(lines))
+		pattern = re.compile(r".* \|\| INFO \|\| ([a-d]) \|\| <module> \|\| (\d+) (\1{2000})$")
+		numbers = {}
+		for line in lines:
+			match = pattern.match(line)
+			self.assertIsNotNone(match, line[:100])
+			numbers.setdefault(match.group(1), []).append(int(match.group(2)))
+		self.assertEqual({name: list(range(300)) for name in "abcd"}, numbers)
+
+
+class LogSinkRetentionTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.log_path = os.path.join(self.directory, "app.log")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_retention_keeps_newest_segments_of_the_same_second(self):
+		for name in ["20261018-095959.gz", "20261018-100000.gz", "20261018-100000.1.gz", "20261018-100000.2.gz",
+					 "20261018-100000.5", "20261018-100000.10.gz"]:
+			open("{}.{}".format(self.log_path, name), "w").close()
+		LogSink(self.log_path, backup_count=2).apply_retention()
+		self.assertEqual(["app.log.20261018-100000.10.gz", "app.log.20261018-100000.5"], sorted(os.listdir(self.directory)))
+
+	def test_size_rotation_keeps_last_segments(self):
+		sink = LogSink(self.log_path, max_bytes=2000, backup_count=2, compress=False)
+		for i in range(200):
+			sink.write(["line {:04d} {}\n".format(i, "x" * 80)])
+		sink.close()
+		segments = sorted((f for f in os.listdir(self.directory) if f != "app.log"),
+						  key=lambda f: [int(part) if part.isdigit() else part for part in f.split(".")])
+		self.assertEqual(2, len(segments))
+		numbers = []
+		for name in segments + ["app.log"]:
+			with open(os.path.join(self.directory, name)) as f:
+				numbers.extend(int(line.split()[1]) for line in f)
+		self.assertEqual(list(range(200 - len(numbers), 200)), numbers)
+
+	def test_interval_rotation_compresses_segments(self):
+		compress_delay = _LogCompressor.compress_delay
+		_LogCompressor.compress_delay = 0
+		try:
+			sink = LogSink(self.log_path, rotate_interval=1, backup_count=3)
+			sink.write(["first\n"])
+			time.sleep(1.1)
+			sink.write(["second\n"])
+			for _ in range(50):
+				segments = [f for f in os.listdir(self.directory) if f != "app.log"]
+				if len(segments) == 1 and segments[0].endswith(".gz"):
+					break
+				time.sleep(0.05)
+			sink.close()
+		finally:
+			_LogCompressor.compress_delay = compress_delay
+		self.assertEqual(1, len(segments))
+		self.assertRegex(segments[0], r"^app\.log\.\d{8}-\d{6}\.gz$")
+		with gzip.open(os.path.join(self.directory, segments[0]), "rt") as f:
+			self.assertEqual("first\n", f.read())
+		with open(self.log_path) as f:
+			self.assertEqual("second\n", f.read())
+
+	def test_sink_reopens_file_rotated_by_another_process(self):
+		sink = LogSink(self.log_path)
+		sink.stale_check_interval = 0
+		sink.max_bytes = 1 << 30
+		sink.write(["before\n"])
+		os.rename(self.log_path, self.log_path + ".old")
+		sink.write(["after\n"])
+		sink.close()
+		with open(self.log_path + ".old") as f:
+			self.assertEqual("before\n", f.read())
+		with open(self.log_path) as f:
+			self.assertEqual("after\n", f.read())
+
+
+class LoggerSuppressionTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.log_path = os.path.join(self.directory, "app.log")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def read_lines(self):
+		with open(self.log_path) as f:
+			return f.read().splitlines()
+
+	def test_summary_is_logged_when_window_ends(self):
+		logger = Logger("test", "INFO", self.log_path, suppress_repeats=2, suppress_window=0.2)
+		for i in range(10):
+			logger.error("IdP unreachable: {}", i)
+		self.assertEqual(2, len(self.read_lines()))
+		time.sleep(0.5)
+		lines = self.read_lines()
+		self.assertEqual(3, len(lines))
+		self.assertIn("suppressed 8 repeats of: IdP unreachable: {}", lines[-1])
+
+	def test_unhashable_messages_are_suppressed_by_repr(self):
+		logger = Logger("test", "INFO", self.log_path, suppress_repeats=1, suppress_window=3600)
+		for _ in range(3):
+			logger.info(["key1", "key2"])
+		logger.close()
+		lines = self.read_lines()
+		self.assertEqual(2, len(lines))
+		self.assertTrue(lines[0].endswith("|| ['key1', 'key2']"))
+		self.assertIn("suppressed 2 repeats of: ['key1', 'key2']", lines[-1])
+
+	def test_summary_is_logged_at_exit(self):
+		code = "import sys; sys.path.insert(0, {!r}); from rs.utils.basics import Logger; " \
+			   "logger = Logger('test', 'INFO', {!r}, suppress_repeats=1, suppress_window=3600)\n" \
+			   "for i in range(5): logger.warn('retrying')".format(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."), self.log_path)
+		subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.DEVNULL)
+		lines = self.read_lines()
+		self.assertEqual(2, len(lines))
+		self.assertIn("suppressed 4 repeats of: retrying", lines[-1])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rs.utils import logs
+from rs.utils.basics import Logger
+from rs.utils.logs import JsonLogReader
+
+
+class JsonLogReaderTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.log_path = os.path.join(self.directory, "app.log")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def write_records(self, records):
+		with open(self.log_path, "a") as f:
+			for ts, level, logger, function, msg in records:
+				f.write(json.dumps({"ts": ts.astimezone().isoformat(), "level": level, "logger": logger,
+									"function": function, "msg": msg}) + "\n")
+
+	def test_logger_json_records(self):
+		logger = Logger("monitor", "INFO", self.log_path, log_format="json")
+		logger.info("probe {} took {} ms", "ropc", 12)
+		logger.error("plain")
+		records = list(JsonLogReader(self.log_path).query())
+		self.assertEqual(["probe ropc took 12 ms", "plain"], [record["msg"] for record in records])
+		self.assertEqual(("probe {} took {} ms", ["ropc", 12]), (records[0]["template"], records[0]["args"]))
+		self.assertEqual({"monitor"}, {record["logger"] for record in records})
+		self.assertEqual("test_logger_json_records", records[1]["function"])
+		self.assertNotIn("template", records[1])
+
+	def test_oversized_records_stay_valid_json(self):
+		logger = Logger("monitor", "INFO", self.log_path, log_format="json")
+		logger.error("x" * 9000)
+		logger.error("document {} fetched", {"key": "é" * 9000})
+		logger.error("small")
+		with open(self.log_path, "rb") as f:
+			lines = f.read().splitlines()
+		self.assertEqual(3, len(lines))
+		self.assertLessEqual(max(len(line) for line in lines), 8191)
+		records = list(JsonLogReader(self.log_path).query(levels="ERROR"))
+		self.assertEqual(3, len(records))
+		self.assertEqual([True, True], [record["truncated"] for record in records[:2]])
+		self.assertTrue(records[0]["msg"].startswith("xxx") and records[0]["msg"].endswith("..."))
+		self.assertEqual("document {} fetched", records[1]["template"])
+		self.assertNotIn("truncated", records[2])
+
+	def test_query_filters_and_skips_blocks(self):
+		start = datetime(2026, 10, 18, 10, 0, 0)
+		records = []
+		for i in range(100):
+			level = "ERROR" if i == 42 else "INFO"
+			logger = "monitor" if i < 50 else "clients"
+			records.append((start + timedelta(seconds=i), level, logger, "probe" if i % 2 else "run", str(i)))
+		self.write_records(records)
+		reader = JsonLogReader(self.log_path, block_lines=10)
+		index = reader.update_index()
+		self.assertEqual(10, len(index["blocks"]))
+		self.assertEqual(["ERROR", "INFO"], sorted(index["blocks"][4]["levels"]))
+		self.assertEqual(["INFO"], index["blocks"][5]["levels"])
+		self.assertEqual(["42"], [record["msg"] for record in reader.query(levels="ERROR")])
+		self.assertEqual([str(i) for i in range(51, 100, 2)],
+						 [record["msg"] for record in reader.query(loggers=["clients"], functions="probe")])
+		since = start + timedelta(seconds=95)
+		self.assertEqual(["95", "96"], [record["msg"] for record in reader.query(since=since, until=since.timestamp() + 1)])
+
+	def test_index_is_updated_incrementally_and_rebuilt_after_rotation(self):
+		start = datetime(2026, 10, 18, 10, 0, 0)
+		self.write_records([(start, "INFO", "a", "f", "first")])
+		with open(self.log_path, "a") as f:
+			f.write("not json\n")
+		reader = JsonLogReader(self.log_path, block_lines=10)
+		self.assertEqual(["first"], [record["msg"] for record in reader.query()])
+		self.write_records([(start, "WARN", "a", "f", "second")])
+		with open(self.log_path, "a") as f:
+			f.write('{"ts": "2026-10-18T10:00:00", "msg": "partial')
+		index = reader.update_index()
+		self.assertEqual(1, len(index["blocks"]))
+		self.assertEqual(3, index["blocks"][0]["lines"])
+		self.assertEqual(["first", "second"], [record["msg"] for record in reader.query()])
+		os.rename(self.log_path, self.log_path + ".1")
+		self.write_records([(start, "ERROR", "b", "g", "rotated")])
+		self.assertEqual(["rotated"], [record["msg"] for record in JsonLogReader(self.log_path, block_lines=10).query()])
+
+	def test_command_line(self):
+		now = datetime.now()
+		self.write_records([(now - timedelta(hours=1), "ERROR", "a", "f", "old"), (now, "ERROR", "a", "f", "new"),
+							(now, "INFO", "a", "f", "info")])
+		output = io.StringIO()
+		with redirect_stdout(output):
+			logs.main([self.log_path, "--level", "ERROR", "--last", "60"])
+		self.assertEqual(["new"], [json.loads(line)["msg"] for line in output.getvalue().splitlines()])
+
+
+if __name__ == "__main__":
+	unittest.main()
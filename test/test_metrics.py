@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rs.utils import http
+from rs.utils.metrics import CloudWatchPublisher, Histogram, MetricsRegistry
+from rs.utils.monitors import OIDCMonitor
+from stub_idp import StubCloudWatch, StubIdp, stub_logger
+
+
+class MetricsTest(unittest.TestCase):
+
+	def test_percentiles_have_bounded_error(self):
+		histogram = Histogram()
+		for value in range(1, 10001):
+			histogram.record(value / 1000.0)
+		histogram.record(0)
+		for percentile, expected in ((50, 5.0), (95, 9.5), (99, 9.9)):
+			self.assertAlmostEqual(expected, histogram.percentile(percentile), delta=expected * 0.045)
+		self.assertEqual((10001, 0, 10.0), (histogram.count, histogram.min, histogram.max))
+		self.assertEqual(0.0, histogram.percentile(0.001))
+
+	def test_registry_merges_series_and_exports_prometheus(self):
+		metrics = MetricsRegistry()
+		metrics.record("http_request_duration_seconds", 0.1, host="a", phase="ttfb")
+		metrics.record("http_request_duration_seconds", 0.3, host="b", phase="ttfb")
+		metrics.record("http_request_duration_seconds", 0.5, host="b", phase="total")
+		self.assertEqual(2, metrics.histogram("http_request_duration_seconds", phase="ttfb").count)
+		self.assertEqual(2, metrics.histogram("http_request_duration_seconds", host="b").count)
+		text = metrics.to_prometheus()
+		self.assertEqual(1, text.count("# TYPE rs_http_request_duration_seconds summary"))
+		self.assertIn('rs_http_request_duration_seconds_count{host="b",phase="total"} 1', text)
+		self.assertIn('rs_http_request_duration_seconds{host="a",phase="ttfb",quantile="0.99"} ', text)
+
+	def test_exports_mix_failed_and_successful_calls(self):
+		metrics = MetricsRegistry()
+		with StubIdp() as idp:
+			transport = http.HttpTransport(metrics=metrics)
+			try:
+				self.assertEqual(200, transport.get(idp.url + "/jwks").status_code)
+			finally:
+				transport.close()
+		transport = http.HttpTransport(metrics=metrics)
+		try:
+			with self.assertRaises(IOError):
+				transport.get(idp.url + "/jwks", timeout=1)
+		finally:
+			transport.close()
+		self.assertEqual({"200", "error"}, {series['labels']['status'] for series in
+										   metrics.to_dict()["http_request_duration_seconds"]})
+		self.assertIn('status="error"', metrics.to_prometheus())
+		self.assertEqual(1, metrics.histogram("http_response_bytes", status=200).count)
+
+
+class CloudWatchPublisherTest(unittest.TestCase):
+
+	def publisher(self, cloudwatch, **kwargs):
+		publisher = CloudWatchPublisher(cloudwatch, flush_interval=60, **kwargs)
+		self.addCleanup(publisher.close)
+		return publisher
+
+	def test_values_are_aggregated_per_metric_and_dimensions(self):
+		cloudwatch = StubCloudWatch()
+		publisher = self.publisher(cloudwatch, namespace="Test", max_values=2)
+		for value in (10, 20, 10, 30):
+			publisher.put("idp-ropc-response", value, unit="Milliseconds", Idp="a")
+		publisher.put("idp-ropc-response", 5, unit="Milliseconds", Idp="b")
+		self.assertEqual([], cloudwatch.calls)
+		publisher.flush()
+		self.assertEqual(1, len(cloudwatch.calls))
+		self.assertEqual("Test", cloudwatch.calls[0]["Namespace"])
+		datums = [(datum["Dimensions"][0]["Value"], datum["Values"], datum["Counts"])
+				  for datum in cloudwatch.calls[0]["MetricData"]]
+		self.assertEqual([("a", [10, 20], [2, 1]), ("a", [30], [1]), ("b", [5], [1])], datums)
+		publisher.flush()
+		self.assertEqual(1, len(cloudwatch.calls))
+
+	def test_statistics_and_batches(self):
+		cloudwatch = StubCloudWatch()
+		publisher = self.publisher(cloudwatch, aggregation="statistics", max_datums=2)
+		for i in range(5):
+			publisher.put("metric{}".format(i), 1)
+			publisher.put("metric{}".format(i), 3)
+		publisher.flush()
+		self.assertEqual([2, 2, 1], [len(call["MetricData"]) for call in cloudwatch.calls])
+		statistics = cloudwatch.calls[0]["MetricData"][0]["StatisticValues"]
+		self.assertEqual({'SampleCount': 2, 'Sum': 4.0, 'Minimum': 1, 'Maximum': 3}, statistics)
+		with self.assertRaises(ValueError):
+			CloudWatchPublisher(cloudwatch, aggregation="average")
+
+	def test_full_buffer_is_flushed_in_background(self):
+		cloudwatch = StubCloudWatch()
+		publisher = self.publisher(cloudwatch, max_datums=3)
+		for i in range(3):
+			publisher.put("metric{}".format(i), i)
+		for _ in range(100):
+			if cloudwatch.calls:
+				break
+			time.sleep(0.01)
+		self.assertEqual(3, len(cloudwatch.calls[0]["MetricData"]))
+
+	def test_throttled_calls_are_retried_and_failed_calls_dropped(self):
+		cloudwatch = StubCloudWatch(throttled=2)
+		publisher = self.publisher(cloudwatch, backoff_factor=0.01)
+		publisher.put("metric", 1)
+		publisher.flush()
+		self.assertEqual((1, 0), (len(cloudwatch.calls), publisher.dropped))
+		cloudwatch.throttled = 10
+		publisher.max_retries = 1
+		publisher.put("metric", 1)
+		publisher.flush()
+		self.assertEqual((1, 1), (len(cloudwatch.calls), publisher.dropped))
+
+	def test_close_publishes_pending_datapoints(self):
+		cloudwatch = StubCloudWatch()
+		publisher = CloudWatchPublisher(cloudwatch)
+		publisher.put("metric", 1)
+		publisher.close()
+		publisher.close()
+		self.assertEqual(1, len(cloudwatch.calls))
+		self.assertFalse(publisher._thread.is_alive())
+
+	def test_monitor_buffers_probe_metrics(self):
+		with StubIdp() as idp:
+			cloudwatch = StubCloudWatch()
+			publisher = self.publisher(cloudwatch)
+			monitor = OIDCMonitor(stub_logger("test_metrics"), None, idp.url, "Y2xpZW50OnNlY3JldA==", publisher=publisher)
+			for _ in range(3):
+				self.assertEqual("OK", monitor.clientcred()["status"])
+			self.assertEqual([], cloudwatch.calls)
+			monitor.flush_metrics()
+		self.assertEqual(1, len(cloudwatch.calls))
+		datum = cloudwatch.calls[0]["MetricData"][0]
+		self.assertEqual("idp-client-credentials-response", datum["MetricName"])
+		self.assertEqual(3, sum(datum["Counts"]))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rs.utils.metrics import MetricsRegistry
+from rs.utils.monitors import OIDCMonitor, ProbeScheduler
+from stub_idp import StubIdp, stub_logger
+
+
+class ProbeSchedulerTest(unittest.TestCase):
+
+	def setUp(self):
+		self.logger = stub_logger("test_monitors")
+
+	def test_run_once_runs_probes_concurrently(self):
+		barrier = threading.Barrier(3, timeout=5)
+
+		def probe(status):
+			barrier.wait()
+			return {'status': status}
+
+		def failing():
+			barrier.wait()
+			raise IOError("down")
+
+		metrics = MetricsRegistry()
+		scheduler = ProbeScheduler(self.logger, metrics=metrics)
+		scheduler.add("ok", probe, "OK")
+		scheduler.add("error", probe, status="ERROR")
+		scheduler.add("failing", failing)
+		results = scheduler.run_once()
+		self.assertEqual({"ok": {'status': 'OK'}, "error": {'status': 'ERROR'}, "failing": {'status': 'ERROR'}}, results)
+		self.assertEqual(results, scheduler.last_results)
+		self.assertEqual(1, metrics.histogram("probe_response_time_ms", probe="ok", status="OK").count)
+		self.assertEqual(2, metrics.histogram("probe_response_time_ms", status="ERROR").count)
+
+	def test_scheduled_runs_skip_busy_probes(self):
+		release = threading.Event()
+		calls = {"fast": 0, "slow": 0}
+		results = []
+
+		def probe(name):
+			calls[name] += 1
+			if name == "slow":
+				release.wait(5)
+			return {'status': 'OK'}
+
+		scheduler = ProbeScheduler(self.logger, interval=0.05)
+		scheduler.add("fast", probe, "fast")
+		scheduler.add("slow", probe, "slow")
+		scheduler.subscribe(lambda name, result: results.append((name, result['status'])))
+		scheduler.start()
+		try:
+			time.sleep(0.5)
+			slow_calls = calls["slow"]
+			release.set()
+			time.sleep(0.2)
+		finally:
+			scheduler.stop()
+		self.assertGreater(calls["fast"], 3)
+		self.assertEqual(1, slow_calls)
+		self.assertIn(("slow", "OK"), results)
+		self.assertEqual(calls["fast"], results.count(("fast", "OK")))
+
+	def test_run_load_reports_requests_errors_and_throughput(self):
+		scheduler = ProbeScheduler(self.logger)
+		scheduler.add("ok", lambda: {'status': 'OK'})
+		scheduler.add("error", lambda: {'status': 'ERROR'})
+		reports = scheduler.run_load(4, rate=100, duration=0.5)
+		total = reports['total']
+		self.assertEqual(total['requests'], reports['ok']['requests'] + reports['error']['requests'])
+		self.assertEqual(reports['error']['requests'], total['errors'])
+		self.assertEqual(0, reports['ok']['errors'])
+		self.assertEqual(1.0, reports['error']['error_rate'])
+		self.assertAlmostEqual(0.5, total['error_rate'], delta=0.1)
+		self.assertAlmostEqual(100, total['throughput'], delta=25)
+		self.assertEqual(total['requests'], total['latency']['count'])
+
+	def test_run_load_against_idp(self):
+		with StubIdp() as idp:
+			monitor = OIDCMonitor(self.logger, None, idp.url, "Y2xpZW50OnNlY3JldA==")
+			scheduler = ProbeScheduler(self.logger)
+			scheduler.add("clientcred", monitor.clientcred)
+			reports = scheduler.run_load(4, duration=0.5)
+			self.assertEqual(0, reports['clientcred']['errors'])
+			self.assertGreater(reports['clientcred']['requests'], 4)
+			self.assertEqual(reports['clientcred']['requests'], idp.stats["token"])
+
+
+if __name__ == "__main__":
+	unittest.main()
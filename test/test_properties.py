@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rs.utils.basics import Properties, PropertiesWatcher, TemplateReplacer, parse_properties
+
+_working_directory = os.getcwd()
+
+
+def setUpModule():
+	# Properties logs to rs_logger.log in the working directory, keep it out of the repo
+	os.chdir(tempfile.mkdtemp(prefix="rs-tests-"))
+
+
+def tearDownModule():
+	log_directory = os.getcwd()
+	os.chdir(_working_directory)
+	shutil.rmtree(log_directory, True)
+
+
+class TemplateReplacerRenderTest(unittest.TestCase):
+
+	def test_values_are_not_expanded_again(self):
+		replacer = TemplateReplacer("$(", ")", {"a": "$(b)", "b": "2", "n": 3})
+		self.assertEqual(("x=$(b) y=2 z=3 $(a", {"a", "b", "n"}), replacer.render("x=$(a) y=$(b) z=$(n) $(a"))
+
+	def test_missing_keys_are_reported_together(self):
+		replacer = TemplateReplacer("{{", "}}", {"a": "1"})
+		with self.assertRaises(KeyError) as context:
+			replacer.render("{{a}} {{b}} {{c.d}} {{b}}")
+		self.assertEqual({"b", "c.d"}, context.exception.args[0])
+
+
+class TemplateReplacerStreamTest(unittest.TestCase):
+
+	delimiters = [("$(", ")"), ("@", "@"), ("%", "%"), ("${", "}"), ("@@", "@@"), ("<%", "%>"), ("[", "_]")]
+
+	def render(self, replacer, text):
+		try:
+			return replacer.render(text)[0], None
+		except KeyError as err:
+			return None, err.args[0]
+
+	def render_stream(self, replacer, text, chunk_size):
+		file_out = io.StringIO()
+		try:
+			replacer.render_stream(io.StringIO(text), file_out, chunk_size)
+			return file_out.getvalue(), None
+		except KeyError as err:
+			return None, err.args[0]
+
+	def test_stream_matches_render_for_chunk_ending_in_placeholder(self):
+		replacer = TemplateReplacer("@", "@", {"host": "idp.myorg.com"})
+		text = "url=https://@host@"
+		for chunk_size in range(1, len(text) + 2):
+			self.assertEqual(("url=https://idp.myorg.com", None), self.render_stream(replacer, text, chunk_size))
+
+	def test_stream_fuzz_against_render(self):
+		rnd = random.Random(1234)
+		for param_prefix, param_suffix in self.delimiters:
+			values = {"a": "1", "host": "x@y", "b.c": "%(", "": "never"}
+			replacer = TemplateReplacer(param_prefix, param_suffix, values)
+			pieces = [param_prefix, param_suffix, param_prefix[0], param_suffix[-1], "a", "host", "b.c", "zz", " ",
+					  "\n", ".", "_"]
+			for _ in range(300):
+				text = "".join(rnd.choice(pieces) for _ in range(rnd.randint(0, 30)))
+				expected = self.render(replacer, text)
+				for chunk_size in (1, 2, 3, 5, 10):
+					self.assertEqual(expected, self.render_stream(replacer, text, chunk_size),
+									 "{}{} {!r} chunk {}".format(param_prefix, param_suffix, text, chunk_size))
+
+
+class ParsePropertiesTest(unittest.TestCase):
+
+	def test_plain_values_are_stripped(self):
+		self.assertEqual({"a": "x", "b": "y z"}, parse_properties(['a = "x" ', "b=  y z\t"]))
+
+	def test_escaped_edges_are_kept(self):
+		lines = ["tab=\\t|", "tab2=|\\t", "lead=\\ lead", "trail=trail\\ ", 'quoted=\\"q\\"', "back=\\\\"]
+		self.assertEqual({"tab": "\t|", "tab2": "|\t", "lead": " lead", "trail": "trail ", "quoted": '"q"',
+						  "back": "\\"}, parse_properties(lines))
+
+	def test_java_syntax(self):
+		lines = ["# comment\n", "  ! comment\n", "\n", "a=1\n", "b : 2\n", "c 3\n", "d\n", "e:f=g\n",
+				 "multi = one, \\\n", "    two, \\\r\n", "    three\n", "key\\ with\\:sep = v\n",
+				 "unicode=caf\\u00e9 \\u2603\n", "url=http\\://x\n", "last = \\"]
+		self.assertEqual({"a": "1", "b": "2", "c": "3", "d": "", "e": "f=g", "multi": "one, two, three",
+						  "key with:sep": "v", "unicode": "caf\u00e9 \u2603", "url": "http://x", "last": ""},
+						 parse_properties(lines))
+
+	def test_unescaped_edges_of_escaped_values_are_stripped(self):
+		self.assertEqual({"a": "C:\\dir", "b": "x\ty"}, parse_properties(['a="C:\\\\dir"  ', "b= x\\ty "]))
+
+
+class PropertiesLayersTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.default_path = os.path.join(self.folder, "sample.properties")
+		self.local_path = os.path.join(self.folder, "local.properties")
+		self.write_file(self.default_path, "host=idp\nport=443\nurl=https://{{host}}:{{port}}\n")
+		self.write_file(self.local_path, "port=8443\n")
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def write_file(self, path, text):
+		with open(path, "w") as file_out:
+			file_out.write(text)
+
+	def test_layers_override_in_order(self):
+		extra_path = os.path.join(self.folder, "extra.properties")
+		self.write_file(extra_path, "host=extra\nname=x\n")
+		os.environ["RS_TEST_LAYERS_NAME"] = "env"
+		try:
+			props = Properties(self.local_path, self.default_path, layers=[extra_path, {"host": "dict"}],
+							   env_prefix="RS_TEST_LAYERS_")
+		finally:
+			del os.environ["RS_TEST_LAYERS_NAME"]
+		self.assertEqual(("dict", "8443", "env"), (props.get("host"), props.get("port"), props.get("name")))
+		props.put("host", "put")
+		self.assertEqual("https://put:8443", props.get("url"))
+
+	def test_parse_cache_is_used_until_the_file_changes(self):
+		cache_dir = os.path.join(self.folder, "cache")
+		Properties(self.local_path, self.default_path, parse_cache_dir=cache_dir)
+		self.assertEqual(2, len(os.listdir(cache_dir)))
+		Properties._parse_cache.clear()
+		for cache_file in os.listdir(cache_dir):
+			with open(os.path.join(cache_dir, cache_file)) as file_in:
+				cached = json.load(file_in)
+			cached["props"] = {k: v + "-cached" for k, v in cached["props"].items()}
+			self.write_file(os.path.join(cache_dir, cache_file), json.dumps(cached))
+		self.assertEqual("8443-cached", Properties(self.local_path, self.default_path, parse_cache_dir=cache_dir).get("port"))
+		Properties._parse_cache.clear()
+		self.write_file(self.local_path, "port=9443\n")
+		self.assertEqual("9443", Properties(self.local_path, self.default_path, parse_cache_dir=cache_dir).get("port"))
+
+
+class PropertiesResolveTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.local_path = os.path.join(self.folder, "local.properties")
+		open(self.local_path, "w").close()
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def properties(self, values):
+		return Properties(self.local_path, self.local_path, layers=[values])
+
+	def test_nested_references_are_resolved_and_invalidated(self):
+		props = self.properties({"a": "{{b}}-{{c}}", "b": "{{c}}{{c}}", "c": "1", "d": "{{missing}}", "n": 5})
+		self.assertEqual("11-1", props.get("a"))
+		self.assertEqual("{{missing}}", props.get("d"))
+		self.assertEqual(5, props.get("n"))
+		self.assertIsNone(props.get("missing"))
+		props.put("c", "2")
+		self.assertEqual(("22-2", "22"), (props.get("a"), props.get("b")))
+
+	def test_long_chains_resolve_without_recursion(self):
+		values = {"k{}".format(i): "{{{{k{}}}}}".format(i + 1) for i in range(5000)}
+		values["k5000"] = "end"
+		self.assertEqual("end", self.properties(values).get("k0"))
+
+	def test_circular_references_raise(self):
+		props = self.properties({"a": "x{{b}}", "b": "{{c}}", "c": "{{a}}", "d": "{{d}}"})
+		for key in "abcd":
+			with self.assertRaises(ValueError):
+				props.get(key)
+
+
+class PropertiesReplaceTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.default_path = os.path.join(self.folder, "sample.properties")
+		self.local_path = os.path.join(self.folder, "local.properties")
+		self.write_file(self.default_path, "host=idp\nport=443\nurl=https://$(host):$(port)\n")
+		self.write_file(self.local_path, "port=8443\n")
+		self.templates = os.path.join(self.folder, "templates")
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def write_file(self, path, text):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "w") as file_out:
+			file_out.write(text)
+
+	def read_file(self, path):
+		with open(path) as file_in:
+			return file_in.read()
+
+	def properties(self, **kwargs):
+		return Properties(self.local_path, self.default_path, "$(", ")", **kwargs)
+
+	def test_replace_file_resolves_nested_references(self):
+		path = os.path.join(self.templates, "app.conf")
+		self.write_file(path, "url=$(url)\n")
+		os.chmod(path, 0o640)
+		reports = self.properties().replace(path)
+		self.assertEqual("url=https://idp:8443\n", self.read_file(path))
+		self.assertEqual(0o640, stat.S_IMODE(os.stat(path).st_mode))
+		self.assertEqual([(path, ["url"], False)], [(r["path"], r["keys"], r["skipped"]) for r in reports])
+
+	def test_symlinked_file_target_is_rendered(self):
+		target = os.path.join(self.folder, "shared", "app.conf")
+		path = os.path.join(self.templates, "app.conf")
+		self.write_file(target, "host=$(host)\n")
+		os.makedirs(self.templates)
+		os.symlink(target, path)
+		if os.geteuid() == 0:
+			os.chown(target, 1000, 1000)
+		self.properties().replace(path)
+		self.assertTrue(os.path.islink(path))
+		self.assertEqual("host=idp\n", self.read_file(target))
+		self.assertEqual(["app.conf"], os.listdir(os.path.dirname(target)))
+		if os.geteuid() == 0:
+			self.assertEqual((1000, 1000), (os.stat(target).st_uid, os.stat(target).st_gid))
+
+	def test_missing_keys_leave_file_unchanged(self):
+		path = os.path.join(self.templates, "app.conf")
+		self.write_file(path, "$(host) $(missing)\n")
+		with self.assertRaises(ValueError):
+			self.properties().replace(path)
+		self.assertEqual("$(host) $(missing)\n", self.read_file(path))
+		self.assertEqual(["app.conf"], os.listdir(self.templates))
+
+	def test_replace_folder_filters_and_parallel_workers(self):
+		names = ["a.conf", "b.xml", "sub/c.conf", "sub/skip.conf", "sub/deep/d.conf"]
+		for name in names:
+			self.write_file(os.path.join(self.templates, name), "$(host)")
+		reports = self.properties().replace(self.templates, ".conf", recursive=True, exclude=["*/skip.conf"],
+											workers=4)
+		replaced = [os.path.relpath(r["path"], self.templates) for r in reports]
+		self.assertEqual(["a.conf", "sub/c.conf", "sub/deep/d.conf"], replaced)
+		self.assertEqual("$(host)", self.read_file(os.path.join(self.templates, "b.xml")))
+		self.assertEqual("$(host)", self.read_file(os.path.join(self.templates, "sub/skip.conf")))
+		self.assertEqual("idp", self.read_file(os.path.join(self.templates, "sub/deep/d.conf")))
+		reports = self.properties().replace(self.templates, include=["*.xml"])
+		self.assertEqual(["b.xml"], [os.path.basename(r["path"]) for r in reports])
+
+	def test_large_files_are_streamed(self):
+		path = os.path.join(self.templates, "big.conf")
+		self.write_file(path, "$(url)\n" * 5000)
+		props = self.properties()
+		props.stream_threshold = 1024
+		props.stream_chunk_size = 7
+		self.assertEqual(["url"], props.replace(path)[0]["keys"])
+		self.assertEqual("https://idp:8443\n" * 5000, self.read_file(path))
+
+	def test_manifest_renders_again_only_on_changes(self):
+		manifest_path = os.path.join(self.folder, "manifest.json")
+		path = os.path.join(self.templates, "app.conf")
+		other_path = os.path.join(self.templates, "other.conf")
+		self.write_file(path, "url=$(url)\n")
+		self.write_file(other_path, "host=$(host)\n")
+		props = self.properties(manifest_path=manifest_path)
+		self.assertEqual([False, False], [r["skipped"] for r in props.replace(self.templates)])
+		props = self.properties(manifest_path=manifest_path)
+		self.assertEqual([True, True], [r["skipped"] for r in props.replace(self.templates)])
+		self.write_file(self.local_path, "port=9443\n")
+		props.reload()
+		self.assertEqual([False, True], [r["skipped"] for r in props.replace(self.templates)])
+		self.assertEqual("url=https://idp:9443\n", self.read_file(path))
+		props.put("host", "other")
+		reports = props.replace_changed({"host"})
+		self.assertEqual([path, other_path], [r["path"] for r in reports])
+		self.assertEqual("host=other\n", self.read_file(other_path))
+		self.write_file(path, "edited $(port)\n")
+		self.assertFalse(props.replace(path)[0]["skipped"])
+		self.assertEqual("edited 9443\n", self.read_file(path))
+		self.assertEqual(2, len(os.listdir(manifest_path + ".d")))
+
+
+class PropertiesWriteTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.default_path = os.path.join(self.folder, "sample.properties")
+		self.local_path = os.path.join(self.folder, "local.properties")
+		open(self.default_path, "w").close()
+		open(self.local_path, "w").close()
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def test_write_then_parse_round_trip(self):
+		values = {"plain": "value", "lead": " lead", "trail": "trail ", "quoted": '"quoted"', "half": 'a"',
+				  "tab": "tab\t|", "space": " ", "quote": '"', "spaces": "  ", "back": "a\\ ", "empty": "",
+				  "lines": "a\nb\r\nc", "key with=sep:#!": "x", " key": "=:#!"}
+		props = Properties(self.local_path, self.default_path, layers=[values])
+		out_path = os.path.join(self.folder, "out.properties")
+		props.write(out_path)
+		with open(out_path, "rt") as file_in:
+			self.assertEqual(values, parse_properties(file_in))
+
+	def test_new_file_mode_follows_umask(self):
+		umask = os.umask(0o022)
+		try:
+			props = Properties(self.local_path, self.default_path, layers=[{"a": "1"}])
+			out_path = os.path.join(self.folder, "new.properties")
+			props.write(out_path)
+			self.assertEqual(0o644, stat.S_IMODE(os.stat(out_path).st_mode))
+			os.chmod(out_path, 0o600)
+			props.write(out_path)
+			self.assertEqual(0o600, stat.S_IMODE(os.stat(out_path).st_mode))
+			self.assertEqual(0o022, os.umask(0o022))
+		finally:
+			os.umask(umask)
+
+	def test_symlinked_file_target_is_written(self):
+		target = os.path.join(self.folder, "shared.properties")
+		out_path = os.path.join(self.folder, "out.properties")
+		open(target, "w").close()
+		os.symlink(target, out_path)
+		if os.geteuid() == 0:
+			os.chown(target, 1000, 1000)
+		Properties(self.local_path, self.default_path, layers=[{"a": "1"}]).write(out_path)
+		self.assertTrue(os.path.islink(out_path))
+		with open(target, "rt") as file_in:
+			self.assertEqual("a=1\n", file_in.read())
+		if os.geteuid() == 0:
+			self.assertEqual((1000, 1000), (os.stat(target).st_uid, os.stat(target).st_gid))
+
+
+class PropertiesReloadTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.default_path = os.path.join(self.folder, "sample.properties")
+		self.local_path = os.path.join(self.folder, "local.properties")
+		self.write_file(self.default_path, "host=idp\nurl=https://{{host}}/\n")
+		self.write_file(self.local_path, "")
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def write_file(self, path, text):
+		with open(path, "w") as file_out:
+			file_out.write(text)
+
+	def test_failed_reload_leaves_properties_unchanged(self):
+		props = Properties(self.local_path, self.default_path)
+		self.assertEqual("https://idp/", props.get("url"))
+		self.write_file(self.local_path, "host={{url}}\nextra=1\n")
+		with self.assertRaises(ValueError):
+			props.reload()
+		self.assertEqual("https://idp/", props.get("url"))
+		self.assertIsNone(props.get("extra"))
+		self.write_file(self.local_path, "host=other\n")
+		self.assertEqual({"host", "url"}, props.reload())
+		self.assertEqual("https://other/", props.get("url"))
+
+	def test_watcher_reloads_source_changes(self):
+		props = Properties(self.local_path, self.default_path)
+		changes = []
+		changed = threading.Event()
+		watcher = props.watch(lambda keys, reports: (changes.append(keys), changed.set()), interval=0.2,
+							  debounce=0.05)
+		try:
+			self.write_file(os.path.join(self.folder, "other.log"), "noise\n")
+			self.assertFalse(changed.wait(0.5))
+			self.write_file(self.local_path, "host=other\n")
+			self.assertTrue(changed.wait(5))
+			self.assertEqual([{"host", "url"}], changes)
+		finally:
+			watcher.stop()
+
+	@unittest.skipUnless(sys.platform.startswith("linux"), "inotify is only used on Linux")
+	def test_inotify_ignores_other_files_of_the_folder(self):
+		watcher = PropertiesWatcher(Properties(self.local_path, self.default_path))
+		watcher._open_inotify()
+		try:
+			self.assertIsNotNone(watcher._inotify_fd)
+			self.write_file(os.path.join(self.folder, "rs_logger.log"), "line\n")
+			self.assertFalse(watcher._read_events())
+			self.write_file(self.local_path, "host=other\n")
+			self.assertTrue(watcher._read_events())
+		finally:
+			watcher.stop()
+
+if __name__ == "__main__":
+	unittest.main()